@@ -1,69 +1,312 @@
 import os
-from typing import TypedDict, Literal, List
+import json
+import logging
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict, Literal, List, Dict
 from dotenv import load_dotenv
 
 from langgraph.graph import StateGraph, END
-from langchain_openai import ChatOpenAI
+from langgraph.types import CachePolicy
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.messages import HumanMessage, AIMessage
 
 
 from weather import WeatherTool
-from rag import RAGTool
+from gazetteer import Gazetteer
+from rag import NO_PDF_ANSWER, RAGTool
 from database import ChatDatabase
+from clients import get_chat_model
+from resilience import CircuitBreaker
+from cassette import Cassette
+import deadline
+import metrics
+import node_cache
+import profiling
+import scheduler
+import tracing
+import usage
+import weather_answers
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+INTENT_PROMPT = ChatPromptTemplate.from_template(
+    """You are an intent classifier. Analyze the user's query and classify it as either:
+        - "weather": If asking about weather, temperature, climate, or meteorological conditions
+        - "document": If asking about document content, PDFs, or general knowledge questions
+
+        Respond with ONLY one word: either "weather" or "document"
+
+        Query: {query}
+
+        Intent:
+        """
+)
+
+CITY_PROMPT = ChatPromptTemplate.from_template(
+    """Extract ONLY the city names from this weather query. 
+Respond with just the city names separated by semicolons, nothing else.
+
+Query: {query}
+
+Cities:"""
+)
+
+WEATHER_RESPONSE_PROMPT = ChatPromptTemplate.from_template(
+    """
+    You are a helpful weather assistant. Based on the weather data below, provide a natural, conversational response to the user's question.
+    User Question: {query} Weather Data:{weather_data} Response:
+    """
+)
+
+
+# Remaining-budget thresholds (ms) below which a node takes a cheaper path
+HISTORY_BUDGET_MS = 8000      # send only the last few history messages to the RAG answer
+RERANK_BUDGET_MS = 5000       # skip flashrank and use the vector search order
+RETRIEVAL_BUDGET_MS = 3000    # retrieve fewer chunks
+WEATHER_LLM_BUDGET_MS = 2500  # answer weather questions from a template instead of the LLM
+
+DEGRADED_HISTORY_MESSAGES = 4
+# Turns of a session's history read from the database when run() isn't given any
+HISTORY_TURNS = int(os.getenv("AGENT_HISTORY_TURNS", "10"))
+RETRIEVAL_K = 5
+DEGRADED_RETRIEVAL_K = 3
+WEATHER_TIMEOUT = 10
+MAX_CITIES = 10
+
+# Concurrent weather API calls per pipeline when a query names several cities
+WEATHER_FETCH_WORKERS = int(os.getenv("WEATHER_FETCH_WORKERS", "8"))
+
+# Node cache TTLs in seconds; retrieval entries are also keyed on the PDF's
+# ingestion, so re-ingesting a PDF invalidates them. fetch_weather isn't
+# cached here: WeatherTool's own cache serves stale entries while it
+# refreshes them and remembers unknown cities, which a node cache hit
+# would bypass
+CITY_CACHE_TTL = int(os.getenv("CITY_CACHE_TTL", "86400"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "3600"))
+
+
+def format_weather_answer(weather_data: dict) -> str:
+    """
+    Describe weather data without an LLM call
+    
+    Args:
+        weather_data: Result of WeatherTool.get_weather
+        
+    Returns:
+        One-paragraph answer
+    """
+    return (
+        f"It's currently {weather_data['temperature']}°C with {weather_data['description']} "
+        f"in {weather_data['city']}, {weather_data['country']}. "
+        f"Humidity is {weather_data['humidity']}% and the wind speed is {weather_data['wind_speed']} m/s."
+    )
+
+
+def format_weather_reports(reports: List[dict]) -> str:
+    """
+    Describe the weather in several cities without an LLM call
+    
+    Args:
+        reports: Per-city results of the fetch_weather node, each with
+            "city" and either "data" or "error"
+        
+    Returns:
+        One paragraph per city, then the cities that couldn't be fetched
+    """
+    paragraphs = [format_weather_answer(report["data"]) for report in reports if "data" in report]
+    missing = [report["city"] for report in reports if "error" in report]
+    if missing:
+        paragraphs.append(f"I couldn't get the weather for {', '.join(missing)}.")
+    return "\n\n".join(paragraphs)
+
+
+def parse_cities(text: str) -> List[str]:
+    """
+    Split the city extraction output into city names
+    
+    Args:
+        text: Model output, city names separated by semicolons or newlines
+        
+    Returns:
+        Distinct city names in the order given, at most MAX_CITIES
+    """
+    cities = []
+    seen = set()
+    for name in text.replace("\n", ";").split(";"):
+        name = name.strip().strip(".")
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            cities.append(name)
+    return cities[:MAX_CITIES]
+
+
+def _weather_text(weather_data: dict) -> str:
+    """Weather data as given to the response prompt"""
+    return f"""City: {weather_data['city']}, {weather_data['country']}
+                    Temperature: {weather_data['temperature']}°C
+                    Conditions: {weather_data['description']}
+                    Humidity: {weather_data['humidity']}%
+                    Wind Speed: {weather_data['wind_speed']} m/s"""
+
 
 # Define the state that flows through the graph
 class AgentState(TypedDict):
     query: str
     chat_history: List
+    pdf_name: str
     intent: str
     city: str
+    cities: List
     weather_data: dict
+    weather_reports: List
+    documents: List
+    retrieval: dict
     rag_response: dict
     final_answer: str
     error: str
+    timings: dict
+    token_usage: dict
+    trace_id: str
+    profile_path: str
+    deadline: float
+    degradations: List
+    cache: dict
+    budget: str
+    response_path: str
 
 
 class AgentPipeline:
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-        self.weather_tool = WeatherTool()
-        self.rag_tool = RAGTool()
+    def __init__(self, tracer: tracing.Tracer = None, llm=None, weather_tool: WeatherTool = None,
+                 rag_tool: RAGTool = None, db_name: str = "chat_history.db", deadline_ms: float = None,
+                 cache: node_cache.BaseCache = None, profiler: profiling.Profiler = None,
+                 budget: usage.SessionBudget = None, cassette=None, gazetteer: Gazetteer = None,
+                 weather_answer_mode: str = None):
+        """
+        Build the agent graph
+        
+        Args:
+            tracer: Request tracer (defaults to one configured from the environment)
+            llm: Chat model (defaults to the shared gpt-4o-mini client)
+            weather_tool: Weather tool (defaults to WeatherTool())
+            rag_tool: RAG tool (defaults to RAGTool())
+            db_name: SQLite file chat history is written to
+            deadline_ms: Default latency budget per run (defaults to AGENT_DEADLINE_MS,
+                20000; 0 disables the deadline)
+            cache: Storage for cached node results (defaults to the one selected
+                by AGENT_NODE_CACHE)
+            profiler: Per-request profiler (defaults to one configured from the environment)
+            budget: Per-session token and cost limits (defaults to the ones configured
+                by SESSION_TOKEN_BUDGET / SESSION_COST_BUDGET_USD)
+            cassette: Cassette that records or replays every external call and the
+                runs that made them (defaults to the one configured by AGENT_CASSETTE);
+                it also wraps the default RAG tool's clients
+            gazetteer: City index used to find city names without the LLM
+                (defaults to the one configured by GAZETTEER_PATH)
+            weather_answer_mode: "template" to answer weather questions from local
+                templates and only call the LLM for open-ended ones, or "llm" to
+                always call it (defaults to WEATHER_ANSWER_MODE, "template")
+        """
+        if cassette is None:
+            cassette = Cassette.from_env()
+        self.cassette = cassette
+        if cassette is None or cassette.recording:
+            llm = llm or get_chat_model(temperature=0.3)
+            weather_tool = weather_tool or WeatherTool()
+        if cassette is not None:
+            llm = cassette.chat_model(llm)
+            weather_tool = cassette.weather_tool(weather_tool)
+        self.llm = llm
+        self.weather_tool = weather_tool
+        # One breaker for every chat model call, the RAG tool's included:
+        # they all depend on the same API
+        self.model_breaker = CircuitBreaker.from_env("chat", excluded=(deadline.DeadlineExceeded,))
+        self.rag_tool = rag_tool or RAGTool(db_name=db_name, cassette=cassette, model_breaker=self.model_breaker)
+        # Bounds the weather API calls a multi-city query makes at once
+        self.weather_pool = ThreadPoolExecutor(max_workers=WEATHER_FETCH_WORKERS, thread_name_prefix="weather")
+        self.db_name = db_name
+        self.tracer = tracer or tracing.Tracer.from_env()
+        self.profiler = profiler or profiling.Profiler.from_env()
+        self.budget = budget or usage.SessionBudget.from_env()
+        self.gazetteer = gazetteer if gazetteer is not None else Gazetteer.from_env()
+        self.weather_answer_mode = weather_answer_mode or os.getenv("WEATHER_ANSWER_MODE", weather_answers.TEMPLATE)
+        if self.weather_answer_mode not in (weather_answers.TEMPLATE, weather_answers.LLM):
+            raise ValueError(f"Unknown weather answer mode: {self.weather_answer_mode}")
+        if deadline_ms is None:
+            deadline_ms = float(os.getenv("AGENT_DEADLINE_MS", "20000"))
+        self.deadline_ms = deadline_ms or None
+        if cache is None:
+            cache = node_cache.from_env()
+        elif not isinstance(cache, node_cache.NodeCache):
+            cache = node_cache.NodeCache(cache)
+        self.cache = cache
+        
+        # Compile node chains once instead of on every call; every model
+        # call is admitted through the shared chat rate-limit budget, times
+        # out no later than the request deadline and fails fast while the
+        # model API is down
+        admit = scheduler.get_scheduler("chat").gate()
+        llm = self.model_breaker.guard(deadline.bounded(self.llm))
+        self.intent_chain = INTENT_PROMPT | admit | llm | StrOutputParser()
+        self.city_chain = CITY_PROMPT | admit | llm | StrOutputParser()
+        self.weather_response_chain = WEATHER_RESPONSE_PROMPT | admit | llm | StrOutputParser()
         self.graph = self._build_graph()
     
+    def _remaining_ms(self, state: AgentState):
+        """
+        Milliseconds left in the run's latency budget
+        
+        Returns:
+            Remaining budget, or None if the run has no deadline
+        """
+        left = deadline.remaining(state.get("deadline"))
+        return None if left is None else left * 1000
+    
+    def _short_on_time(self, state: AgentState, threshold_ms: float) -> bool:
+        """Whether less than threshold_ms of the budget is left"""
+        left = self._remaining_ms(state)
+        return left is not None and left < threshold_ms
+    
+    def _economize(self, state: AgentState) -> bool:
+        """Whether the session is close enough to its budget to take cheaper paths"""
+        return state.get("budget") == usage.ECONOMY
+    
+    def _degrade(self, state: AgentState, step: str):
+        """
+        Record a degradation taken to stay within the deadline or session budget
+        
+        Args:
+            state: Current state
+            step: Degradation name, e.g. "skip_rerank"
+        """
+        state.setdefault("degradations", []).append(step)
+        metrics.registry.increment("agent_degradations_total", step=step)
+        logger.info("degraded step=%s remaining_ms=%.0f", step, self._remaining_ms(state) or 0)
+    
     def _classify_intent(self, state: AgentState) -> AgentState:
         """
         Classify user intent: weather or document query
         """
         query = state["query"]
         
-        intent_prompt = ChatPromptTemplate.from_template(
-            """You are an intent classifier. Analyze the user's query and classify it as either:
-                - "weather": If asking about weather, temperature, climate, or meteorological conditions
-                - "document": If asking about document content, PDFs, or general knowledge questions
-
-                Respond with ONLY one word: either "weather" or "document"
-
-                Query: {query}
-
-                Intent:
-                """
-        )
-        
         try:
-            chain = intent_prompt | self.llm | StrOutputParser()
-            intent = chain.invoke({"query": query}).strip().lower()
+            with metrics.timer("llm.classify_intent"):
+                intent = self.intent_chain.invoke(
+                    {"query": query},
+                    config=metrics.llm_config("llm.classify_intent")
+                ).strip().lower()
             
             # Validate intent
             if intent not in ["weather", "document"]:
                 intent = "document"  # Default fallback
             
             state["intent"] = intent
-            print(f"\n[Decision Node] Intent classified as: {intent}")
+            logger.debug("intent_classified intent=%s", intent)
             
         except Exception as e:
             state["error"] = f"Intent classification failed: {str(e)}"
@@ -73,56 +316,155 @@ class AgentPipeline:
     
     def _extract_city(self, state: AgentState) -> AgentState:
         """
-        Extract city name from weather query
+        Extract the city names from weather query, with the gazetteer when
+        it recognizes every place named and otherwise in a single LLM call
         """
         query = state["query"]
         
-        city_prompt = ChatPromptTemplate.from_template(
-            """Extract ONLY the city name from this weather query. 
-Respond with just the city name, nothing else.
-
-Query: {query}
-
-City:"""
-        )
+        # Cached node: return only the keys it sets
+        mentions = self.gazetteer.extract(query) if self.gazetteer is not None else None
+        if mentions:
+            # Keep the country of a qualified name ("London, CA") that the
+            # bare name wouldn't resolve to
+            cities = [
+                city.name if self.gazetteer.resolve(city.name) == city else f"{city.name}, {city.country}"
+                for city in mentions[:MAX_CITIES]
+            ]
+            logger.debug("city_extracted cities=%s source=gazetteer", cities)
+            tracing.add_attributes(city_source="gazetteer")
+            return {"city": cities[0], "cities": cities}
         
         try:
-            chain = city_prompt | self.llm | StrOutputParser()
-            city = chain.invoke({"query": query}).strip()
-            state["city"] = city
-            print(f"[Weather Node] Extracted city: {city}")
+            with metrics.timer("llm.extract_city"):
+                cities = parse_cities(self.city_chain.invoke(
+                    {"query": query},
+                    config=metrics.llm_config("llm.extract_city")
+                ))
+            logger.debug("city_extracted cities=%s", cities)
+            return {"city": cities[0] if cities else "", "cities": cities}
             
         except Exception as e:
-            state["error"] = f"City extraction failed: {str(e)}"
-            state["city"] = ""
-        
-        return state
+            return {"city": "", "cities": [], "error": f"City extraction failed: {str(e)}"}
     
     def _fetch_weather(self, state: AgentState) -> AgentState:
         """
-        Fetch weather data using WeatherTool
+        Fetch weather data using WeatherTool, all cities at once
+        """
+        cities = state.get("cities") or [state["city"]]
+        try:
+            timeout = deadline.timeout(WEATHER_TIMEOUT)
+        except deadline.DeadlineExceeded as e:
+            # Earlier nodes used up the budget; answer without weather
+            # instead of failing the run
+            return {"weather_data": {}, "error": f"Weather fetch failed: {str(e)}"}
+        
+        if len(cities) == 1:
+            city = cities[0]
+            try:
+                with metrics.timer("weather.api"):
+                    weather_data = self.weather_tool.get_weather(city, timeout=timeout)
+                logger.debug("weather_fetched city=%s", city)
+                return {"weather_data": weather_data}
+                
+            except Exception as e:
+                return {"weather_data": {}, "error": f"Weather fetch failed: {str(e)}"}
+        
+        # Each call gets its own copy of the context, so it sees the run's
+        # deadline, trace and profile. When the gazetteer lists every city
+        # they are fetched with one group request first, and the per-city
+        # calls are answered from WeatherTool's cache
+        with metrics.timer("weather.api"):
+            give_up_at = time.monotonic() + timeout
+            self.weather_tool.prefetch(cities, timeout=timeout)
+            timeout = max(give_up_at - time.monotonic(), 0.001)
+            futures = [
+                self.weather_pool.submit(contextvars.copy_context().run, self._fetch_city, city, timeout)
+                for city in cities
+            ]
+            reports = [future.result() for future in futures]
+        
+        found = [report["data"] for report in reports if "data" in report]
+        failed = [f"{report['city']}: {report['error']}" for report in reports if "error" in report]
+        logger.debug("weather_fetched cities=%d failed=%d", len(cities), len(failed))
+        
+        result = {"weather_data": found[0] if found else {}, "weather_reports": reports}
+        if failed:
+            result["error"] = f"Weather fetch failed for {'; '.join(failed)}"
+        return result
+    
+    def _fetch_city(self, city: str, timeout: float) -> dict:
+        """
+        Fetch one city's weather on a weather pool thread
+        
+        Returns:
+            Report with "city" and either "data" or "error"
+        """
+        profiling.register_thread()
+        with tracing.span("weather.fetch", city=city):
+            try:
+                return {"city": city, "data": self.weather_tool.get_weather(city, timeout=timeout)}
+            except Exception as e:
+                logger.warning("weather_fetch_failed city=%s error=%s", city, e)
+                return {"city": city, "error": str(e)}
+    
+    def _retrieval_plan(self, state: AgentState):
+        """
+        Choose retrieval depth and reranking for the remaining time and session budget
+        
+        Returns:
+            Tuple of (k, rerank)
+        """
+        economize = self._economize(state)
+        k = DEGRADED_RETRIEVAL_K if economize or self._short_on_time(state, RETRIEVAL_BUDGET_MS) else RETRIEVAL_K
+        return k, not (economize or self._short_on_time(state, RERANK_BUDGET_MS))
+    
+    def _retrieve_documents(self, state: AgentState) -> AgentState:
+        """
+        Retrieve and rerank the PDF chunks relevant to the query
         """
-        city = state["city"]
+        k, rerank = self._retrieval_plan(state)
+        retrieval = {"k": k, "rerank": rerank}
         
+        # Cached node: return only the keys it sets
         try:
-            weather_data = self.weather_tool.get_weather(city)
-            state["weather_data"] = weather_data
-            print(f"[Weather Node] Fetched weather for {city}")
+            documents = self.rag_tool.retrieve(state["query"], state.get("pdf_name"), k=k, rerank=rerank)
+            logger.debug("documents_retrieved count=%s", None if documents is None else len(documents))
+            return {"documents": documents, "retrieval": retrieval}
             
         except Exception as e:
-            state["error"] = f"Weather fetch failed: {str(e)}"
-            state["weather_data"] = {}
-        
-        return state
+            return {
+                "documents": [],
+                "retrieval": {**retrieval, "failed": True},
+                "error": f"Document retrieval failed: {str(e)}"
+            }
     
     def _query_documents(self, state: AgentState) -> AgentState:
         """
-        Query documents using RAG
+        Answer the query from the retrieved documents using RAG
         """
         query = state["query"]
         chat_history = state.get("chat_history", [])
+        retrieval = state.get("retrieval") or {}
+        
+        # Report the cheaper retrieval the documents came from
+        if retrieval.get("rerank") is False:
+            self._degrade(state, "skip_rerank")
+        if retrieval.get("k", RETRIEVAL_K) < RETRIEVAL_K:
+            self._degrade(state, "shrink_retrieval")
+        if len(chat_history) > DEGRADED_HISTORY_MESSAGES \
+                and (self._economize(state) or self._short_on_time(state, HISTORY_BUDGET_MS)):
+            chat_history = chat_history[-DEGRADED_HISTORY_MESSAGES:]
+            self._degrade(state, "truncate_history")
         
         try:
+            if retrieval.get("failed"):
+                raise RuntimeError(state.get("error") or "Document retrieval failed")
+            
+            documents = state.get("documents")
+            if documents is None:
+                state["rag_response"] = {"answer": NO_PDF_ANSWER, "sources": []}
+                return state
+            
             # Convert chat history to proper format
             formatted_history = []
             for msg in chat_history:
@@ -131,12 +473,13 @@ City:"""
                 elif msg["role"] == "ai":
                     formatted_history.append(AIMessage(content=msg["content"]))
             
-            rag_response = self.rag_tool.query(query, formatted_history)
+            rag_response = self.rag_tool.answer(query, documents, formatted_history)
             state["rag_response"] = rag_response
-            print(f"[RAG Node] Retrieved {len(rag_response.get('sources', []))} sources")
+            logger.debug("documents_queried sources=%d", len(rag_response.get('sources', [])))
             
         except Exception as e:
-            state["error"] = f"RAG query failed: {str(e)}"
+            if not retrieval.get("failed"):
+                state["error"] = f"RAG query failed: {str(e)}"
             state["rag_response"] = {
                 "answer": "Failed to retrieve information from documents.",
                 "sources": []
@@ -144,6 +487,16 @@ City:"""
         
         return state
     
+    def _city_cache_key(self, state: AgentState) -> str:
+        """Cache key for extract_city: the city depends only on the query"""
+        return state["query"].strip()
+    
+    def _retrieval_cache_key(self, state: AgentState) -> str:
+        """Cache key for retrieve_documents: PDF ingestion, query and retrieval plan"""
+        pdf_name = state.get("pdf_name") or ""
+        k, rerank = self._retrieval_plan(state)
+        return json.dumps([pdf_name, self.rag_tool.ingest_id(pdf_name), state["query"], k, rerank], default=str)
+    
     def _generate_response(self, state: AgentState) -> AgentState:
         """
         Generate final response based on intent
@@ -154,45 +507,55 @@ City:"""
         try:
             if intent == "weather":
                 weather_data = state.get("weather_data", {})
-                print(f"DEBUG - Weather data received: {weather_data}")
+                logger.debug("weather_data_received data=%s", weather_data)
+                reports = state.get("weather_reports") or (
+                    [{"city": state.get("city", ""), "data": weather_data}] if weather_data else []
+                )
+                question_type = None
+                if self.weather_answer_mode == weather_answers.TEMPLATE:
+                    question_type = weather_answers.classify_question(query)
                 
-                if weather_data:
-                    # Format weather data nicely
-                    weather_text = f"""City: {weather_data['city']}, {weather_data['country']}
-                    Temperature: {weather_data['temperature']}°C
-                    Conditions: {weather_data['description']}
-                    Humidity: {weather_data['humidity']}%
-                    Wind Speed: {weather_data['wind_speed']} m/s"""
+                if weather_data and question_type is not None:
+                    state["final_answer"] = weather_answers.render(question_type, query, reports)
+                    state["response_path"] = weather_answers.TEMPLATE
+                elif weather_data and (self._economize(state) or self._short_on_time(state, WEATHER_LLM_BUDGET_MS)):
+                    state["final_answer"] = format_weather_reports(reports)
+                    state["response_path"] = weather_answers.DEGRADED_TEMPLATE
+                    self._degrade(state, "template_weather_answer")
+                elif weather_data:
+                    # Format weather data nicely, one block per city
+                    weather_text = "\n\n".join(_weather_text(report["data"]) for report in reports if "data" in report)
+                    missing = [report["city"] for report in reports if "error" in report]
+                    if missing:
+                        weather_text += f"\n\nWeather unavailable for: {', '.join(missing)}"
                     
                     # Generate natural response
-                    response_prompt = ChatPromptTemplate.from_template(
-                        """
-                        You are a helpful weather assistant. Based on the weather data below, provide a natural, conversational response to the user's question.
-                        User Question: {query} Weather Data:{weather_data} Response:
-                        """
-                    )
-                    
-                    chain = response_prompt | self.llm | StrOutputParser()
-                    answer = chain.invoke({
-                        "query": query,
-                        "weather_data": weather_text
-                    })
+                    with metrics.timer("llm.generate_response"):
+                        answer = self.weather_response_chain.invoke(
+                            {
+                                "query": query,
+                                "weather_data": weather_text
+                            },
+                            config=metrics.llm_config("llm.generate_response")
+                        )
                     
                     state["final_answer"] = answer
+                    state["response_path"] = weather_answers.LLM
                 else:
                     state["final_answer"] = "I couldn't fetch the weather data. Please try again."
+                    state["response_path"] = weather_answers.NO_DATA
             
             else:  # document intent
                 rag_response = state.get("rag_response", {})
                 state["final_answer"] = rag_response.get("answer", "No answer available.")
-            
-            # print(f"[Response Node] Generated final answer")
+                state["response_path"] = weather_answers.RAG
             
         except Exception as e:
             state["error"] = f"Response generation failed: {str(e)}"
-            print(f"ERROR: {str(e)}")  
+            logger.error("response_generation_failed error=%s", e)
             state["final_answer"] = "An error occurred while generating the response."
         
+        tracing.add_attributes(response_path=state.get("response_path"))
         return state
     
     def _route_intent(self, state: AgentState) -> Literal["weather", "document"]:
@@ -201,6 +564,26 @@ City:"""
         """
         return state["intent"]
     
+    def _timed_node(self, name: str, node):
+        """
+        Wrap a graph node so its latency is recorded under its node name
+        and everything it calls sees the run's deadline
+        
+        Args:
+            name: Node name
+            node: Node function taking and returning AgentState
+            
+        Returns:
+            Wrapped node function
+        """
+        def timed(state: AgentState) -> AgentState:
+            profiling.register_thread()
+            # Expose the run's deadline to the model scheduler and clients
+            with deadline.scope(state.get("deadline")), metrics.timer(name):
+                return node(state)
+        
+        return timed
+    
     def _build_graph(self) -> StateGraph:
         """
         Build the LangGraph workflow
@@ -209,11 +592,18 @@ City:"""
         workflow = StateGraph(AgentState)
         
         # Add nodes
-        workflow.add_node("classify_intent", self._classify_intent)
-        workflow.add_node("extract_city", self._extract_city)
-        workflow.add_node("fetch_weather", self._fetch_weather)
-        workflow.add_node("query_documents", self._query_documents)
-        workflow.add_node("generate_response", self._generate_response)
+        workflow.add_node("classify_intent", self._timed_node("classify_intent", self._classify_intent))
+        workflow.add_node(
+            "extract_city", self._timed_node("extract_city", self._extract_city),
+            cache_policy=CachePolicy(key_func=self._city_cache_key, ttl=CITY_CACHE_TTL)
+        )
+        workflow.add_node("fetch_weather", self._timed_node("fetch_weather", self._fetch_weather))
+        workflow.add_node(
+            "retrieve_documents", self._timed_node("retrieve_documents", self._retrieve_documents),
+            cache_policy=CachePolicy(key_func=self._retrieval_cache_key, ttl=RETRIEVAL_CACHE_TTL)
+        )
+        workflow.add_node("query_documents", self._timed_node("query_documents", self._query_documents))
+        workflow.add_node("generate_response", self._timed_node("generate_response", self._generate_response))
         
         # Set entry point
         workflow.set_entry_point("classify_intent")
@@ -224,7 +614,7 @@ City:"""
             self._route_intent,
             {
                 "weather": "extract_city",
-                "document": "query_documents"
+                "document": "retrieve_documents"
             }
         )
         
@@ -232,69 +622,282 @@ City:"""
         workflow.add_edge("extract_city", "fetch_weather")
         workflow.add_edge("fetch_weather", "generate_response")
         
-        # Document flow: query_documents -> generate_response
+        # Document flow: retrieve_documents -> query_documents -> generate_response
+        workflow.add_edge("retrieve_documents", "query_documents")
         workflow.add_edge("query_documents", "generate_response")
         
         # End after response generation
         workflow.add_edge("generate_response", END)
         
-        # Compile graph
-        return workflow.compile()
+        # Compile graph; nodes with a cache policy reuse results from the node cache
+        return workflow.compile(cache=self.cache)
   
-    def run(self, query: str, session_id: str, chat_history: List = None) -> dict:
-
+    def _refuse_over_budget(self, state: AgentState) -> AgentState:
         """
-        Run the agent pipeline
+        Answer without any model calls because the session's budget is spent
+        """
+        state["final_answer"] = usage.BUDGET_EXHAUSTED_ANSWER
+        state["response_path"] = weather_answers.REFUSED
+        self._degrade(state, "refuse_over_budget")
+        return state
+    
+    def _execute(self, query: str, chat_history: List = None, pdf_name: str = None,
+                 deadline_ms: float = None, budget: str = usage.OK) -> dict:
+        """
+        Run the graph for a single query without persisting it
         
         Args:
             query: User query
-            session_id: Session identifier
             chat_history: List of previous messages [{"role": "human/ai", "content": "..."}]
+            pdf_name: Name of the PDF document queries should use
+            deadline_ms: Latency budget for this run (defaults to the pipeline's)
+            budget: Session budget status (usage.OK, ECONOMY or EXHAUSTED)
             
         Returns:
-            Final state with answer and metadata
+            Tuple of (final state with answer and metadata, Trace or None)
         """
         if chat_history is None:
             chat_history = []
+        if deadline_ms is None:
+            deadline_ms = self.deadline_ms
         
         initial_state = {
             "query": query,
             "chat_history": chat_history,
+            "pdf_name": pdf_name or "",
             "intent": "",
             "city": "",
+            "cities": [],
             "weather_data": {},
+            "weather_reports": [],
+            "documents": [],
+            "retrieval": {},
             "rag_response": {},
             "final_answer": "",
-            "error": ""
+            "error": "",
+            "timings": {},
+            "token_usage": {},
+            "deadline": deadline.from_budget(deadline_ms),
+            "degradations": [],
+            "cache": {},
+            "budget": budget,
+            "response_path": ""
         }
         
-        print(f"\n{'='*60}")
-        print(f"User Query: {query}")
-        print(f"{'='*60}")
+        logger.info("run_started query=%r", query)
         
-        # Execute graph
-        final_state = self.graph.invoke(initial_state)
+        # Execute graph, collecting a per-request timing breakdown and trace
+        with self.tracer.trace("agent.run", query=query) as trace:
+            with metrics.request_scope() as breakdown:
+                with metrics.timer("total"):
+                    if budget == usage.EXHAUSTED:
+                        final_state = self._refuse_over_budget(initial_state)
+                    else:
+                        final_state = self.graph.invoke(initial_state)
         
-        # Determine which PDF was used (if document intent)
+        final_state["timings"] = breakdown["timings_ms"]
+        final_state["token_usage"] = {
+            **breakdown["tokens"],
+            "cost_usd": sum(call["cost_usd"] for call in breakdown["model_calls"]),
+            "calls": breakdown["model_calls"]
+        }
+        final_state["cache"] = breakdown["cache"]
+        final_state["trace_id"] = trace.trace_id if trace else None
+        if final_state.get("response_path"):
+            metrics.registry.increment("agent_response_path_total", path=final_state["response_path"])
+        return final_state, trace
+    
+    def _history_row(self, session_id: str, query: str, final_state: dict) -> Dict:
+        """
+        Build the chat_history row for a finished run
+        
+        Args:
+            session_id: Session identifier
+            query: User query
+            final_state: State returned by the graph
+            
+        Returns:
+            Keyword arguments for ChatDatabase.insert_message
+        """
+        # Record which PDF was used (if document intent)
         pdf_name = None
-        if final_state["intent"] == "document" and self.rag_tool.vectorstore:
-            # Try to get PDF name from vectorstore or track it separately
-            # For now, we'll pass it from the UI
-            pdf_name = getattr(self.rag_tool, 'current_pdf_name', None)
-        
-        # Save to database with PDF info
-        db = ChatDatabase()
-        db.insert_message(
-            session_id=session_id,
-            user_query=query,
-            ai_response=final_state["final_answer"],
-            intent=final_state["intent"],
-            pdf_name=pdf_name
-        )
+        if final_state["intent"] == "document":
+            pdf_name = final_state.get("pdf_name") or None
+        
+        return {
+            "session_id": session_id,
+            "user_query": query,
+            "ai_response": final_state["final_answer"],
+            "intent": final_state["intent"],
+            "pdf_name": pdf_name
+        }
+    
+    def _usage_rows(self, history_row: Dict, message_id: int, final_state: dict) -> List[Dict]:
+        """
+        Attribute a finished run's model calls to its request, session and PDF
+        
+        Args:
+            history_row: Row returned by _history_row
+            message_id: chat_history row of the request
+            final_state: State returned by _execute
+            
+        Returns:
+            Calls for ChatDatabase.insert_usage
+        """
+        return [
+            {
+                **call,
+                "message_id": message_id,
+                "session_id": history_row["session_id"],
+                "pdf_name": history_row["pdf_name"]
+            }
+            for call in final_state["token_usage"]["calls"]
+        ]
+    
+    def _budget_status(self, db: ChatDatabase, session_id: str) -> str:
+        """
+        Check a session's spending so far against the budget
+        
+        Returns:
+            usage.OK, ECONOMY or EXHAUSTED
+        """
+        if not self.budget.enabled:
+            return usage.OK
+        return self.budget.status(db.get_usage(session_id=session_id))
+  
+    def run(self, query: str, session_id: str, chat_history: List = None, pdf_name: str = None,
+            deadline_ms: float = None, profile: bool = None) -> dict:
+
+        """
+        Run the agent pipeline
+        
+        Safe to call concurrently from many sessions: everything session
+        specific, including the active PDF, travels in the graph state.
+        
+        Args:
+            query: User query
+            session_id: Session identifier
+            chat_history: List of previous messages [{"role": "human/ai", "content": "..."}];
+                None reads the session's last HISTORY_TURNS turns from the database
+            pdf_name: Name of the loaded PDF to answer document questions from
+            deadline_ms: Latency budget for this run (defaults to the pipeline's);
+                steps that would overrun it degrade, and the degradations taken
+                are listed in the result's "degradations"
+            profile: True to profile this run, False to never profile it, None to
+                sample at AGENT_PROFILE_RATE; the collapsed-stack file is returned
+                in the result's "profile_path"
+            
+        Returns:
+            Final state with answer and metadata; "token_usage" has the run's
+            tokens, cost and individual model calls
+        """
+        db = ChatDatabase(self.db_name)
+        if chat_history is None:
+            chat_history = db.get_recent_turns(session_id, HISTORY_TURNS)
+        
+        if self.cassette is not None:
+            self.cassette.log(
+                "run", query=query, session_id=session_id, chat_history=list(chat_history),
+                pdf_name=pdf_name, deadline_ms=deadline_ms
+            )
+        
+        budget = self._budget_status(db, session_id)
+        
+        with self.profiler.profile("agent_run", force=profile) as run_profile:
+            final_state, trace = self._execute(query, chat_history, pdf_name, deadline_ms, budget)
+        final_state["profile_path"] = run_profile.path if run_profile else None
+        
+        # Save to database with PDF info and the run's token usage
+        history_row = self._history_row(session_id, query, final_state)
+        message_id = db.insert_message(**history_row)
+        db.insert_usage(self._usage_rows(history_row, message_id, final_state))
+        self.tracer.persist(trace, db, message_id, session_id, query)
 
-        print(f"{'='*60}\n")
+        logger.info(
+            "run_finished intent=%s total_ms=%s degradations=%s",
+            final_state["intent"], final_state["timings"].get("total"), final_state.get("degradations")
+        )
         
         return final_state
+    
+    def run_batch(self, queries: List, session_id: str = "batch", max_concurrency: int = 4,
+                  pdf_name: str = None) -> List[dict]:
+        """
+        Run many queries through the pipeline concurrently
+        
+        All runs share this pipeline's clients and caches. Query embeddings
+        for the loaded PDF are computed in one grouped call up front, and
+        every history row is written in a single transaction at the end.
+        Model calls run at background priority so interactive chat in the
+        same process is admitted first. Session budgets are checked once,
+        before the batch starts.
+        
+        Args:
+            queries: List of query strings, or dicts with "query" and optional
+                "session_id" / "chat_history" / "pdf_name" keys
+            session_id: Session identifier for items that don't set their own
+            max_concurrency: Maximum number of graph runs in flight at once
+            pdf_name: PDF for items that don't set their own
+            
+        Returns:
+            Final states, in the same order as the input queries
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        
+        items = []
+        for item in queries:
+            if isinstance(item, str):
+                item = {"query": item}
+            items.append({
+                "query": item["query"],
+                "session_id": item.get("session_id", session_id),
+                "chat_history": item.get("chat_history") or [],
+                "pdf_name": item.get("pdf_name", pdf_name)
+            })
+        
+        if not items:
+            return []
+        
+        # One embedding request for the whole batch instead of one per query
+        document_queries = [item["query"] for item in items if item["pdf_name"]]
+        if document_queries:
+            try:
+                self.rag_tool.embed_queries(document_queries)
+            except Exception as e:
+                logger.warning("batch_embedding_failed error=%s", e)
+        
+        db = ChatDatabase(self.db_name)
+        budgets = {
+            item["session_id"]: self._budget_status(db, item["session_id"])
+            for item in items
+        }
+        
+        def execute(item):
+            with scheduler.priority(scheduler.BACKGROUND):
+                return self._execute(
+                    item["query"], item["chat_history"], item["pdf_name"],
+                    budget=budgets[item["session_id"]]
+                )
+        
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            outcomes = list(executor.map(execute, items))
+        
+        history_rows = [
+            self._history_row(item["session_id"], item["query"], final_state)
+            for item, (final_state, _) in zip(items, outcomes)
+        ]
+        message_ids = db.insert_messages(history_rows)
+        db.insert_usage([
+            call
+            for history_row, message_id, (final_state, _) in zip(history_rows, message_ids, outcomes)
+            for call in self._usage_rows(history_row, message_id, final_state)
+        ])
+        
+        for item, (_, trace), message_id in zip(items, outcomes, message_ids):
+            self.tracer.persist(trace, db, message_id, item["session_id"], item["query"])
+        
+        return [final_state for final_state, _ in outcomes]
 
 
 # Test the agent
@@ -1,10 +1,23 @@
 import streamlit as st
 import os
+import logging
 from datetime import datetime
 from agent import AgentPipeline
 from database import ChatDatabase
 import uuid
 
+# Pipeline logs are level-gated; set LOG_LEVEL=DEBUG to see per-node details
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s"
+)
+
+# Sessions listed in the sidebar, and turns shown when a previous session is opened
+SIDEBAR_SESSIONS = 10
+SESSION_DISPLAY_TURNS = 50
+# Past messages listed for a history search
+SEARCH_RESULTS = 10
+
 # Page config
 st.set_page_config(
     page_title="AI Chat Assistant",
@@ -12,9 +25,15 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def get_agent() -> AgentPipeline:
+    """One pipeline per process, shared by every browser session"""
+    return AgentPipeline()
+
+agent = get_agent()
+
 # Initialize session state
-if 'agent' not in st.session_state:
-    st.session_state.agent = AgentPipeline()
+if 'db' not in st.session_state:
     st.session_state.db = ChatDatabase()
 
 if 'current_session_id' not in st.session_state:
@@ -33,7 +52,7 @@ if 'pdf_load_warning' not in st.session_state:
 def load_pdf_into_rag(pdf_path: str, pdf_name: str):
     """Load PDF and update tracking"""
     try:
-        success = st.session_state.agent.rag_tool.load_pdf(pdf_path)
+        success = agent.rag_tool.load_pdf(pdf_path)
         if success:
             st.session_state.loaded_pdf_name = pdf_name
             st.session_state.pdf_load_warning = None
@@ -43,6 +62,32 @@ def load_pdf_into_rag(pdf_path: str, pdf_name: str):
         st.error(f"Error loading PDF: {str(e)}")
         return False
 
+def open_session(session_id: str):
+    """Switch the chat to a previous session and its PDF"""
+    # Get session PDF
+    session_pdf = st.session_state.db.get_session_pdf(session_id)
+    
+    if session_pdf:
+        # Check that PDF's collection still exists
+        if agent.rag_tool.has_pdf(session_pdf):
+            st.session_state.loaded_pdf_name = session_pdf
+            st.session_state.pdf_load_warning = None
+        else:
+            # Collection doesn't exist
+            st.session_state.pdf_load_warning = (
+                f"⚠️ This session used **{session_pdf}** but that PDF's data "
+                f"is not in the database. Please re-upload **{session_pdf}** to continue."
+            )
+            st.session_state.loaded_pdf_name = None
+    else:
+        st.session_state.pdf_load_warning = None
+    
+    # Load session
+    st.session_state.current_session_id = session_id
+    history = st.session_state.db.get_session_history(session_id, limit=SESSION_DISPLAY_TURNS)
+    st.session_state.messages = history
+    st.rerun()
+
 # Sidebar
 with st.sidebar:
     st.title("🤖 AI Chat Assistant")
@@ -56,8 +101,6 @@ with st.sidebar:
         st.success(f"✅ Current: {st.session_state.loaded_pdf_name}")
         if st.button("Clear PDF", use_container_width=True):
             st.session_state.loaded_pdf_name = None
-            st.session_state.agent.rag_tool.vectorstore = None
-            st.session_state.agent.rag_tool.current_pdf_name = None
             st.rerun()
     
     uploaded_file = st.file_uploader("Upload a PDF for Q&A", type=['pdf'], key="pdf_uploader")
@@ -92,10 +135,10 @@ with st.sidebar:
     
     # Previous Sessions
     st.subheader("📋 Previous Sessions")
-    sessions = st.session_state.db.get_all_sessions()
+    sessions = st.session_state.db.get_all_sessions(limit=SIDEBAR_SESSIONS)
     
     if sessions:
-        for session in sessions[:10]:
+        for session in sessions:
             session_id = session['session_id']
             message_count = session['message_count']
             last_message = session['last_message']
@@ -112,32 +155,22 @@ with st.sidebar:
             button_label = f"{session_id[:12]}...\n{pdf_indicator}\n({message_count} msgs) {timestamp}"
             
             if st.button(button_label, key=session_id, use_container_width=True):
-                # Get session PDF
-                session_pdf = st.session_state.db.get_session_pdf(session_id)
-                
-                if session_pdf:
-                    # Try to switch to that PDF's collection
-                    if st.session_state.agent.rag_tool.switch_to_pdf(session_pdf):
-                        st.session_state.loaded_pdf_name = session_pdf
-                        st.session_state.pdf_load_warning = None
-                    else:
-                        # Collection doesn't exist
-                        st.session_state.pdf_load_warning = (
-                            f"⚠️ This session used **{session_pdf}** but that PDF's data "
-                            f"is not in the database. Please re-upload **{session_pdf}** to continue."
-                        )
-                        st.session_state.loaded_pdf_name = None
-                else:
-                    st.session_state.pdf_load_warning = None
-                
-                # Load session
-                st.session_state.current_session_id = session_id
-                history = st.session_state.db.get_session_history(session_id)
-                st.session_state.messages = history
-                st.rerun()
+                open_session(session_id)
     else:
         st.info("No previous sessions")
     
+    # Search across every session's questions and answers
+    search_query = st.text_input("🔎 Search history", placeholder="e.g. rain in London")
+    if search_query:
+        results = st.session_state.db.search(search_query, limit=SEARCH_RESULTS)
+        if not results:
+            st.caption("No matching messages")
+        for result in results:
+            snippet = result['answer_snippet'] if '**' in result['answer_snippet'] else result['query_snippet']
+            button_label = f"{snippet}\n({result['session_id'][:12]}...)"
+            if st.button(button_label, key=f"search_{result['message_id']}", use_container_width=True):
+                open_session(result['session_id'])
+    
     st.markdown("---")
     
     # Current Session Info
@@ -147,6 +180,8 @@ with st.sidebar:
     session_pdf = st.session_state.db.get_session_pdf(st.session_state.current_session_id)
     if session_pdf:
         st.text(f"PDF: {session_pdf[:20]}...")
+    session_usage = st.session_state.db.get_usage(session_id=st.session_state.current_session_id)
+    st.text(f"Tokens: {session_usage['total_tokens']:,} (${session_usage['cost_usd']:.4f})")
 
 # Main Chat Interface
 st.title("💬 AI Chat Assistant")
@@ -193,14 +228,11 @@ if user_query:
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
             try:
-                # Set current PDF name
-                if st.session_state.loaded_pdf_name:
-                    st.session_state.agent.rag_tool.current_pdf_name = st.session_state.loaded_pdf_name
-                
-                result = st.session_state.agent.run(
+                # The agent reads the session's recent turns from the database
+                result = agent.run(
                     query=user_query,
                     session_id=st.session_state.current_session_id,
-                    chat_history=st.session_state.messages[:-1]
+                    pdf_name=st.session_state.loaded_pdf_name
                 )
                 
                 answer = result.get('final_answer', 'No response generated.')
@@ -209,6 +241,8 @@ if user_query:
                 # Display intent
                 if intent == "weather":
                     st.markdown("🌤️ **Intent:** Weather Query")
+                    if result.get('response_path'):
+                        st.caption(f"Answer path: {result['response_path']}")
                 elif intent == "document":
                     st.markdown("📄 **Intent:** Document Query")
                     if st.session_state.loaded_pdf_name:
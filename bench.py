@@ -0,0 +1,78 @@
+"""
+Offline performance benchmark for the agent pipeline
+
+Swaps OpenAI, OpenWeatherMap and the Qdrant server for local fakes with
+a simulated latency, runs the ingestion, document-query and weather-query
+scenarios, and saves the results as JSON.
+
+Usage:
+    python bench.py --latency-ms 50 --queries 100 --concurrency 8
+    python bench.py --output bench_results/new.json --compare bench_results/baseline.json
+    python bench.py --replay cassettes/workload.gz --latency-scale 0
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks import pipeline
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline against local fake backends")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="simulated latency per external call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform +/- jitter around the latency")
+    parser.add_argument("--queries", type=int, default=50, help="questions per query scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--documents", type=int, default=3, help="PDFs to ingest")
+    parser.add_argument("--pages", type=int, default=5, help="pages per generated PDF")
+    parser.add_argument("--output", help="results file (default: bench_results/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline results file to check for p95 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative p95 increase")
+    parser.add_argument("--replay", help="replay a recorded cassette instead of the synthetic scenarios")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiplier for replayed latencies (0 replays instantly)")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        results = pipeline.replay(args.replay, latency_scale=args.latency_scale)
+        print(f"Replayed {args.replay} ({results['config']['steps']} steps), latency scale {args.latency_scale:g}")
+    else:
+        results = pipeline.run(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            queries=args.queries,
+            concurrency=args.concurrency,
+            documents=args.documents,
+            pages=args.pages
+        )
+        print(f"Simulated latency {args.latency_ms:.0f} ms, concurrency {args.concurrency}")
+    for name, summary in results["scenarios"].items():
+        throughput = next(value for key, value in summary.items() if key.endswith("_per_second"))
+        print(f"  {name:<26} n={summary['count']:<5} p50={summary['p50_ms']:9.1f} ms  "
+              f"p95={summary['p95_ms']:9.1f} ms  p99={summary['p99_ms']:9.1f} ms  {throughput:8.2f}/s")
+
+    output = args.output or os.path.join("bench_results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = pipeline.compare(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of per-call chain overhead
+
+Compares the old pattern (build the prompt and `prompt | llm | parser`
+chain inside every node call) with chains compiled once at pipeline
+construction, and a fresh ChatOpenAI per component with the shared
+client factory. A zero-latency fake chat model isolates our own overhead
+from network time.
+
+Usage:
+    python -m benchmarks.chain_overhead [iterations]
+"""
+
+import os
+import sys
+import time
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+import agent
+import clients
+
+
+def _time_per_call(fn, iterations: int) -> float:
+    """
+    Measure the mean duration of a call
+
+    Args:
+        fn: Zero-argument callable
+        iterations: Number of timed calls
+
+    Returns:
+        Mean microseconds per call
+    """
+    for _ in range(min(50, iterations)):
+        fn()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int = 2000) -> dict:
+    """
+    Run the benchmark
+
+    Args:
+        iterations: Number of timed calls per case
+
+    Returns:
+        Mean microseconds per call for each case
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    llm = FakeListChatModel(responses=["weather"])
+    template = agent.INTENT_PROMPT.messages[0].prompt.template
+    precompiled = agent.INTENT_PROMPT | llm | StrOutputParser()
+
+    def rebuild_per_call():
+        chain = ChatPromptTemplate.from_template(template) | llm | StrOutputParser()
+        return chain.invoke({"query": "What's the weather in Paris?"})
+
+    def precompiled_call():
+        return precompiled.invoke({"query": "What's the weather in Paris?"})
+
+    def new_client():
+        return clients.ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
+
+    def shared_client():
+        return clients.get_chat_model(temperature=0.3)
+
+    client_iterations = max(1, iterations // 20)
+    return {
+        "chain_rebuilt_per_call_us": _time_per_call(rebuild_per_call, iterations),
+        "chain_precompiled_us": _time_per_call(precompiled_call, iterations),
+        "client_constructed_us": _time_per_call(new_client, client_iterations),
+        "client_from_factory_us": _time_per_call(shared_client, client_iterations)
+    }
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    results = run(iterations)
+
+    print(f"Per-call overhead ({iterations} iterations, zero-latency fake model)")
+    for name, value in results.items():
+        print(f"  {name:<28} {value:10.1f} µs")
+
+    saved = results["chain_rebuilt_per_call_us"] - results["chain_precompiled_us"]
+    print(f"\nPrecompiled chains save {saved:.1f} µs per LLM call "
+          f"({saved / results['chain_rebuilt_per_call_us'] * 100:.0f}%)")
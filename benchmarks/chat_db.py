@@ -0,0 +1,119 @@
+"""
+Concurrent chat history writes and reads against ChatDatabase
+
+Many threads each insert messages into their own session and read the
+session's history back after every insert, like concurrent Streamlit
+sessions. Compares a new connection per call in rollback-journal mode (the
+old ChatDatabase behaviour) with persistent per-thread connections in WAL mode.
+
+Usage:
+    python -m benchmarks.chat_db [threads] [operations per thread]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from database import ChatDatabase, close_connections
+
+
+class _PerCallDatabase(ChatDatabase):
+    """ChatDatabase opening a default connection for every call, in rollback-journal mode"""
+
+    def __init__(self, db_name: str):
+        ChatDatabase(db_name).close()
+        self.db_name = db_name
+        conn = sqlite3.connect(db_name)
+        conn.execute("PRAGMA journal_mode=DELETE").fetchone()
+        conn.close()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_name)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+def _percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def _run_case(db: ChatDatabase, threads: int, operations: int) -> dict:
+    """
+    Time threads inserting and reading history at the same time
+
+    Returns:
+        Operations per second, p50/p99 milliseconds per operation and
+        operations that failed (e.g. "database is locked")
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(threads)
+
+    def worker(index: int):
+        session_id = f"session-{index}"
+        own = []
+        failed = 0
+        start_line.wait()
+        for i in range(operations):
+            start = time.perf_counter()
+            try:
+                db.insert_message(session_id, f"Question {i}", f"Answer {i}", "weather")
+                db.get_session_history(session_id)
+            except sqlite3.OperationalError:
+                failed += 1
+            own.append((time.perf_counter() - start) * 1000)
+        close_connections()
+        with lock:
+            latencies.extend(own)
+            errors.append(failed)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "ops_per_sec": threads * operations / elapsed,
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99),
+        "errors": sum(errors)
+    }
+
+
+def run(threads: int = 8, operations: int = 200) -> dict:
+    """
+    Run the benchmark, each case on a fresh database file
+
+    Args:
+        threads: Concurrent writer/reader threads
+        operations: Insert-then-read operations per thread
+
+    Returns:
+        Results per case
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, factory in (("per_call_connection", _PerCallDatabase), ("persistent_wal", ChatDatabase)):
+            db = factory(os.path.join(directory, f"{name}.db"))
+            results[name] = _run_case(db, threads, operations)
+            db.close()
+    return results
+
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    results = run(threads, operations)
+
+    print(f"Chat history ({threads} threads x {operations} insert + read operations)")
+    for name, result in results.items():
+        print(f"  {name:<20} {result['ops_per_sec']:8.0f} ops/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p99 {result['p99_ms']:7.2f} ms  {result['errors']:4d} errors")
@@ -0,0 +1,272 @@
+"""
+Deterministic local stand-ins for the pipeline's external services
+
+Every fake sleeps for a configurable latency so benchmarks can model
+network time while measuring our own code paths offline.
+"""
+
+import hashlib
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from qdrant_client import QdrantClient
+
+from scheduler import estimate_tokens
+
+
+WEATHER_WORDS = ("weather", "temperature", "rain", "umbrella", "forecast", "hot", "cold", "wind", "humid", "sunny")
+
+
+class Latency:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, seed: int = 42):
+        """
+        Simulated service latency
+
+        Args:
+            latency_ms: Mean latency per call
+            jitter_ms: Uniform +/- jitter around the mean
+            seed: Seed for reproducible jitter
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._random = random.Random(seed)
+
+    def sleep(self, timeout: Optional[float] = None):
+        """
+        Block for one call's worth of latency
+
+        Args:
+            timeout: Seconds the caller is willing to wait
+
+        Raises:
+            TimeoutError: If the simulated call takes longer than the timeout
+        """
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        if timeout is not None and delay / 1000 > timeout:
+            time.sleep(max(0.0, timeout))
+            raise TimeoutError(f"Simulated call timed out after {timeout:.3f}s")
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers the pipeline's prompts deterministically"""
+
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    calls: int = 0
+    _latency: Optional[Latency] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _respond(self, prompt: str) -> str:
+        """Pick a plausible answer based on which pipeline prompt this is"""
+        query = prompt.rsplit("Query:", 1)[-1]
+
+        if "intent classifier" in prompt:
+            words = set(re.findall(r"[a-z]+", query.lower()))
+            return "weather" if words & set(WEATHER_WORDS) else "document"
+
+        if "Extract ONLY the city" in prompt:
+            name = r"[A-Z][a-zA-Z]+(?:\s[A-Z][a-zA-Z]+)*"
+            match = re.search(rf"\b(?:in|for|at)\s+({name}(?:(?:,\s*|,?\s+and\s+){name})*)", query)
+            if not match:
+                return "London"
+            return "; ".join(re.split(r",?\s+and\s+|,\s*", match.group(1)))
+
+        if "weather assistant" in prompt:
+            return "It's currently pleasant there. " + prompt.split("Weather Data:", 1)[-1][:120].strip()
+
+        context = prompt.split("Context:", 1)[-1][:200].strip()
+        return f"Based on the document: {context}"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        if self._latency is None:
+            self._latency = Latency(self.latency_ms, self.jitter_ms)
+        self._latency.sleep(kwargs.get("timeout"))
+        self.calls += 1
+
+        prompt = "\n".join(str(message.content) for message in messages)
+        answer = self._respond(prompt)
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(answer)
+        }
+        message = AIMessage(
+            content=answer,
+            usage_metadata={
+                "input_tokens": usage["prompt_tokens"],
+                "output_tokens": usage["completion_tokens"],
+                "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]
+            }
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"token_usage": usage})
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, size: int = 1536, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        """
+        Hash-based embeddings: identical texts always get identical vectors
+
+        Args:
+            size: Vector dimension (matches the pipeline's Qdrant collections)
+            latency_ms: Simulated latency per request
+            jitter_ms: Uniform +/- jitter around the latency
+        """
+        self.size = size
+        self.latency = Latency(latency_ms, jitter_ms)
+        self.calls = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch with one simulated request"""
+        self.latency.sleep()
+        self.calls += 1
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query with one simulated request"""
+        self.latency.sleep()
+        self.calls += 1
+        return self._vector(text)
+
+
+class FakeWeatherTool:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        """
+        WeatherTool stand-in returning stable made-up conditions per city
+
+        Args:
+            latency_ms: Simulated API latency
+            jitter_ms: Uniform +/- jitter around the latency
+        """
+        self.latency = Latency(latency_ms, jitter_ms)
+        self.calls = 0
+
+    def prefetch(self, cities: List[str], timeout: float = 10) -> int:
+        """Fetch nothing ahead; every city is simulated by get_weather"""
+        return 0
+
+    def get_weather(self, city: str, timeout: float = 10) -> Dict:
+        """
+        Get fake current weather for a city
+
+        Args:
+            city: Name of the city
+            timeout: Seconds to wait for the simulated API
+
+        Returns:
+            Dictionary shaped like WeatherTool.get_weather's result
+        """
+        self.latency.sleep(timeout)
+        self.calls += 1
+        rng = random.Random(city.lower())
+        return {
+            "city": city,
+            "country": "XX",
+            "temperature": round(rng.uniform(-5, 35), 1),
+            "feels_like": round(rng.uniform(-8, 38), 1),
+            "humidity": rng.randint(20, 95),
+            "description": rng.choice(["clear sky", "few clouds", "light rain", "overcast clouds", "mist"]),
+            "wind_speed": round(rng.uniform(0, 12), 1)
+        }
+
+
+class FakeRanker:
+    def __init__(self, latency_ms: float = 0.0):
+        """
+        Flashrank stand-in scoring passages by word overlap with the query
+
+        Args:
+            latency_ms: Simulated model inference time
+        """
+        self.latency = Latency(latency_ms)
+
+    def rerank(self, request) -> List[Dict]:
+        """Score and sort passages like flashrank.Ranker.rerank"""
+        self.latency.sleep()
+        query_words = set(request.query.lower().split())
+        results = []
+        for passage in request.passages:
+            words = set(passage["text"].lower().split())
+            score = len(query_words & words) / (len(query_words) or 1)
+            results.append({**passage, "score": score})
+        return sorted(results, key=lambda result: result["score"], reverse=True)
+
+
+def in_memory_qdrant() -> QdrantClient:
+    """Create a Qdrant client backed by local in-memory storage"""
+    return QdrantClient(location=":memory:")
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_sample_pdf(path: str, pages: int = 5, lines_per_page: int = 40, seed: int = 7):
+    """
+    Write a small text-only PDF for ingestion benchmarks
+
+    Args:
+        path: Output file path
+        pages: Number of pages
+        lines_per_page: Lines of generated prose per page
+        seed: Seed for the generated text
+    """
+    rng = random.Random(seed)
+    vocabulary = (
+        "transformer attention layer model training data retrieval vector index query "
+        "document embedding latency throughput cache database session weather city "
+        "answer context chunk rerank score pipeline graph node token budget"
+    ).split()
+
+    objects = []
+    page_ids = []
+    font_id = 3
+    next_id = 4
+    for _ in range(pages):
+        lines = [" ".join(rng.choice(vocabulary) for _ in range(12)).capitalize() + "." for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 50 780 Td 14 TL " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        objects.append((content_id, f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"))
+        objects.append((page_id, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                                 f"/Contents {content_id} 0 R /Resources << /Font << /F1 {font_id} 0 R >> >> >>"))
+        page_ids.append(page_id)
+
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects = [
+        (1, "<< /Type /Catalog /Pages 2 0 R >>"),
+        (2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>"),
+        (font_id, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    ] + objects
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id, body in objects:
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n{body}\nendobj\n".encode("latin-1")
+
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for object_id in range(1, len(objects) + 1):
+        output += f"{offsets[object_id]:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+
+    with open(path, "wb") as f:
+        f.write(output)
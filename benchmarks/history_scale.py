@@ -0,0 +1,172 @@
+"""
+Chat history query latency at a million messages
+
+Fills a database with the original chat_history schema (no indexes, no
+sessions table) and times the history queries as they were written before,
+then opens it with ChatDatabase, which adds the indexes and the sessions
+summary table, and times the same lookups again, along with the paginated
+variants the app uses (the sidebar's first page of sessions and the turns
+sent to the model).
+
+Usage:
+    python -m benchmarks.history_scale [rows] [sessions]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database import ChatDatabase
+
+LEGACY_SCHEMA = '''
+    CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        user_query TEXT NOT NULL,
+        ai_response TEXT NOT NULL,
+        intent TEXT,
+        pdf_name TEXT,
+        created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    )
+'''
+
+LEGACY_QUERIES = {
+    "get_all_sessions": ('''
+        SELECT
+            session_id,
+            COUNT(*) as message_count,
+            MAX(created_at) as last_message,
+            (SELECT pdf_name FROM chat_history ch2
+             WHERE ch2.session_id = chat_history.session_id
+             AND ch2.pdf_name IS NOT NULL
+             ORDER BY ch2.created_at DESC LIMIT 1) as pdf_name
+        FROM chat_history
+        GROUP BY session_id
+        ORDER BY last_message DESC
+    ''', False),
+    "get_session_history": ('''
+        SELECT user_query, ai_response
+        FROM chat_history
+        WHERE session_id = ?
+        ORDER BY created_at
+    ''', True),
+    "get_session_pdf": ('''
+        SELECT pdf_name
+        FROM chat_history
+        WHERE session_id = ? AND pdf_name IS NOT NULL
+        ORDER BY created_at DESC
+        LIMIT 1
+    ''', True),
+}
+
+
+def _fill(path: str, rows: int, sessions: int):
+    """Write rows messages spread round-robin over sessions, one second apart"""
+    start = datetime(2024, 1, 1)
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_SCHEMA)
+    with conn:
+        conn.executemany(
+            'INSERT INTO chat_history (session_id, user_query, ai_response, intent, pdf_name, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                (
+                    f"session-{i % sessions}", f"Question {i}", f"Answer {i}", "document",
+                    f"doc-{i % 7}.pdf" if i % 3 == 0 else None,
+                    (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S.000")
+                )
+                for i in range(rows)
+            )
+        )
+    conn.close()
+
+
+def _time(fn, repeat: int) -> float:
+    """Mean milliseconds of fn over repeat calls"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _legacy(path: str, session_id: str, repeat: int, time_limit: float) -> dict:
+    """
+    Time the original queries, giving up on a query after time_limit seconds
+
+    Returns:
+        Milliseconds per query, or None for queries that hit the limit
+    """
+    conn = sqlite3.connect(path)
+    results = {}
+    for name, (sql, by_session) in LEGACY_QUERIES.items():
+        params = (session_id,) if by_session else ()
+        give_up_at = time.monotonic() + time_limit
+        conn.set_progress_handler(lambda: time.monotonic() > give_up_at, 10000)
+        try:
+            results[name] = _time(lambda: conn.execute(sql, params).fetchall(), repeat if by_session else 1)
+        except sqlite3.OperationalError:
+            results[name] = None
+        conn.set_progress_handler(None, 0)
+    conn.close()
+    return results
+
+
+def run(rows: int = 1_000_000, sessions: int = 10_000, repeat: int = 20, time_limit: float = 30.0) -> dict:
+    """
+    Run the benchmark
+
+    Args:
+        rows: Messages in the database
+        sessions: Sessions they are spread over
+        repeat: Calls averaged per lookup
+        time_limit: Seconds after which an unindexed query is abandoned
+
+    Returns:
+        Per-query milliseconds before and after, and the migration time
+    """
+    session_id = f"session-{sessions // 2}"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.db")
+        _fill(path, rows, sessions)
+        before = _legacy(path, session_id, repeat, time_limit)
+
+        start = time.perf_counter()
+        db = ChatDatabase(path)
+        migration_s = time.perf_counter() - start
+        # A cursor near the end of the listing, as if paged that far
+        deep_session = db.get_all_sessions()[-20]["session_id"]
+
+        after = {
+            "get_all_sessions": _time(db.get_all_sessions, repeat),
+            "get_session_history": _time(lambda: db.get_session_history(session_id), repeat),
+            "get_session_pdf": _time(lambda: db.get_session_pdf(session_id), repeat),
+            "sessions_page": _time(lambda: db.get_all_sessions(limit=10), repeat),
+            "sessions_page_deep": _time(lambda: db.get_all_sessions(limit=10, before=deep_session), repeat),
+            "get_recent_turns": _time(lambda: db.get_recent_turns(session_id, 10), repeat),
+        }
+        start = time.perf_counter()
+        db.insert_message(session_id, "Question", "Answer", "document", "doc-1.pdf")
+        after["insert_message"] = (time.perf_counter() - start) * 1000
+        db.close()
+
+    return {"before_ms": before, "after_ms": after, "migration_s": migration_s}
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    results = run(rows, sessions)
+
+    print(f"Chat history queries ({rows} messages in {sessions} sessions)")
+    print(f"  {'query':<22} {'before':>12} {'after':>10}")
+    for name, after in results["after_ms"].items():
+        before = results["before_ms"].get(name, "")
+        if before is None:
+            before = "gave up"
+        elif before != "":
+            before = f"{before:.2f} ms"
+        print(f"  {name:<22} {before:>12} {after:>7.2f} ms")
+    print(f"\nAdding indexes and the sessions table took {results['migration_s']:.1f} s")
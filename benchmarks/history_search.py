@@ -0,0 +1,135 @@
+"""
+Searching chat history at a million messages: LIKE scan vs the FTS5 index
+
+Fills a database with synthetic questions and answers whose words follow a
+Zipf-like distribution, so some search words are rare and some appear in
+a large share of all messages. Times ChatDatabase.search against the
+LIKE query that was the only option before, for words that are ranked
+by bm25 and words too common to rank, for a two-word query and for a
+search limited to one session.
+
+Usage:
+    python -m benchmarks.history_search [rows] [sessions]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from database import ChatDatabase, _match_expression, _search_words
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_QUESTION = 10
+WORDS_PER_ANSWER = 40
+
+LIKE_QUERY = '''
+    SELECT id, session_id, created_at, user_query, ai_response
+    FROM chat_history
+    WHERE (user_query LIKE ? OR ai_response LIKE ?) {session}
+    ORDER BY created_at DESC
+    LIMIT ?
+'''
+
+
+def _words(rng: random.Random, count: int) -> str:
+    """count words drawn with probability falling off as 1/rank"""
+    # Inverse-transform sampling of a 1/rank distribution over the vocabulary
+    return " ".join(f"w{int(VOCABULARY_SIZE ** rng.random())}" for _ in range(count))
+
+
+def _fill(db: ChatDatabase, rows: int, sessions: int, seed: int = 7):
+    """Insert rows messages spread round-robin over sessions"""
+    rng = random.Random(seed)
+    batch = []
+    for i in range(rows):
+        batch.append({
+            "session_id": f"session-{i % sessions}",
+            "user_query": _words(rng, WORDS_PER_QUESTION),
+            "ai_response": _words(rng, WORDS_PER_ANSWER),
+            "intent": "document"
+        })
+        if len(batch) == 10000:
+            db.insert_messages(batch)
+            batch = []
+    db.insert_messages(batch)
+
+
+def _time(fn, repeat: int) -> float:
+    """Mean milliseconds of fn over repeat calls"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _like(db: ChatDatabase, word: str, limit: int = 20, session_id: str = None):
+    """The search a LIKE scan gives: newest messages containing word"""
+    pattern = f"%{word}%"
+    params = [pattern, pattern]
+    session = ""
+    if session_id is not None:
+        session = "AND session_id = ?"
+        params.append(session_id)
+    return db._connection().execute(LIKE_QUERY.format(session=session), params + [limit]).fetchall()
+
+
+def run(rows: int = 1_000_000, sessions: int = 10_000, repeat: int = 20) -> dict:
+    """
+    Run the benchmark
+
+    Args:
+        rows: Messages in the database
+        sessions: Sessions they are spread over
+        repeat: Calls averaged per query
+
+    Returns:
+        Per-query milliseconds for LIKE and FTS5, matching message counts,
+        and the time the fill took including indexing
+    """
+    session_id = f"session-{sessions // 2}"
+    cases = {
+        "rare word": ("w15000", None),
+        "uncommon word": ("w1500", None),
+        "common word": ("w3", None),
+        "two words": ("w3 w150", None),
+        "one session": ("w3", session_id),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        db = ChatDatabase(os.path.join(directory, "search.db"))
+        start = time.perf_counter()
+        _fill(db, rows, sessions)
+        fill_s = time.perf_counter() - start
+
+        results = {}
+        for name, (query, session) in cases.items():
+            matches = db._connection().execute(
+                "SELECT COUNT(*) FROM chat_history_fts WHERE chat_history_fts MATCH ?",
+                (_match_expression(_search_words(query), session),)
+            ).fetchone()[0]
+            like_ms = None
+            if " " not in query:
+                like_ms = _time(lambda: _like(db, query, session_id=session), max(1, repeat // 10))
+            results[name] = {
+                "query": query,
+                "matches": matches,
+                "like_ms": like_ms,
+                "fts_ms": _time(lambda: db.search(query, limit=20, session_id=session), repeat)
+            }
+        db.close()
+
+    return {"cases": results, "fill_s": fill_s}
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    results = run(rows, sessions)
+
+    print(f"Chat history search ({rows} messages in {sessions} sessions)")
+    print(f"  {'case':<14} {'query':<10} {'matches':>9} {'LIKE':>11} {'FTS5':>10}")
+    for name, case in results["cases"].items():
+        like = f"{case['like_ms']:.1f} ms" if case["like_ms"] is not None else "-"
+        print(f"  {name:<14} {case['query']:<10} {case['matches']:>9} {like:>11} {case['fts_ms']:>7.2f} ms")
+    print(f"\nInserting the messages, with the full-text index kept by triggers, took {results['fill_s']:.1f} s")
@@ -0,0 +1,109 @@
+"""
+Weather API latency during an outage and with a slow tail, against a local stub server
+
+The outage case points WeatherTool at a server that stops answering within
+the call timeout, with and without the circuit breaker. The tail case makes
+one request in twenty slow and compares p50/p99 with and without hedging.
+
+Usage:
+    python -m benchmarks.outage [calls]
+"""
+
+import sys
+import time
+
+from benchmarks.weather_http import StubWeatherServer
+from resilience import CircuitBreaker, Hedger
+from weather import WeatherTool
+
+
+def _percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def _outage(calls: int, timeout: float, failure_threshold: int) -> dict:
+    """
+    Time calls to a server that doesn't answer within the timeout
+
+    Returns:
+        Mean milliseconds per call and requests that reached the server
+    """
+    with StubWeatherServer() as server:
+        server.delay_next(timeout * 2000, times=calls)
+        breaker = CircuitBreaker("weather", failure_threshold=failure_threshold, recovery_timeout=60)
+        tool = WeatherTool(fresh_ttl=0, max_retries=0, base_url=server.url, breaker=breaker)
+        start = time.perf_counter()
+        for i in range(calls):
+            try:
+                tool.get_weather(f"city-{i}", timeout=timeout)
+            except Exception:
+                pass
+        elapsed = time.perf_counter() - start
+        tool.close()
+        return {"per_call_ms": elapsed / calls * 1000, "requests": server.requests}
+
+
+def _tail(calls: int, latency_ms: float, slow_ms: float, percentile) -> dict:
+    """
+    Time calls when every twentieth request is slow
+
+    Returns:
+        p50 and p99 milliseconds, and requests that reached the server
+    """
+    with StubWeatherServer() as server:
+        # Hedges take requests from the script too, so script enough for both
+        for i in range(calls * 2):
+            server.delay_next(slow_ms if i % 20 == 19 else latency_ms)
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, hedger=Hedger("weather", percentile=percentile))
+        latencies = []
+        for i in range(calls):
+            start = time.perf_counter()
+            tool.get_weather(f"city-{i}")
+            latencies.append((time.perf_counter() - start) * 1000)
+        tool.close()
+        # Skip the warm-up calls made before hedging starts
+        latencies = latencies[tool.hedger.min_samples:]
+        return {
+            "p50_ms": _percentile(latencies, 50),
+            "p99_ms": _percentile(latencies, 99),
+            "requests": server.requests
+        }
+
+
+def run(calls: int = 200, timeout: float = 0.2, latency_ms: float = 5.0, slow_ms: float = 200.0) -> dict:
+    """
+    Run the benchmark
+
+    Args:
+        calls: Number of calls per tail case (the outage cases make a fifth as many)
+        timeout: Call timeout in seconds during the outage
+        latency_ms: Normal response time in the tail cases
+        slow_ms: Response time of the slow requests
+
+    Returns:
+        Results per case
+    """
+    outage_calls = max(calls // 5, 10)
+    return {
+        "outage_no_breaker": _outage(outage_calls, timeout, failure_threshold=0),
+        "outage_breaker": _outage(outage_calls, timeout, failure_threshold=5),
+        "tail_no_hedging": _tail(calls, latency_ms, slow_ms, percentile=None),
+        "tail_hedged_p90": _tail(calls, latency_ms, slow_ms, percentile=90)
+    }
+
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    results = run(calls)
+
+    print("Weather API outage (server stops answering, 200 ms timeout)")
+    for name in ("outage_no_breaker", "outage_breaker"):
+        result = results[name]
+        print(f"  {name:<20} {result['per_call_ms']:8.2f} ms/call  {result['requests']:5d} requests sent")
+
+    print("\nSlow tail (1 in 20 requests takes 200 ms instead of 5 ms)")
+    for name in ("tail_no_hedging", "tail_hedged_p90"):
+        result = results[name]
+        print(f"  {name:<20} p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+              f"{result['requests']:5d} requests sent")
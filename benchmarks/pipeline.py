@@ -0,0 +1,345 @@
+"""
+End-to-end pipeline benchmark against local fake backends
+
+Runs AgentPipeline with FakeChatModel, FakeEmbeddings, FakeWeatherTool,
+a word-overlap reranker and in-memory Qdrant, so the numbers reflect our
+own code plus a configurable simulated network latency. Scenarios:
+
+- ingestion: load_pdf on freshly generated PDFs
+- document_queries: concurrent agent.run calls answered from a PDF
+- weather_queries: concurrent agent.run calls for city weather
+- multi_city_weather_queries: the same, comparing three cities per question
+
+replay() instead runs a workload recorded with a cassette (see cassette.py)
+against its recorded responses, with the recorded latencies or none.
+
+Use `python bench.py` to run it and save the results as JSON.
+"""
+
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import metrics
+import scheduler
+from metrics import Histogram
+from benchmarks.fakes import (
+    FakeChatModel,
+    FakeEmbeddings,
+    FakeRanker,
+    FakeWeatherTool,
+    in_memory_qdrant,
+    write_sample_pdf
+)
+
+DOCUMENT_TOPICS = ["attention", "training data", "retrieval", "vector index", "embedding",
+                   "throughput", "chunking", "rerank scores", "token budget", "graph nodes"]
+CITIES = ["Paris", "London", "Tokyo", "New York", "Sydney", "Cairo", "Lima", "Oslo"]
+
+
+def _unthrottle_schedulers():
+    """Lift the rate-limit budgets so admission control doesn't dominate"""
+    for prefix in ("CHAT", "EMBEDDING"):
+        os.environ[f"{prefix}_RPM"] = "1000000000"
+        os.environ[f"{prefix}_TPM"] = "1000000000"
+    with scheduler._schedulers_lock:
+        scheduler._schedulers.clear()
+
+
+def build_pipeline(latency_ms: float, jitter_ms: float, db_name: str):
+    """
+    Build an AgentPipeline wired to fake backends
+
+    Args:
+        latency_ms: Simulated latency of every external call
+        jitter_ms: Uniform +/- jitter around the latency
+        db_name: SQLite file for chat history
+
+    Returns:
+        AgentPipeline instance
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    _unthrottle_schedulers()
+
+    from agent import AgentPipeline
+    from rag import RAGTool
+    from tracing import Tracer
+
+    llm = FakeChatModel(latency_ms=latency_ms, jitter_ms=jitter_ms)
+    rag_tool = RAGTool(
+        llm=llm,
+        embeddings=FakeEmbeddings(latency_ms=latency_ms, jitter_ms=jitter_ms),
+        client=in_memory_qdrant()
+    )
+    rag_tool._ranker = FakeRanker()
+
+    return AgentPipeline(
+        tracer=Tracer(enabled=False),
+        llm=llm,
+        weather_tool=FakeWeatherTool(latency_ms=latency_ms, jitter_ms=jitter_ms),
+        rag_tool=rag_tool,
+        db_name=db_name
+    )
+
+
+def summarize(latencies_ms: List[float], wall_seconds: float, unit: str = "requests") -> Dict:
+    """
+    Summarize a scenario's per-call latencies
+
+    Args:
+        latencies_ms: Latency of each call
+        wall_seconds: Wall-clock duration of the whole scenario
+        unit: What one call is, used to name the throughput field
+
+    Returns:
+        Dict with count, mean/p50/p95/p99/max latency and throughput
+    """
+    histogram = Histogram()
+    for latency in latencies_ms:
+        histogram.observe(latency)
+
+    count = len(latencies_ms)
+    return {
+        "count": count,
+        "mean_ms": round(histogram.total / count, 3) if count else 0.0,
+        "p50_ms": round(histogram.percentile(50), 3),
+        "p95_ms": round(histogram.percentile(95), 3),
+        "p99_ms": round(histogram.percentile(99), 3),
+        "max_ms": round(histogram.max, 3),
+        f"{unit}_per_second": round(count / wall_seconds, 3) if wall_seconds else 0.0
+    }
+
+
+def _run_concurrently(call: Callable[[int], None], count: int, concurrency: int) -> Dict:
+    """
+    Invoke call(i) for i in range(count) across a thread pool
+
+    Args:
+        call: Function taking the call index
+        count: Number of calls
+        concurrency: Worker threads
+
+    Returns:
+        Latency and throughput summary
+    """
+    def timed(index: int) -> float:
+        start = time.perf_counter()
+        call(index)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(count)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_ingestion(pipeline, workdir: str, documents: int, pages: int) -> Dict:
+    """
+    Benchmark PDF ingestion (parse, split, embed, upsert)
+
+    Args:
+        pipeline: Pipeline from build_pipeline
+        workdir: Directory for the generated PDFs
+        documents: Number of PDFs to ingest
+        pages: Pages per PDF
+
+    Returns:
+        Latency and throughput summary per document
+    """
+    paths = []
+    for index in range(documents):
+        path = os.path.join(workdir, f"bench_{index}.pdf")
+        write_sample_pdf(path, pages=pages, seed=index)
+        paths.append(path)
+
+    latencies = []
+    start = time.perf_counter()
+    for path in paths:
+        call_start = time.perf_counter()
+        if not pipeline.rag_tool.load_pdf(path):
+            raise RuntimeError(f"Ingestion failed for {path}")
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    result = summarize(latencies, time.perf_counter() - start, unit="documents")
+    result["pages_per_document"] = pages
+    return result
+
+
+def bench_document_queries(pipeline, pdf_name: str, queries: int, concurrency: int) -> Dict:
+    """
+    Benchmark document questions through the full graph
+
+    Args:
+        pipeline: Pipeline with pdf_name already ingested
+        pdf_name: PDF to query
+        queries: Number of questions
+        concurrency: Concurrent sessions
+
+    Returns:
+        Latency and throughput summary
+    """
+    def ask(index: int):
+        topic = DOCUMENT_TOPICS[index % len(DOCUMENT_TOPICS)]
+        # Distinct wording per call so the query-embedding cache doesn't hide the embed step
+        pipeline.run(f"What does the paper say about {topic} (question {index})?",
+                     session_id=f"bench-doc-{index % concurrency}", pdf_name=pdf_name)
+
+    return _run_concurrently(ask, queries, concurrency)
+
+
+def bench_weather_queries(pipeline, queries: int, concurrency: int) -> Dict:
+    """
+    Benchmark weather questions through the full graph
+
+    Args:
+        pipeline: Pipeline from build_pipeline
+        queries: Number of questions
+        concurrency: Concurrent sessions
+
+    Returns:
+        Latency and throughput summary
+    """
+    def ask(index: int):
+        city = CITIES[index % len(CITIES)]
+        pipeline.run(f"What's the weather in {city} right now (question {index})?",
+                     session_id=f"bench-weather-{index % concurrency}")
+
+    return _run_concurrently(ask, queries, concurrency)
+
+
+def bench_multi_city_weather_queries(pipeline, queries: int, concurrency: int) -> Dict:
+    """
+    Benchmark weather questions naming three cities through the full graph
+
+    The cities' weather is fetched concurrently, so latency should stay
+    close to the single-city scenario.
+
+    Args:
+        pipeline: Pipeline from build_pipeline
+        queries: Number of questions
+        concurrency: Concurrent sessions
+
+    Returns:
+        Latency and throughput summary
+    """
+    def ask(index: int):
+        first, second, third = (CITIES[(index + offset) % len(CITIES)] for offset in range(3))
+        pipeline.run(f"Compare the weather in {first}, {second} and {third} (question {index})",
+                     session_id=f"bench-multi-weather-{index % concurrency}")
+
+    return _run_concurrently(ask, queries, concurrency)
+
+
+def run(latency_ms: float = 50.0, jitter_ms: float = 0.0, queries: int = 50, concurrency: int = 4,
+        documents: int = 3, pages: int = 5) -> Dict:
+    """
+    Run every scenario and collect the results
+
+    Args:
+        latency_ms: Simulated latency of every external call
+        jitter_ms: Uniform +/- jitter around the latency
+        queries: Questions per query scenario
+        concurrency: Concurrent sessions for query scenarios
+        documents: PDFs to ingest
+        pages: Pages per PDF
+
+    Returns:
+        Dict with the run configuration, per-scenario summaries and per-step timings
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        pipeline = build_pipeline(latency_ms, jitter_ms, os.path.join(workdir, "bench.db"))
+        scenarios = {}
+        steps = {}
+
+        for name, scenario in (
+            ("ingestion", lambda: bench_ingestion(pipeline, workdir, documents, pages)),
+            ("document_queries", lambda: bench_document_queries(pipeline, "bench_0.pdf", queries, concurrency)),
+            ("weather_queries", lambda: bench_weather_queries(pipeline, queries, concurrency)),
+            ("multi_city_weather_queries", lambda: bench_multi_city_weather_queries(pipeline, queries, concurrency))
+        ):
+            metrics.registry.reset()
+            scenarios[name] = scenario()
+            steps[name] = metrics.registry.snapshot()["latency_ms"]
+
+    return {
+        "config": {
+            "latency_ms": latency_ms,
+            "jitter_ms": jitter_ms,
+            "queries": queries,
+            "concurrency": concurrency,
+            "documents": documents,
+            "pages": pages
+        },
+        "scenarios": scenarios,
+        "steps": steps
+    }
+
+
+def replay(cassette_path: str, latency_scale: float = 1.0) -> Dict:
+    """
+    Replay a recorded workload offline
+
+    Args:
+        cassette_path: Cassette recorded with AGENT_CASSETTE_MODE=record
+        latency_scale: Multiplier for the recorded latencies (0 for none)
+
+    Returns:
+        Dict in the same shape as run(), with "replay_load_pdf" and
+        "replay_run" scenarios
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    _unthrottle_schedulers()
+
+    from agent import AgentPipeline
+    from cassette import REPLAY, Cassette
+    from tracing import Tracer
+    from usage import SessionBudget
+
+    cassette = Cassette(cassette_path, mode=REPLAY, latency_scale=latency_scale)
+    with tempfile.TemporaryDirectory() as workdir:
+        pipeline = AgentPipeline(
+            tracer=Tracer(enabled=False),
+            db_name=os.path.join(workdir, "replay.db"),
+            budget=SessionBudget(),
+            cassette=cassette
+        )
+        metrics.registry.reset()
+        steps = cassette.replay(pipeline)
+
+    scenarios = {}
+    for kind, unit in (("load_pdf", "documents"), ("run", "queries")):
+        durations = [step["duration_ms"] for step in steps if step["kind"] == kind]
+        if durations:
+            scenarios[f"replay_{kind}"] = summarize(durations, sum(durations) / 1000, unit=unit)
+
+    return {
+        "config": {"cassette": cassette_path, "latency_scale": latency_scale, "steps": len(steps)},
+        "scenarios": scenarios,
+        "steps": {"replay": metrics.registry.snapshot()["latency_ms"]}
+    }
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float = 0.1) -> List[str]:
+    """
+    Find scenarios that got slower than a saved baseline
+
+    Args:
+        current: Results from run()
+        baseline: Earlier results from run()
+        tolerance: Allowed relative increase in p95 latency
+
+    Returns:
+        Human-readable regression descriptions (empty if none)
+    """
+    regressions = []
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before or not before.get("p95_ms"):
+            continue
+        change = (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"]
+        if change > tolerance:
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']:.1f} ms -> {result['p95_ms']:.1f} ms (+{change * 100:.0f}%)"
+            )
+    return regressions
@@ -0,0 +1,121 @@
+"""
+Archiving old sessions: space reclaimed and the cost of reading them back
+
+Fills a database with sessions whose messages span a year, archives those
+idle for longer than the retention period, vacuums, and reports the file
+size at each step. Then times get_session_history for a live session and
+for an archived one of the same length.
+
+Usage:
+    python -m benchmarks.retention [sessions] [turns per session] [retention days]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.history_search import _words
+from database import ChatDatabase
+
+
+def _fill(db: ChatDatabase, sessions: int, turns: int, seed: int = 7):
+    """Write sessions whose last message falls evenly over the past year"""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    conn = db.get_connection()
+    with conn:
+        for index in range(sessions):
+            start = now - timedelta(days=365 * index / sessions)
+            conn.executemany(
+                'INSERT INTO chat_history (session_id, user_query, ai_response, intent, pdf_name, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        f"session-{index}", _words(rng, 12), _words(rng, 120), "document", "paper.pdf",
+                        (start - timedelta(minutes=turns - turn)).strftime("%Y-%m-%d %H:%M:%S.000")
+                    )
+                    for turn in range(turns)
+                ]
+            )
+    conn.close()
+
+
+def _size(path: str) -> int:
+    """Bytes of the database file and its WAL"""
+    return sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+
+
+def _time(fn, repeat: int) -> float:
+    """Mean milliseconds of fn over repeat calls"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run(sessions: int = 5000, turns: int = 20, days: float = 90, repeat: int = 200) -> dict:
+    """
+    Run the benchmark
+
+    Args:
+        sessions: Sessions in the database
+        turns: Turns per session
+        days: Retention period
+        repeat: Calls averaged per history read
+
+    Returns:
+        File sizes, the archive and vacuum reports with their durations,
+        and history read milliseconds for a live and an archived session
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "retention.db")
+        db = ChatDatabase(path)
+        _fill(db, sessions, turns)
+        db.vacuum()
+        size_before = _size(path)
+
+        start = time.perf_counter()
+        archive = db.archive_sessions(days)
+        archive_s = time.perf_counter() - start
+        size_archived = _size(path)
+
+        start = time.perf_counter()
+        vacuum = db.vacuum()
+        vacuum_s = time.perf_counter() - start
+        size_after = _size(path)
+
+        live_ms = _time(lambda: db.get_session_history("session-0"), repeat)
+        archived_ms = _time(lambda: db.get_session_history(f"session-{sessions - 1}"), repeat)
+        db.close()
+
+    return {
+        "size_before": size_before,
+        "size_archived": size_archived,
+        "size_after": size_after,
+        "archive": archive,
+        "archive_s": archive_s,
+        "vacuum": vacuum,
+        "vacuum_s": vacuum_s,
+        "live_ms": live_ms,
+        "archived_ms": archived_ms
+    }
+
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    days = float(sys.argv[3]) if len(sys.argv) > 3 else 90
+    results = run(sessions, turns, days)
+    archive = results["archive"]
+    mb = 1024 * 1024
+
+    print(f"Retention ({sessions} sessions x {turns} turns over a year, archiving after {days:g} days)")
+    print(f"  archived {archive['sessions']} sessions, {archive['messages']} messages in {results['archive_s']:.1f} s: "
+          f"{archive['raw_bytes'] / mb:.1f} MB of history stored as {archive['archived_bytes'] / mb:.1f} MB")
+    print(f"  file {results['size_before'] / mb:.1f} MB -> {results['size_archived'] / mb:.1f} MB after archiving "
+          f"({archive['freed_bytes'] / mb:.1f} MB freed inside) -> {results['size_after'] / mb:.1f} MB after vacuum "
+          f"({results['vacuum']['reclaimed_bytes'] / mb:.1f} MB reclaimed in {results['vacuum_s']:.2f} s)")
+    print(f"  get_session_history: live {results['live_ms']:.3f} ms, archived {results['archived_ms']:.3f} ms")
@@ -0,0 +1,270 @@
+"""
+Per-call latency of the weather API client against a local stub server
+
+Compares a new connection per call (module-level `requests.get`, the old
+WeatherTool behaviour) with the pooled keep-alive session and the pooled
+async client. The stub server counts the TCP connections it accepts, so
+connection reuse shows up directly next to the latency numbers. The
+stub adds a fixed per-connection handshake delay to stand in for the
+TLS handshake a real HTTPS endpoint costs.
+
+Usage:
+    python -m benchmarks.weather_http [calls]
+"""
+
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from gazetteer import Gazetteer
+from weather import WeatherTool
+
+
+def weather_payload(city: str) -> dict:
+    """OpenWeatherMap-shaped response for a city"""
+    return {
+        "name": city.title(),
+        "sys": {"country": "XX"},
+        "main": {"temp": 20.0, "feels_like": 19.0, "humidity": 60},
+        "weather": [{"description": "clear sky"}],
+        "wind": {"speed": 3.5}
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this Nagle's
+        # algorithm holds the body back on keep-alive connections
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.stub.connection_opened()
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        status, headers, latency = stub.next_response()
+        if latency:
+            time.sleep(latency)
+        if url.path.endswith("/group"):
+            # Several cities by id; ids the stub doesn't know are left out
+            ids = [int(city_id) for city_id in query.get("id", [""])[0].split(",") if city_id]
+            payload = {"list": [
+                {"id": city_id, **weather_payload(stub.city_names[city_id])}
+                for city_id in ids if city_id in stub.city_names
+            ]}
+            payload["cnt"] = len(payload["list"])
+        else:
+            city = query.get("q", [""])[0]
+            if "id" in query:
+                city = stub.city_names.get(int(query["id"][0]), "")
+            if status == 200 and city.lower() in stub.unknown_cities:
+                status = 404
+            payload = weather_payload(city)
+
+        body = json.dumps(payload if status == 200 else {"message": "error"}).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client timed out and hung up before the response was ready
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubWeatherServer:
+    def __init__(self, latency_ms: float = 0.0, handshake_ms: float = 0.0, unknown_cities: List[str] = ()):
+        """
+        Local HTTP/1.1 keep-alive server that answers like OpenWeatherMap
+
+        Args:
+            latency_ms: Delay before every response
+            handshake_ms: Delay for every new connection
+            unknown_cities: Cities answered with 404
+        """
+        self.latency = latency_ms / 1000
+        self.handshake = handshake_ms / 1000
+        self.unknown_cities = {city.lower() for city in unknown_cities}
+        gazetteer = Gazetteer.from_env()
+        self.city_names = {city.id: city.name for city in gazetteer.cities.values()} if gazetteer else {}
+        self.connections = 0
+        self.requests = 0
+        self._script = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Weather endpoint URL"""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/data/2.5/weather"
+
+    def fail_next(self, status: int, retry_after: str = None, times: int = 1):
+        """
+        Answer the next requests with an error status
+
+        Args:
+            status: HTTP status, e.g. 429 or 503
+            retry_after: Retry-After header value to send, if any
+            times: Number of requests to fail
+        """
+        headers = {"Retry-After": retry_after} if retry_after is not None else {}
+        with self._lock:
+            self._script.extend([(status, headers, self.latency)] * times)
+
+    def delay_next(self, latency_ms: float, times: int = 1):
+        """
+        Answer the next requests successfully, but slowly
+
+        Args:
+            latency_ms: Delay before each of those responses
+            times: Number of slow requests
+        """
+        with self._lock:
+            self._script.extend([(200, {}, latency_ms / 1000)] * times)
+
+    def next_response(self) -> tuple:
+        """Status, extra headers and delay for the next request"""
+        with self._lock:
+            self.requests += 1
+            return self._script.pop(0) if self._script else (200, {}, self.latency)
+
+    def connection_opened(self):
+        """Count a new connection and simulate its handshake"""
+        with self._lock:
+            self.connections += 1
+        if self.handshake:
+            time.sleep(self.handshake)
+
+    def reset_counts(self):
+        """Zero the connection and request counters"""
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+
+    def __enter__(self) -> "StubWeatherServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, name="stub-weather", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _new_connection(tool: WeatherTool, city: str) -> dict:
+    """Fetch with module-level requests.get, opening a connection per call"""
+    response = requests.get(tool.base_url, params=tool._params(city), timeout=10)
+    response.raise_for_status()
+    return tool._parse(response.json())
+
+
+def _pooled_session(tool: WeatherTool, city: str) -> dict:
+    """Fetch on the tool's pooled session"""
+    return tool.get_weather(city)
+
+
+def _sequential(fetch, calls: int, handshake_ms: float) -> dict:
+    """
+    Time sequential calls against a fresh stub server
+
+    Args:
+        fetch: Called with a WeatherTool and a city
+        calls: Number of calls
+        handshake_ms: Simulated connection setup cost
+
+    Returns:
+        Mean milliseconds per call and connections opened
+    """
+    with StubWeatherServer(handshake_ms=handshake_ms) as server:
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url)
+        start = time.perf_counter()
+        for i in range(calls):
+            fetch(tool, f"city-{i}")
+        elapsed = time.perf_counter() - start
+        tool.close()
+        return {"per_call_ms": elapsed / calls * 1000, "connections": server.connections}
+
+
+def _concurrent(calls: int, handshake_ms: float, concurrency: int) -> dict:
+    """
+    Time concurrent aget_weather calls against a fresh stub server
+
+    Returns:
+        Wall-clock milliseconds per call and connections opened
+    """
+    with StubWeatherServer(handshake_ms=handshake_ms) as server:
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, pool_size=concurrency)
+
+        async def fetch_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def fetch(city):
+                async with semaphore:
+                    return await tool.aget_weather(city)
+
+            await asyncio.gather(*(fetch(f"city-{i}") for i in range(calls)))
+            await tool.aclose()
+
+        start = time.perf_counter()
+        asyncio.run(fetch_all())
+        elapsed = time.perf_counter() - start
+        return {"per_call_ms": elapsed / calls * 1000, "connections": server.connections}
+
+
+def run(calls: int = 200, handshake_ms: float = 2.0, concurrency: int = 10) -> dict:
+    """
+    Run the benchmark
+
+    Every call uses a different city and the response cache is off, so
+    each call reaches the server. Each case gets its own server, so idle
+    connections left by one case don't slow down the next.
+
+    Args:
+        calls: Number of calls per case
+        handshake_ms: Simulated connection setup cost
+        concurrency: Concurrent calls in the async case
+
+    Returns:
+        Mean milliseconds per call and connections opened for each case
+    """
+    return {
+        "new_connection_per_call": _sequential(_new_connection, calls, handshake_ms),
+        "pooled_session": _sequential(_pooled_session, calls, handshake_ms),
+        "async_pooled_concurrent": _concurrent(calls, handshake_ms, concurrency)
+    }
+
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    results = run(calls)
+
+    print(f"Weather API client ({calls} calls, local stub with 2 ms connection setup)")
+    for name, result in results.items():
+        print(f"  {name:<26} {result['per_call_ms']:8.2f} ms/call  {result['connections']:5d} connections")
+
+    saved = results["new_connection_per_call"]["per_call_ms"] - results["pooled_session"]["per_call_ms"]
+    print(f"\nConnection reuse saves {saved:.2f} ms per call "
+          f"({saved / results['new_connection_per_call']['per_call_ms'] * 100:.0f}%)")
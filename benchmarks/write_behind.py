@@ -0,0 +1,121 @@
+"""
+Request-path cost of persisting chat history, synchronous vs write-behind
+
+Many threads each write what the end of AgentPipeline.run writes: a
+chat_history row and the run's token usage. With synchronous writes every
+request commits twice on its own thread; in write-behind mode the writes
+are queued and a background thread commits them in groups.
+
+Usage:
+    python -m benchmarks.write_behind [threads] [requests per thread]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import database
+import metrics
+from benchmarks.chat_db import _percentile
+from database import ChatDatabase, close_connections, close_writers
+
+USAGE_CALLS = 3
+
+
+def _persist(db: ChatDatabase, session_id: str, i: int):
+    """Write one request's history row and token usage, as AgentPipeline.run does"""
+    message_id = db.insert_message(session_id, f"Question {i}", f"Answer {i}", "document", "paper.pdf")
+    db.insert_usage([
+        {
+            "message_id": message_id, "session_id": session_id, "pdf_name": "paper.pdf",
+            "step": f"llm.step_{call}", "model": "gpt-4o-mini",
+            "prompt_tokens": 500, "completion_tokens": 50, "cost_usd": 0.0001
+        }
+        for call in range(USAGE_CALLS)
+    ])
+
+
+def _run_case(db_name: str, write_behind: bool, threads: int, requests: int) -> dict:
+    """
+    Time threads persisting requests at the same time
+
+    Returns:
+        Requests and commits per second, and p50/p99 milliseconds spent
+        writing per request
+    """
+    db = ChatDatabase(db_name, write_behind=write_behind)
+    metrics.registry.reset()
+    latencies = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(threads)
+
+    def worker(index: int):
+        own = []
+        start_line.wait()
+        for i in range(requests):
+            start = time.perf_counter()
+            _persist(db, f"session-{index}", i)
+            own.append((time.perf_counter() - start) * 1000)
+        close_connections()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    # Queued writes only count once they are committed
+    close_writers()
+    elapsed = time.perf_counter() - start
+
+    if write_behind:
+        commits = sum(
+            counter["value"] for counter in metrics.registry.snapshot()["counters"]
+            if counter["name"] == "chat_db_group_commits_total"
+        )
+    else:
+        commits = threads * requests * 2
+    stored = db.get_usage()["calls"]
+    db.close()
+
+    return {
+        "requests_per_sec": threads * requests / elapsed,
+        "commits_per_sec": commits / elapsed,
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99),
+        "lost": threads * requests * USAGE_CALLS - stored
+    }
+
+
+def run(threads: int = 8, requests: int = 250) -> dict:
+    """
+    Run the benchmark, each case on a fresh database file
+
+    Args:
+        threads: Concurrent request threads
+        requests: Requests persisted per thread
+
+    Returns:
+        Results per case
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, write_behind in (("synchronous", False), ("write_behind", True)):
+            results[name] = _run_case(os.path.join(directory, f"{name}.db"), write_behind, threads, requests)
+    return results
+
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    results = run(threads, requests)
+
+    print(f"Persisting requests ({threads} threads x {requests} requests, "
+          f"batch {database.WRITE_BEHIND_BATCH}, interval {database.WRITE_BEHIND_INTERVAL_MS:g} ms)")
+    for name, result in results.items():
+        print(f"  {name:<12} {result['requests_per_sec']:8.0f} req/s  {result['commits_per_sec']:7.0f} commits/s  "
+              f"p50 {result['p50_ms']:6.3f} ms  p99 {result['p99_ms']:6.3f} ms  {result['lost']} lost")
@@ -0,0 +1,367 @@
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from deadline import DeadlineExceeded
+from resilience import CircuitOpenError
+from scheduler import AdmissionError
+from weather import UnknownCityError, WeatherAPIError
+
+logger = logging.getLogger(__name__)
+
+
+RECORD = "record"
+REPLAY = "replay"
+
+# Qdrant client calls that change the collection; their arguments carry
+# random point ids, so they are matched by collection only
+_QDRANT_WRITES = {
+    "create_collection", "recreate_collection", "delete_collection",
+    "upsert", "upload_points", "delete", "set_payload", "overwrite_payload"
+}
+
+
+class CassetteMiss(Exception):
+    """Raised when a replayed call was never recorded"""
+
+
+class ReplayedError(Exception):
+    """A failure recorded from the real backend whose own type isn't replayable, raised again on replay"""
+
+
+# Failures replayed as their own type, by recorded type name. Cassette
+# files only ever select from these; a name found in a file is never
+# imported, so replaying one can't load arbitrary code
+_REPLAYABLE_ERRORS: Dict[str, Callable[[Dict], Exception]] = {
+    "weather:UnknownCityError": lambda entry: UnknownCityError(entry["error"]),
+    "weather:WeatherAPIError": lambda entry: WeatherAPIError(entry["error"], entry.get("status_code")),
+    "resilience:CircuitOpenError": lambda entry: CircuitOpenError(entry["error"]),
+    "deadline:DeadlineExceeded": lambda entry: DeadlineExceeded(entry["error"]),
+    "scheduler:AdmissionError": lambda entry: AdmissionError(entry["error"]),
+    "cassette:CassetteMiss": lambda entry: CassetteMiss(entry["error"]),
+}
+
+
+def _error_type(error: BaseException) -> str:
+    """Qualified name of an exception's type, e.g. weather:UnknownCityError"""
+    return f"{type(error).__module__}:{type(error).__qualname__}"
+
+
+def _replayed_error(entry: Dict) -> Exception:
+    """
+    Rebuild a recorded failure
+
+    Args:
+        entry: Recorded interaction with an error message and, in cassettes
+            recorded since it was added, the error's type
+
+    Returns:
+        The recorded type with the recorded message if it is replayable,
+        else ReplayedError
+    """
+    build = _REPLAYABLE_ERRORS.get(entry.get("error_type"))
+    if build is None:
+        return ReplayedError(entry["error"])
+    return build(entry)
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str = RECORD, latency_scale: float = 1.0):
+        """
+        Recorder and player for every external call the pipeline makes
+
+        In record mode, chat model, embedding, weather and Qdrant calls go to
+        the real backends and their results, failures and latencies are kept,
+        along with the load_pdf / run calls that caused them. In replay mode
+        the same calls are served from the cassette with no network access,
+        so our own code can be benchmarked against a realistic workload.
+
+        Identical calls are matched in the order they were recorded, and the
+        last recording is reused once they run out.
+
+        Args:
+            path: Cassette file
+            mode: RECORD or REPLAY
+            latency_scale: Multiplier for replayed latencies (0 replays instantly)
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.serde = JsonPlusSerializer()
+        self.interactions: Dict[str, List[Dict]] = {}
+        self.workload: List[Dict] = []
+        self.meta: Dict[str, Any] = {}
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if mode == REPLAY:
+            self.load()
+
+    @classmethod
+    def from_env(cls) -> Optional["Cassette"]:
+        """
+        Create a cassette configured by AGENT_CASSETTE (file), AGENT_CASSETTE_MODE
+        (record or replay) and AGENT_CASSETTE_LATENCY_SCALE
+
+        Recording cassettes are saved when the process exits.
+
+        Returns:
+            Cassette, or None when AGENT_CASSETTE is unset
+        """
+        path = os.getenv("AGENT_CASSETTE")
+        if not path:
+            return None
+        cassette = cls(
+            path,
+            mode=os.getenv("AGENT_CASSETTE_MODE", RECORD).lower(),
+            latency_scale=float(os.getenv("AGENT_CASSETTE_LATENCY_SCALE", "1"))
+        )
+        if cassette.recording:
+            atexit.register(cassette.save)
+        return cassette
+
+    @property
+    def recording(self) -> bool:
+        """Whether calls go to the real backends"""
+        return self.mode == RECORD
+
+    @property
+    def replaying(self) -> bool:
+        """Whether calls are served from the cassette"""
+        return self.mode == REPLAY
+
+    def _key(self, kind: str, request) -> str:
+        """Stable key for a call; large requests (vectors, prompts) are hashed"""
+        data = json.dumps(request, sort_keys=True, default=repr)
+        return f"{kind}:{hashlib.sha256(data.encode()).hexdigest()[:32]}"
+
+    def interaction(self, kind: str, request, call: Callable[[], Any]):
+        """
+        Make an external call, or serve it from the cassette
+
+        Args:
+            kind: Call type, e.g. "chat" or "qdrant.query_points"
+            request: JSON-serializable description identifying the call
+            call: Performs the real call (only used when recording)
+
+        Returns:
+            The call's result
+        """
+        key = self._key(kind, request)
+
+        if self.replaying:
+            with self._lock:
+                recorded = self.interactions.get(key)
+                if not recorded:
+                    raise CassetteMiss(f"No recorded {kind} call matches this request")
+                position = self._positions.get(key, 0)
+                self._positions[key] = position + 1
+                entry = recorded[min(position, len(recorded) - 1)]
+            if self.latency_scale > 0:
+                time.sleep(entry["latency_ms"] * self.latency_scale / 1000)
+            if "error" in entry:
+                raise _replayed_error(entry)
+            return entry["value"]
+
+        start = time.perf_counter()
+        try:
+            value = call()
+            entry = {"value": value}
+        except Exception as e:
+            entry = {"error": str(e), "error_type": _error_type(e)}
+            if isinstance(getattr(e, "status_code", None), int):
+                entry["status_code"] = e.status_code
+            raise
+        finally:
+            entry["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            with self._lock:
+                self.interactions.setdefault(key, []).append(entry)
+        return value
+
+    def log(self, kind: str, **arguments):
+        """
+        Record a workload step (a run or load_pdf call) while recording
+
+        Args:
+            kind: "run" or "load_pdf"
+            **arguments: Keyword arguments of the call
+        """
+        if self.recording:
+            with self._lock:
+                self.workload.append({"kind": kind, "arguments": arguments})
+
+    def save(self):
+        """Write the cassette to its file"""
+        with self._lock:
+            data = {"meta": self.meta, "workload": self.workload, "interactions": self.interactions}
+            encoding, payload = self.serde.dumps_typed(data)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with gzip.open(self.path, "wb") as f:
+            f.write(encoding.encode() + b"\n" + payload)
+        logger.info("cassette_saved path=%s interactions=%d steps=%d",
+                    self.path, sum(len(entries) for entries in self.interactions.values()), len(self.workload))
+
+    def load(self):
+        """Read the cassette from its file"""
+        with gzip.open(self.path, "rb") as f:
+            encoding, payload = f.read().split(b"\n", 1)
+        data = self.serde.loads_typed((encoding.decode(), payload))
+        self.meta = data["meta"]
+        self.workload = data["workload"]
+        self.interactions = data["interactions"]
+        self._positions = {}
+
+    def replay(self, pipeline) -> List[Dict]:
+        """
+        Run the recorded workload through a pipeline built on this cassette
+
+        Args:
+            pipeline: AgentPipeline created with cassette=self
+
+        Returns:
+            One dict per step with its kind, duration_ms and result
+        """
+        steps = []
+        for step in self.workload:
+            arguments = dict(step["arguments"])
+            start = time.perf_counter()
+            if step["kind"] == "load_pdf":
+                result = pipeline.rag_tool.load_pdf(**arguments)
+            else:
+                result = pipeline.run(**arguments)
+            steps.append({
+                "kind": step["kind"],
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                "result": result
+            })
+        return steps
+
+    def chat_model(self, llm: Optional[BaseChatModel]) -> "CassetteChatModel":
+        """Wrap a chat model (None when replaying)"""
+        return CassetteChatModel(inner=llm, cassette=self)
+
+    def embeddings(self, embeddings: Optional[Embeddings]) -> "CassetteEmbeddings":
+        """Wrap an embeddings client (None when replaying)"""
+        return CassetteEmbeddings(embeddings, self)
+
+    def weather_tool(self, weather_tool) -> "CassetteWeatherTool":
+        """Wrap a weather tool (None when replaying)"""
+        return CassetteWeatherTool(weather_tool, self)
+
+    def qdrant_client(self, client) -> "CassetteQdrantClient":
+        """Wrap a Qdrant client (None when replaying)"""
+        return CassetteQdrantClient(client, self)
+
+
+class CassetteChatModel(BaseChatModel):
+    """Chat model that records or replays the calls of the model it wraps"""
+
+    inner: Optional[Any] = None
+    cassette: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        request = [[message.type, message.content] for message in messages] + [stop]
+        # The wrapped model runs without the caller's callbacks; its usage is
+        # reported once, below
+        message = self.cassette.interaction(
+            "chat", request, lambda: self.inner.invoke(messages, config={"callbacks": []}, stop=stop, **kwargs)
+        )
+
+        # Report the recorded usage so token accounting sees replayed calls
+        usage_metadata = message.usage_metadata or {}
+        llm_output = {"model_name": message.response_metadata.get("model_name")}
+        if usage_metadata:
+            llm_output["token_usage"] = {
+                "prompt_tokens": usage_metadata.get("input_tokens", 0),
+                "completion_tokens": usage_metadata.get("output_tokens", 0)
+            }
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output=llm_output)
+
+
+class CassetteEmbeddings(Embeddings):
+    def __init__(self, embeddings: Optional[Embeddings], cassette: Cassette):
+        """
+        Embeddings client that records or replays the client it wraps
+
+        Args:
+            embeddings: Real embeddings client (None when replaying)
+            cassette: Cassette to record to or replay from
+        """
+        self.embeddings = embeddings
+        self.cassette = cassette
+        if cassette.recording:
+            cassette.meta["embedding_model"] = getattr(embeddings, "model", None)
+        # Lets ScheduledEmbeddings price replayed calls
+        self.model = cassette.meta.get("embedding_model")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents"""
+        return self.cassette.interaction("embed_documents", texts, lambda: self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query"""
+        return self.cassette.interaction("embed_query", text, lambda: self.embeddings.embed_query(text))
+
+
+class CassetteWeatherTool:
+    def __init__(self, weather_tool, cassette: Cassette):
+        """
+        Weather tool that records or replays the tool it wraps
+
+        Args:
+            weather_tool: Real WeatherTool (None when replaying)
+            cassette: Cassette to record to or replay from
+        """
+        self.weather_tool = weather_tool
+        self.cassette = cassette
+
+    def prefetch(self, cities: List[str], timeout: float = 10) -> int:
+        """Fetch nothing ahead, so every city is recorded as its own call"""
+        return 0
+
+    def get_weather(self, city: str, timeout: float = 10):
+        """Get current weather for a city"""
+        return self.cassette.interaction(
+            "weather", city, lambda: self.weather_tool.get_weather(city, timeout=timeout)
+        )
+
+
+class CassetteQdrantClient:
+    def __init__(self, client, cassette: Cassette):
+        """
+        Qdrant client proxy that records or replays every method call
+
+        Args:
+            client: Real QdrantClient (None when replaying)
+            cassette: Cassette to record to or replay from
+        """
+        self._client = client
+        self._cassette = cassette
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            if name in _QDRANT_WRITES:
+                request = kwargs.get("collection_name", args[0] if args else None)
+            else:
+                request = [args, kwargs]
+            return self._cassette.interaction(
+                f"qdrant.{name}", request, lambda: getattr(self._client, name)(*args, **kwargs)
+            )
+
+        return call
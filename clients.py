@@ -0,0 +1,126 @@
+import os
+import threading
+from typing import Dict, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+load_dotenv()
+
+
+# Uniform settings for every model client
+MODEL_TIMEOUT = float(os.getenv("MODEL_TIMEOUT", "30"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3"))
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "20"))
+
+_lock = threading.Lock()
+_http_client = None
+_async_http_client = None
+_chat_models: Dict[Tuple[str, float], ChatOpenAI] = {}
+_embeddings: Dict[str, OpenAIEmbeddings] = {}
+
+
+def _limits() -> httpx.Limits:
+    """Connection pool limits shared by the sync and async HTTP clients"""
+    return httpx.Limits(
+        max_connections=MODEL_POOL_SIZE,
+        max_keepalive_connections=MODEL_POOL_SIZE,
+        keepalive_expiry=60
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Get the process-wide HTTP client used by all model clients
+
+    Returns:
+        httpx.Client with a keep-alive connection pool
+    """
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=_limits(), timeout=MODEL_TIMEOUT)
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide async HTTP client used by all model clients
+
+    Returns:
+        httpx.AsyncClient with a keep-alive connection pool
+    """
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(limits=_limits(), timeout=MODEL_TIMEOUT)
+        return _async_http_client
+
+
+def get_chat_model(temperature: float = 0.3, model: str = "gpt-4o-mini") -> ChatOpenAI:
+    """
+    Get a shared chat model client
+
+    All chat models share one HTTP connection pool and use the same timeout
+    and retry policy (exponential backoff with jitter, honoring Retry-After).
+
+    Args:
+        temperature: Sampling temperature
+        model: OpenAI model name
+
+    Returns:
+        ChatOpenAI instance, reused for identical settings
+    """
+    http_client = get_http_client()
+    http_async_client = get_async_http_client()
+
+    key = (model, temperature)
+    with _lock:
+        if key not in _chat_models:
+            _chat_models[key] = ChatOpenAI(
+                model=model,
+                temperature=temperature,
+                timeout=MODEL_TIMEOUT,
+                max_retries=MODEL_MAX_RETRIES,
+                http_client=http_client,
+                http_async_client=http_async_client
+            )
+        return _chat_models[key]
+
+
+def get_embeddings(model: str = "text-embedding-ada-002") -> OpenAIEmbeddings:
+    """
+    Get a shared embeddings client
+
+    Args:
+        model: OpenAI embedding model name
+
+    Returns:
+        OpenAIEmbeddings instance on the shared connection pool
+    """
+    http_client = get_http_client()
+    http_async_client = get_async_http_client()
+
+    with _lock:
+        if model not in _embeddings:
+            _embeddings[model] = OpenAIEmbeddings(
+                model=model,
+                timeout=MODEL_TIMEOUT,
+                max_retries=MODEL_MAX_RETRIES,
+                http_client=http_client,
+                http_async_client=http_async_client
+            )
+        return _embeddings[model]
+
+
+def reset_clients():
+    """Drop all shared clients so the next call rebuilds them"""
+    global _http_client, _async_http_client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = None
+        _async_http_client = None
+        _chat_models.clear()
+        _embeddings.clear()
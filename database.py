@@ -1,47 +1,455 @@
+import atexit
+import json
+import logging
+import os
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Dict
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Iterable, Iterator, Optional
+
+import metrics
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Seconds a statement waits for another connection's write lock before
+# failing with "database is locked"
+BUSY_TIMEOUT = float(os.getenv("CHAT_DB_BUSY_TIMEOUT", "10"))
+
+# Prepared statements kept per connection, keyed by their SQL text
+STATEMENT_CACHE_SIZE = 256
+
+# Write-behind mode: queued writes are committed together once
+# WRITE_BEHIND_BATCH of them are waiting, or WRITE_BEHIND_INTERVAL_MS after
+# the previous group commit
+WRITE_BEHIND_BATCH = int(os.getenv("CHAT_DB_WRITE_BEHIND_BATCH", "64"))
+WRITE_BEHIND_INTERVAL_MS = float(os.getenv("CHAT_DB_WRITE_BEHIND_INTERVAL_MS", "50"))
+
+# Words of context around the matched words in a search snippet
+SNIPPET_TOKENS = 16
+
+# bm25 counts every message containing each search word, so a search with
+# a word found in more messages than this lists its matches newest first
+# instead of ranking them
+SEARCH_RANK_MAX_MATCHES = int(os.getenv("CHAT_DB_SEARCH_RANK_MAX_MATCHES", "2000"))
+
+# Retention: sessions whose last message is older than RETENTION_DAYS are
+# moved to the compressed archive, ARCHIVE_BATCH sessions per transaction
+RETENTION_DAYS = float(os.getenv("CHAT_DB_RETENTION_DAYS", "90"))
+ARCHIVE_BATCH = 100
+
+# zlib level for archived sessions; 9 saves well under 1% over 6 on chat
+# text and takes half as long again
+ARCHIVE_ZLIB_LEVEL = 6
+
+# Persistent connections, per thread and database file
+_local = threading.local()
+
+# Write-behind queues, per database file
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _connect(db_name: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Open a connection with the pragmas every ChatDatabase connection uses
+    
+    Args:
+        db_name: SQLite file
+        check_same_thread: False for a connection its owner shares between
+            threads behind a lock
+        
+    Returns:
+        Connection returning sqlite3.Row rows
+    """
+    conn = sqlite3.connect(
+        db_name, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=check_same_thread
+    )
+    conn.row_factory = sqlite3.Row
+    # In WAL mode a commit only needs to reach the log, not be fsynced to
+    # the database file; a power loss can drop the last commits but never
+    # corrupts the database
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def close_connections():
+    """Close every persistent connection the calling thread holds"""
+    connections = getattr(_local, "connections", {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def close_writers():
+    """Commit everything still queued for write-behind and stop the writer threads"""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+# Queued writes must reach the database before the process exits
+atexit.register(close_writers)
+
+
+def _fts_string(text: str) -> str:
+    """Quote text as an FTS5 string, which matches it as a phrase"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _search_words(text: str) -> List[str]:
+    """Words of search box text, without punctuation"""
+    return re.findall(r"\w+", text)
+
+
+def _match_expression(words: List[str], session_id: str = None) -> str:
+    """
+    Build an FTS5 query matching messages that contain all of the words
+    
+    Each word is quoted, so FTS5 operators typed by the user ("NOT",
+    "NEAR") are searched for like any other word. Words are only looked up
+    in questions and answers.
+    
+    Args:
+        words: Words from _search_words
+        session_id: Only match this session's messages
+        
+    Returns:
+        FTS5 match expression
+    """
+    expression = f"{{user_query ai_response}} : ({' '.join(_fts_string(word) for word in words)})"
+    if session_id is not None:
+        # Indexed hex-encoded, as one token
+        expression = f"session_id : {_fts_string(session_id.encode().hex())} AND {expression}"
+    return expression
+
+
+def _now(days_ago: float = 0) -> str:
+    """
+    Current UTC time in the format of the tables' created_at defaults
+    
+    Args:
+        days_ago: Go back this many days from now
+    """
+    moment = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    return moment.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def _unpack_history(blob: bytes) -> List[Dict]:
+    """Rows of a session_archive history blob, as dicts keyed like chat_history's columns"""
+    columns = ("id", "user_query", "ai_response", "intent", "pdf_name", "created_at")
+    return [dict(zip(columns, row)) for row in json.loads(zlib.decompress(blob))]
+
+
+class WriteBehind:
+    def __init__(self, db_name: str, batch_size: int = None, interval_ms: float = None):
+        """
+        Writes to one database file, committed in groups by a background thread
+        
+        A group commit happens once batch_size writes are queued, interval_ms
+        after the previous one, or when flush() is called. Chat message ids
+        are handed out when a message is queued, so callers get them back
+        at once; this relies on no other process inserting into
+        chat_history while the queue is in use.
+        
+        Args:
+            db_name: SQLite file
+            batch_size: Queued writes that trigger a commit (defaults to WRITE_BEHIND_BATCH)
+            interval_ms: Longest a write waits in the queue while others arrive
+                (defaults to WRITE_BEHIND_INTERVAL_MS)
+        """
+        self.db_name = db_name
+        self.batch_size = batch_size or WRITE_BEHIND_BATCH
+        self.interval = (interval_ms or WRITE_BEHIND_INTERVAL_MS) / 1000
+        self._lock = threading.Lock()         # queue, pending counts and message ids
+        self._commit_lock = threading.Lock()  # one group commit at a time
+        self._queue = []
+        self._pending = Counter()
+        self._next_message_id = None
+        self._conn = None
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-db-write-behind", daemon=True)
+        self._thread.start()
+    
+    def submit(self, sql: str, rows: List[tuple], session_ids: Iterable[str] = ()):
+        """
+        Queue a statement to run once per row in the next group commit
+        
+        Args:
+            sql: Statement with placeholders
+            rows: Parameters, one tuple per execution
+            session_ids: Sessions whose reads must wait for this write
+        """
+        with self._lock:
+            self._enqueue(sql, rows, session_ids)
+        self._after_submit()
+    
+    def submit_messages(self, rows: List[tuple]) -> List[int]:
+        """
+        Queue chat_history rows, assigning their ids and timestamps now
+        
+        Args:
+            rows: (session_id, user_query, ai_response, intent, pdf_name) tuples
+        
+        Returns:
+            Ids the rows will have, in input order
+        """
+        created_at = _now()
+        with self._lock:
+            if self._next_message_id is None:
+                self._next_message_id = self._max_message_id() + 1
+            first_id = self._next_message_id
+            self._next_message_id += len(rows)
+            self._enqueue(
+                '''INSERT INTO chat_history
+                (id, session_id, user_query, ai_response, intent, pdf_name, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(first_id + i, *row, created_at) for i, row in enumerate(rows)],
+                [row[0] for row in rows]
+            )
+        self._after_submit()
+        return list(range(first_id, first_id + len(rows)))
+    
+    def pending(self, session_id: str = None) -> bool:
+        """
+        Whether writes are queued but not committed yet
+        
+        Args:
+            session_id: Only consider writes for this session
+        """
+        with self._lock:
+            if session_id is None:
+                return bool(self._pending)
+            return self._pending[session_id] > 0
+    
+    def flush(self):
+        """Commit every queued write; returns once they are visible to readers"""
+        with self._commit_lock:
+            with self._lock:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return
+            
+            try:
+                self._commit(batch)
+            finally:
+                with self._lock:
+                    for _, _, session_ids in batch:
+                        self._pending.subtract(session_ids)
+                    # Drop sessions with nothing left in the queue
+                    self._pending = +self._pending
+    
+    def close(self):
+        """Stop the writer thread after committing everything queued"""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        with self._commit_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def _enqueue(self, sql: str, rows: List[tuple], session_ids: Iterable[str]):
+        """Append a write; callers hold self._lock"""
+        # None stands for writes that belong to no session
+        session_ids = set(session_ids) or {None}
+        self._queue.append((sql, rows, session_ids))
+        self._pending.update(session_ids)
+    
+    def _after_submit(self):
+        """Wake the writer thread for a full batch, or commit right away once closed"""
+        if self._closed:
+            self.flush()
+        elif len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+    
+    def _max_message_id(self) -> int:
+        """Highest chat_history id ever handed out, including deleted rows"""
+        conn = _connect(self.db_name)
+        try:
+            row = conn.execute(
+                '''SELECT MAX(
+                    COALESCE((SELECT MAX(id) FROM chat_history), 0),
+                    COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'chat_history'), 0)
+                )'''
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0]
+    
+    def _connection(self) -> sqlite3.Connection:
+        """The writer's own connection, used by whichever thread holds the commit lock"""
+        if self._conn is None:
+            self._conn = _connect(self.db_name, check_same_thread=False)
+        return self._conn
+    
+    def _commit(self, batch: List[tuple]):
+        """Write a batch in one transaction, falling back to one transaction per write"""
+        conn = self._connection()
+        try:
+            with conn:
+                for sql, rows, _ in batch:
+                    conn.executemany(sql, rows)
+            metrics.registry.increment("chat_db_group_commits_total")
+            metrics.registry.increment("chat_db_queued_writes_total", len(batch))
+            return
+        except sqlite3.Error as e:
+            logger.warning("group_commit_failed db=%s writes=%d error=%s", self.db_name, len(batch), e)
+        
+        # Keep the writes that succeed on their own
+        for sql, rows, _ in batch:
+            try:
+                with conn:
+                    conn.executemany(sql, rows)
+            except sqlite3.Error as e:
+                metrics.registry.increment("chat_db_write_errors_total")
+                logger.error("queued_write_failed db=%s error=%s sql=%s", self.db_name, e, " ".join(sql.split()))
+    
+    def _run(self):
+        """Commit whatever is queued every interval, or as soon as a batch fills up"""
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write_behind_flush_failed db=%s", self.db_name)
 
 
 class ChatDatabase:
-    def __init__(self, db_name: str = "chat_history.db"):
-        """Initialize database connection"""
+    def __init__(self, db_name: str = "chat_history.db", write_behind: bool = None):
+        """
+        Chat history, traces and token usage stored in SQLite
+        
+        Handles are cheap: the schema is migrated the first time a file is
+        opened in the process, and every handle on the same file shares one
+        persistent connection per thread, so the statements it has
+        prepared are reused across calls and handles. The database runs in
+        WAL mode, so readers don't block the writer or each other, and a
+        writer waiting for another one retries for BUSY_TIMEOUT seconds
+        instead of failing at once.
+        
+        In write-behind mode, inserts are queued and committed in groups by
+        a background thread (see WriteBehind) instead of on the caller's
+        thread. A read first commits the queued writes of the session it
+        reads, so callers always see what they wrote. Once a file has a
+        write-behind queue in this process, every handle on it writes
+        through the queue, which keeps message ids unique.
+        
+        Args:
+            db_name: SQLite file
+            write_behind: Queue inserts for group commits (defaults to the
+                CHAT_DB_WRITE_BEHIND environment variable)
+        """
         self.db_name = db_name
-        self.create_table()
+        if write_behind is None:
+            write_behind = os.getenv("CHAT_DB_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+        self.write_behind = write_behind
+        self.migrate()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        """
+        Open a new connection for the caller to use and close
+        
+        The class's own methods use the thread's persistent connection
+        instead. Queued write-behind writes are committed first, so the new
+        connection sees them.
+        """
+        self._read_your_writes()
+        return _connect(self.db_name)
+    
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's persistent connection to the database, opened on first use"""
+        connections = getattr(_local, "connections", None)
+        if connections is None:
+            connections = _local.connections = {}
+        conn = connections.get(self.db_name)
+        if conn is None:
+            conn = connections[self.db_name] = _connect(self.db_name)
         return conn
     
-    def create_table(self):
-        """Create chat history table if it doesn't exist"""
-        conn = self.get_connection()
-        
-        # Check if pdf_name column exists, if not add it
-        cursor = conn.execute("PRAGMA table_info(chat_history)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'chat_history' not in [table[0] for table in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]:
-            # Create new table with pdf_name column
-            conn.execute('''
-                CREATE TABLE chat_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT NOT NULL,
-                    user_query TEXT NOT NULL,
-                    ai_response TEXT NOT NULL,
-                    intent TEXT,
-                    pdf_name TEXT,
-                    created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
-                )
-            ''')
-        elif 'pdf_name' not in columns:
-            # Add pdf_name column to existing table
-            conn.execute('ALTER TABLE chat_history ADD COLUMN pdf_name TEXT')
+    def _writer(self) -> Optional[WriteBehind]:
+        """The file's write-behind queue, started on first use in write-behind mode"""
+        writer = _writers.get(self.db_name)
+        if writer is None and self.write_behind:
+            with _writers_lock:
+                writer = _writers.get(self.db_name)
+                if writer is None:
+                    writer = _writers[self.db_name] = WriteBehind(self.db_name)
+        return writer
+    
+    def _read_your_writes(self, session_id: str = None):
+        """
+        Commit the queued writes a read is about to look at
         
-        conn.commit()
-        conn.close()
+        Args:
+            session_id: Session the read is limited to, None for any
+        """
+        writer = _writers.get(self.db_name)
+        if writer is not None and writer.pending(session_id):
+            writer.flush()
+
+    def _write(self, sql: str, rows: List[tuple], session_ids: Iterable[str] = ()):
+        """
+        Run an insert once per row, through the write-behind queue if there is one
+        
+        Args:
+            sql: Statement with placeholders
+            rows: Parameters, one tuple per execution
+            session_ids: Sessions the rows belong to
+        """
+        writer = self._writer()
+        if writer is not None:
+            writer.submit(sql, rows, session_ids)
+            return
+        
+        conn = self._connection()
+        with conn:
+            conn.executemany(sql, rows)
+    
+    def close(self):
+        """Commit queued writes and close this thread's persistent connection to the database"""
+        with _writers_lock:
+            writer = _writers.pop(self.db_name, None)
+        if writer is not None:
+            writer.close()
+        
+        connections = getattr(_local, "connections", {})
+        conn = connections.pop(self.db_name, None)
+        if conn is not None:
+            conn.close()
+    
+    def migrate(self) -> int:
+        """
+        Apply pending schema migrations (see migrations.py) to the file
+        
+        The file's schema version is read first, a single pragma, so
+        constructing handles on an up-to-date file doesn't write to it.
+        It is read every time rather than remembered per path, since the
+        file may have been deleted and recreated, or replaced by another
+        process, since this process last looked.
+        
+        Returns:
+            Number of migrations applied
+        """
+        conn = self._connection()
+        if migrations.schema_version(conn) >= migrations.SCHEMA_VERSION:
+            return 0
+        # Lets vacuum() return freed pages a few at a time. Like WAL it is
+        # a property of the file, but it only takes effect on a new one;
+        # vacuum() converts older files
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL is a property of the file; this only writes to it the first time
+        conn.execute("PRAGMA journal_mode=WAL").fetchone()
+        return migrations.migrate(conn)
     
     def insert_message(self, session_id: str, user_query: str, ai_response: str, intent: str = "", pdf_name: str = None):
         """
@@ -53,43 +461,229 @@ class ChatDatabase:
             ai_response: AI's answer
             intent: Classified intent (weather/document)
             pdf_name: Name of PDF used (if any)
+            
+        Returns:
+            Id of the inserted row
         """
-        conn = self.get_connection()
-        conn.execute(
-            '''INSERT INTO chat_history 
-            (session_id, user_query, ai_response, intent, pdf_name) 
-            VALUES (?, ?, ?, ?, ?)''',
-            (session_id, user_query, ai_response, intent, pdf_name)
-        )
-        conn.commit()
-        conn.close()
+        writer = self._writer()
+        if writer is not None:
+            return writer.submit_messages([(session_id, user_query, ai_response, intent, pdf_name)])[0]
+        
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                '''INSERT INTO chat_history 
+                (session_id, user_query, ai_response, intent, pdf_name) 
+                VALUES (?, ?, ?, ?, ?)''',
+                (session_id, user_query, ai_response, intent, pdf_name)
+            )
+        return cursor.lastrowid
+    
+    def insert_messages(self, messages: List[Dict]):
+        """
+        Insert several chat messages in a single transaction
+        
+        Args:
+            messages: List of dicts with the same keys as insert_message's arguments
+            
+        Returns:
+            Ids of the inserted rows, in input order
+        """
+        if not messages:
+            return []
+        
+        writer = self._writer()
+        if writer is not None:
+            return writer.submit_messages([
+                (
+                    message["session_id"],
+                    message["user_query"],
+                    message["ai_response"],
+                    message.get("intent", ""),
+                    message.get("pdf_name")
+                )
+                for message in messages
+            ])
+        
+        message_ids = []
+        conn = self._connection()
+        with conn:
+            for message in messages:
+                cursor = conn.execute(
+                    '''INSERT INTO chat_history 
+                    (session_id, user_query, ai_response, intent, pdf_name) 
+                    VALUES (?, ?, ?, ?, ?)''',
+                    (
+                        message["session_id"],
+                        message["user_query"],
+                        message["ai_response"],
+                        message.get("intent", ""),
+                        message.get("pdf_name")
+                    )
+                )
+                message_ids.append(cursor.lastrowid)
+        return message_ids
+    
+    def get_session_history(self, session_id: str, limit: Optional[int] = None,
+                            before: Optional[int] = None) -> List[Dict]:
+        """
+        Get the messages of a session, oldest first
+        
+        With limit, only the latest turns (a question and its answer) are
+        read, walking the session index backwards, so a page costs the same
+        however long the session has grown. Pass the "message_id" of the
+        first message of a page as before to get the page preceding it.
+        
+        Sessions moved to the archive by archive_sessions() are read from
+        there, together with anything written to them since.
+        
+        Args:
+            session_id: Session identifier
+            limit: Maximum number of turns, None for all of them
+            before: Only return turns written before this message
+            
+        Returns:
+            List of messages in format [{"role": "human/ai", "content": "...", "message_id": ...}]
+        """
+        conditions = "session_id = ?"
+        params = [session_id]
+        if before is not None:
+            conditions += " AND (created_at, id) < (SELECT created_at, id FROM chat_history WHERE id = ?)"
+            params.append(before)
+        
+        self._read_your_writes(session_id)
+        conn = self._connection()
+        archived = self._archived_rows(session_id)
+        if archived:
+            return self._messages(self._archive_page(session_id, archived, limit, before))
+        
+        if limit is None:
+            rows = conn.execute(
+                f'''SELECT id, user_query, ai_response 
+                FROM chat_history 
+                WHERE {conditions} 
+                ORDER BY created_at, id''',
+                params
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'''SELECT id, user_query, ai_response 
+                FROM chat_history 
+                WHERE {conditions} 
+                ORDER BY created_at DESC, id DESC 
+                LIMIT ?''',
+                params + [limit]
+            ).fetchall()
+            rows.reverse()
+        
+        return self._messages(rows)
+    
+    def _archived_rows(self, session_id: str) -> List[Dict]:
+        """The archived chat_history rows of a session, oldest first, if it has been archived"""
+        row = self._connection().execute(
+            'SELECT history FROM session_archive WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return _unpack_history(row['history']) if row else []
     
-    def get_session_history(self, session_id: str) -> List[Dict]:
+    def _archive_page(self, session_id: str, archived: List[Dict], limit: Optional[int],
+                      before: Optional[int]) -> List[Dict]:
         """
-        Get all messages for a session
+        Page through an archived session's rows and the ones written to it since
         
         Args:
             session_id: Session identifier
+            archived: Rows from _archived_rows
+            limit: Maximum number of turns, None for all of them
+            before: Only return turns written before this message
             
         Returns:
-            List of messages in format [{"role": "human/ai", "content": "..."}]
+            Rows, oldest first
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            '''SELECT user_query, ai_response 
+        live = self._connection().execute(
+            '''SELECT id, user_query, ai_response, intent, pdf_name, created_at 
             FROM chat_history 
             WHERE session_id = ? 
-            ORDER BY created_at''',
+            ORDER BY created_at, id''',
             (session_id,)
-        )
+        ).fetchall()
+        rows = sorted(archived + [dict(row) for row in live], key=lambda row: (row['created_at'] or "", row['id']))
         
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({"role": "human", "content": row['user_query']})
-            messages.append({"role": "ai", "content": row['ai_response']})
+        if before is not None:
+            ids = [row['id'] for row in rows]
+            # Like the keyset query, an unknown message has nothing before it
+            rows = rows[:ids.index(before)] if before in ids else []
+        if limit is not None:
+            rows = rows[-limit:] if limit > 0 else []
+        return rows
+    
+    def get_recent_turns(self, session_id: str, turns: int) -> List[Dict]:
+        """
+        Get the last turns of a session, the context a model call needs
         
-        conn.close()
+        Args:
+            session_id: Session identifier
+            turns: Number of question/answer pairs
+            
+        Returns:
+            Up to 2 * turns messages, oldest first
+        """
+        return self.get_session_history(session_id, limit=turns)
+    
+    def iter_session_history(self, session_id: str, batch_size: int = 500) -> Iterator[Dict]:
+        """
+        Lazily yield every message of a session, oldest first, for exports
+        
+        Rows are read batch_size at a time, each batch resuming after the
+        last row of the previous one, so memory stays flat however long the
+        session is and no read transaction is held open between batches.
+        
+        Args:
+            session_id: Session identifier
+            batch_size: Turns read per query
+            
+        Yields:
+            Messages in the same format as get_session_history
+        """
+        self._read_your_writes(session_id)
+        conn = self._connection()
+        after = None
+        archived = self._archived_rows(session_id)
+        if archived:
+            # Anything written to the session since it was archived follows
+            yield from self._messages(archived)
+            after = (archived[-1]['created_at'], archived[-1]['id'])
+        while True:
+            if after is None:
+                rows = conn.execute(
+                    '''SELECT id, user_query, ai_response, created_at 
+                    FROM chat_history 
+                    WHERE session_id = ? 
+                    ORDER BY created_at, id 
+                    LIMIT ?''',
+                    (session_id, batch_size)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    '''SELECT id, user_query, ai_response, created_at 
+                    FROM chat_history 
+                    WHERE session_id = ? AND (created_at, id) > (?, ?) 
+                    ORDER BY created_at, id 
+                    LIMIT ?''',
+                    (session_id, *after, batch_size)
+                ).fetchall()
+            
+            yield from self._messages(rows)
+            if len(rows) < batch_size:
+                return
+            after = (rows[-1]['created_at'], rows[-1]['id'])
+    
+    @staticmethod
+    def _messages(rows) -> List[Dict]:
+        """Split chat_history rows into human and ai messages"""
+        messages = []
+        for row in rows:
+            messages.append({"role": "human", "content": row['user_query'], "message_id": row['id']})
+            messages.append({"role": "ai", "content": row['ai_response'], "message_id": row['id']})
         return messages
     
     def get_session_pdf(self, session_id: str) -> str:
@@ -102,7 +696,8 @@ class ChatDatabase:
         Returns:
             PDF name or None
         """
-        conn = self.get_connection()
+        self._read_your_writes(session_id)
+        conn = self._connection()
         cursor = conn.cursor()
         cursor.execute(
             '''SELECT pdf_name 
@@ -114,32 +709,42 @@ class ChatDatabase:
         )
         
         row = cursor.fetchone()
-        conn.close()
+        if row is None:
+            row = cursor.execute('SELECT pdf_name FROM session_archive WHERE session_id = ?', (session_id,)).fetchone()
         
         return row['pdf_name'] if row else None
     
-    def get_all_sessions(self) -> List[Dict]:
+    def get_all_sessions(self, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
         """
-        Get list of all unique sessions with PDF info
+        Get list of all unique sessions with PDF info, most recent first
+        
+        Pages are read straight off the sessions index: pass the session_id
+        of the last session of a page as before to get the next one.
         
+        Args:
+            limit: Maximum number of sessions, None for all of them
+            before: Only return sessions listed after this one
+            
         Returns:
             List of sessions with metadata
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 
-                session_id,
-                COUNT(*) as message_count,
-                MAX(created_at) as last_message,
-                (SELECT pdf_name FROM chat_history ch2 
-                 WHERE ch2.session_id = chat_history.session_id 
-                 AND ch2.pdf_name IS NOT NULL 
-                 ORDER BY ch2.created_at DESC LIMIT 1) as pdf_name
-            FROM chat_history
-            GROUP BY session_id
-            ORDER BY last_message DESC
-        ''')
+        conditions = ""
+        params = []
+        if before is not None:
+            conditions = "WHERE (last_message, session_id) < (SELECT last_message, session_id FROM sessions WHERE session_id = ?)"
+            params.append(before)
+        
+        self._read_your_writes()
+        conn = self._connection()
+        cursor = conn.execute(
+            f'''SELECT session_id, message_count, last_message, pdf_name
+            FROM sessions
+            {conditions}
+            ORDER BY last_message DESC, session_id DESC
+            LIMIT ?''',
+            # A negative LIMIT means no limit
+            params + [-1 if limit is None else limit]
+        )
         
         sessions = []
         for row in cursor.fetchall():
@@ -150,27 +755,470 @@ class ChatDatabase:
                 "pdf_name": row['pdf_name']
             })
         
-        conn.close()
         return sessions
     
+    def search(self, query: str, limit: int = 20, session_id: str = None) -> List[Dict]:
+        """
+        Find past messages by their words, best matches first
+        
+        Every word of the query has to appear in the question or the answer,
+        after stemming ("raining" finds "rain"). Results are ranked by bm25
+        straight from the full-text index. Ranking costs as much as there
+        are messages containing the query's words, so when one of them is
+        in more than SEARCH_RANK_MAX_MATCHES messages the matches are
+        listed newest first instead; either way a search takes milliseconds
+        however much history there is.
+        
+        Args:
+            query: Words as typed by the user; punctuation is ignored
+            limit: Maximum number of results
+            session_id: Only search this session
+            
+        Returns:
+            Matches with message_id, session_id, created_at, pdf_name, and
+            query_snippet / answer_snippet with the matched words in bold
+        """
+        words = _search_words(query)
+        if not words:
+            return []
+        
+        self._read_your_writes(session_id)
+        conn = self._connection()
+        conditions = "chat_history_fts MATCH ?"
+        params = [_match_expression(words, session_id)]
+        if session_id is not None:
+            # Stemming could make two hex tokens equal; this keeps it exact
+            conditions += " AND chat_history.session_id = ?"
+            params.append(session_id)
+        order = "rank" if self._rankable(conn, words) else "chat_history_fts.rowid DESC"
+        
+        cursor = conn.execute(
+            f'''SELECT 
+                chat_history.id AS message_id,
+                chat_history.session_id,
+                chat_history.created_at,
+                chat_history.pdf_name,
+                snippet(chat_history_fts, 1, '**', '**', '…', {SNIPPET_TOKENS}) AS query_snippet,
+                snippet(chat_history_fts, 2, '**', '**', '…', {SNIPPET_TOKENS}) AS answer_snippet
+            FROM chat_history_fts 
+            JOIN chat_history ON chat_history.id = chat_history_fts.rowid 
+            WHERE {conditions} 
+            ORDER BY {order} 
+            LIMIT ?''',
+            params + [limit]
+        )
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
+    @staticmethod
+    def _rankable(conn: sqlite3.Connection, words: List[str]) -> bool:
+        """Whether every word is rare enough for bm25 to rank its matches quickly"""
+        for word in set(words):
+            # Stops reading the word's matches after SEARCH_RANK_MAX_MATCHES
+            common = conn.execute(
+                '''SELECT rowid FROM chat_history_fts 
+                WHERE chat_history_fts MATCH ? 
+                LIMIT 1 OFFSET ?''',
+                (_match_expression([word]), SEARCH_RANK_MAX_MATCHES)
+            ).fetchone()
+            if common:
+                return False
+        return True
+    
+    def insert_spans(self, message_id: int, spans: List[Dict]):
+        """
+        Store the spans of a traced request
+        
+        Args:
+            message_id: chat_history row the trace belongs to
+            spans: Span dicts as produced by tracing.Span.to_dict()
+        """
+        self._write(
+            '''INSERT INTO trace_spans 
+            (trace_id, span_id, parent_span_id, message_id, name, start_time, duration_ms, attributes, error) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [
+                (
+                    span["trace_id"],
+                    span["span_id"],
+                    span["parent_id"],
+                    message_id,
+                    span["name"],
+                    span["start_time"],
+                    span["duration_ms"],
+                    json.dumps(span["attributes"], default=str),
+                    span["error"]
+                )
+                for span in spans
+            ]
+        )
+    
+    def get_trace(self, trace_id: str) -> List[Dict]:
+        """
+        Get all spans of a trace
+        
+        Args:
+            trace_id: Trace identifier
+            
+        Returns:
+            Spans ordered by start time
+        """
+        self._read_your_writes()
+        conn = self._connection()
+        cursor = conn.execute(
+            '''SELECT trace_id, span_id, parent_span_id, message_id, name, start_time, duration_ms, attributes, error 
+            FROM trace_spans 
+            WHERE trace_id = ? 
+            ORDER BY start_time''',
+            (trace_id,)
+        )
+        
+        spans = []
+        for row in cursor.fetchall():
+            span = dict(row)
+            span["attributes"] = json.loads(span["attributes"] or "{}")
+            spans.append(span)
+        
+        return spans
+    
+    def insert_slow_query(self, trace_id: str, message_id: int, session_id: str, query: str, duration_ms: float, span_tree: str):
+        """
+        Record a request that exceeded the slow query threshold
+        
+        Args:
+            trace_id: Trace identifier
+            message_id: chat_history row of the request
+            session_id: Session identifier
+            query: User query
+            duration_ms: Total request duration
+            span_tree: JSON-encoded nested span tree
+        """
+        self._write(
+            '''INSERT INTO slow_queries 
+            (trace_id, message_id, session_id, user_query, duration_ms, span_tree) 
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            [(trace_id, message_id, session_id, query, duration_ms, span_tree)],
+            [session_id]
+        )
+    
+    def get_slow_queries(self, limit: int = 20) -> List[Dict]:
+        """
+        Get the slowest logged requests
+        
+        Args:
+            limit: Maximum number of entries
+            
+        Returns:
+            Slow query entries with their decoded span trees, slowest first
+        """
+        self._read_your_writes()
+        conn = self._connection()
+        cursor = conn.execute(
+            '''SELECT trace_id, message_id, session_id, user_query, duration_ms, span_tree, created_at 
+            FROM slow_queries 
+            ORDER BY duration_ms DESC 
+            LIMIT ?''',
+            (limit,)
+        )
+        
+        entries = []
+        for row in cursor.fetchall():
+            entry = dict(row)
+            entry["span_tree"] = json.loads(entry["span_tree"])
+            entries.append(entry)
+        
+        return entries
+    
+    def insert_usage(self, calls: List[Dict]):
+        """
+        Record the token usage of model calls
+        
+        Args:
+            calls: Dicts with step, model, prompt_tokens, completion_tokens and
+                cost_usd (as in the metrics request breakdown's "model_calls"),
+                plus optional message_id, session_id and pdf_name
+        """
+        if not calls:
+            return
+        
+        self._write(
+            '''INSERT INTO token_usage 
+            (message_id, session_id, pdf_name, step, model, prompt_tokens, completion_tokens, cost_usd) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            [
+                (
+                    call.get("message_id"),
+                    call.get("session_id"),
+                    call.get("pdf_name"),
+                    call["step"],
+                    call.get("model"),
+                    call["prompt_tokens"],
+                    call["completion_tokens"],
+                    call["cost_usd"]
+                )
+                for call in calls
+            ],
+            [call.get("session_id") for call in calls]
+        )
+    
+    def get_usage(self, session_id: str = None, pdf_name: str = None, message_id: int = None) -> Dict:
+        """
+        Get total token usage and cost
+        
+        Filters combine, so passing only session_id gives the session's
+        spend and passing only pdf_name gives everything spent on that PDF,
+        including its ingestion.
+        
+        Args:
+            session_id: Only count calls made in this session
+            pdf_name: Only count calls made for this PDF
+            message_id: Only count calls made for this request
+            
+        Returns:
+            Dict with prompt_tokens, completion_tokens, total_tokens, cost_usd and calls
+        """
+        conditions = []
+        params = []
+        for column, value in (("session_id", session_id), ("pdf_name", pdf_name), ("message_id", message_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        self._read_your_writes(session_id)
+        conn = self._connection()
+        row = conn.execute(
+            f'''SELECT 
+                COALESCE(SUM(prompt_tokens), 0) as prompt_tokens,
+                COALESCE(SUM(completion_tokens), 0) as completion_tokens,
+                COALESCE(SUM(cost_usd), 0.0) as cost_usd,
+                COUNT(*) as calls
+            FROM token_usage {where}''',
+            params
+        ).fetchone()
+        
+        return {
+            "prompt_tokens": row['prompt_tokens'],
+            "completion_tokens": row['completion_tokens'],
+            "total_tokens": row['prompt_tokens'] + row['completion_tokens'],
+            "cost_usd": row['cost_usd'],
+            "calls": row['calls']
+        }
+    
+    def archive_sessions(self, older_than_days: float = None, batch_size: int = None) -> Dict:
+        """
+        Move sessions whose last message is older than older_than_days to the archive
+        
+        Each session's chat_history rows become one zlib-compressed row of
+        session_archive and are deleted from chat_history, which drops them
+        from the session listing and the search index. get_session_history
+        still returns them. Sessions are moved batch_size per transaction,
+        so writers are never held up for long; the search index is then
+        merged in one transaction to drop what was deleted from it. The
+        pages this frees are reused by new rows; vacuum() returns them to
+        the file system.
+        
+        Args:
+            older_than_days: Age of the last message (defaults to RETENTION_DAYS)
+            batch_size: Sessions per transaction (defaults to ARCHIVE_BATCH)
+            
+        Returns:
+            Sessions and messages archived, the uncompressed and compressed
+            bytes of their history, and the bytes freed inside the file
+        """
+        if older_than_days is None:
+            older_than_days = RETENTION_DAYS
+        batch_size = batch_size or ARCHIVE_BATCH
+        cutoff = _now(older_than_days)
+        
+        self._read_your_writes()
+        conn = self._connection()
+        used_before = self._used_pages(conn)
+        report = {"sessions": 0, "messages": 0, "raw_bytes": 0, "archived_bytes": 0}
+        while True:
+            # Taking the write lock first keeps a session's rows from
+            # changing between reading and deleting them
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                session_ids = [
+                    row['session_id'] for row in conn.execute(
+                        '''SELECT session_id FROM sessions 
+                        WHERE last_message < ? 
+                        ORDER BY last_message, session_id 
+                        LIMIT ?''',
+                        (cutoff, batch_size)
+                    )
+                ]
+                for session_id in session_ids:
+                    self._archive_session(conn, session_id, report)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            if len(session_ids) < batch_size:
+                break
+        
+        if report["sessions"]:
+            # Deleting from the search index only adds delete markers to it;
+            # merging its segments drops them along with the deleted entries
+            with conn:
+                conn.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('optimize')")
+        
+        report["freed_bytes"] = (used_before - self._used_pages(conn)) * self._page_size(conn)
+        if report["sessions"]:
+            metrics.registry.increment("chat_db_archived_sessions_total", report["sessions"])
+        logger.info(
+            "sessions_archived db=%s sessions=%d messages=%d raw_bytes=%d archived_bytes=%d freed_bytes=%d",
+            self.db_name, report["sessions"], report["messages"], report["raw_bytes"],
+            report["archived_bytes"], report["freed_bytes"]
+        )
+        return report
+    
+    @staticmethod
+    def _archive_session(conn: sqlite3.Connection, session_id: str, report: Dict):
+        """Move one session's chat_history rows into its session_archive row, inside the caller's transaction"""
+        rows = [
+            tuple(row) for row in conn.execute(
+                '''SELECT id, user_query, ai_response, intent, pdf_name, created_at 
+                FROM chat_history 
+                WHERE session_id = ? 
+                ORDER BY created_at, id''',
+                (session_id,)
+            )
+        ]
+        existing = conn.execute('SELECT history FROM session_archive WHERE session_id = ?', (session_id,)).fetchone()
+        if existing is not None:
+            # Written to again after it was archived
+            rows = [tuple(row.values()) for row in _unpack_history(existing['history'])] + rows
+            rows.sort(key=lambda row: (row[5] or "", row[0]))
+        
+        raw = json.dumps(rows, separators=(",", ":")).encode()
+        history = zlib.compress(raw, ARCHIVE_ZLIB_LEVEL)
+        pdf_names = [row[4] for row in rows if row[4] is not None]
+        conn.execute(
+            '''INSERT OR REPLACE INTO session_archive 
+            (session_id, message_count, first_message, last_message, pdf_name, history) 
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            (session_id, len(rows), rows[0][5], rows[-1][5], pdf_names[-1] if pdf_names else None, history)
+        )
+        # Dropping the summary row first spares its delete trigger
+        # recomputing it after every message; another trigger removes the
+        # messages from the search index
+        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        deleted = conn.execute('DELETE FROM chat_history WHERE session_id = ?', (session_id,)).rowcount
+        
+        report["sessions"] += 1
+        report["messages"] += deleted
+        report["raw_bytes"] += len(raw)
+        report["archived_bytes"] += len(history)
+    
+    def vacuum(self, max_pages: int = None) -> Dict:
+        """
+        Return free pages at the end of the database file to the file system
+        
+        Files created with auto_vacuum=INCREMENTAL (every file ChatDatabase
+        creates) release up to max_pages pages without rewriting the rest of
+        the file. An older file is converted with one full VACUUM, which
+        rewrites the whole file and holds the write lock while it does.
+        
+        Args:
+            max_pages: Most pages to release, None for all free pages
+            
+        Returns:
+            Page counts before and after, the bytes reclaimed and whether a
+            full VACUUM was needed
+        """
+        self._read_your_writes()
+        conn = self._connection()
+        page_size = self._page_size(conn)
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+        
+        full = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+        if full:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # incremental_vacuum frees a page per step of the statement and
+            # returns no rows, so execute() would stop after the first page;
+            # executescript() steps it to the end
+            pages = "" if max_pages is None else f"({int(max_pages)})"
+            conn.executescript(f"PRAGMA incremental_vacuum{pages}")
+        # The shrunk database is in the WAL until a checkpoint copies it back
+        # and truncates the file
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        
+        pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        report = {
+            "pages_before": pages_before,
+            "pages_after": pages_after,
+            "reclaimed_bytes": (pages_before - pages_after) * page_size,
+            "full_vacuum": full
+        }
+        logger.info(
+            "database_vacuumed db=%s pages_before=%d pages_after=%d reclaimed_bytes=%d full_vacuum=%s",
+            self.db_name, pages_before, pages_after, report["reclaimed_bytes"], full
+        )
+        return report
+    
+    def compact(self, older_than_days: float = None, max_pages: int = None) -> Dict:
+        """
+        Retention job: archive old sessions, then give the freed space back
+        
+        Args:
+            older_than_days: Age of the last message (defaults to RETENTION_DAYS)
+            max_pages: Most pages to release, None for all free pages
+            
+        Returns:
+            The reports of archive_sessions() and vacuum()
+        """
+        return {
+            "archive": self.archive_sessions(older_than_days),
+            "vacuum": self.vacuum(max_pages)
+        }
+    
+    @staticmethod
+    def _page_size(conn: sqlite3.Connection) -> int:
+        """Bytes per database page"""
+        return conn.execute("PRAGMA page_size").fetchone()[0]
+    
+    @staticmethod
+    def _used_pages(conn: sqlite3.Connection) -> int:
+        """Pages holding data, excluding free pages waiting for reuse or a vacuum"""
+        return conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
     def clear_session(self, session_id: str):
         """
         Delete all messages for a session
         
+        Token usage is kept, so clearing a session doesn't reset its budget.
+        
         Args:
             session_id: Session to clear
         """
-        conn = self.get_connection()
-        conn.execute('DELETE FROM chat_history WHERE session_id = ?', (session_id,))
-        conn.commit()
-        conn.close()
+        # Queued inserts must not land after the delete. Commit the whole
+        # queue: spans are queued without their session, so a flush of just
+        # this session's writes would leave them to land afterwards
+        self._read_your_writes()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'DELETE FROM trace_spans WHERE message_id IN (SELECT id FROM chat_history WHERE session_id = ?)',
+                (session_id,)
+            )
+            conn.execute('DELETE FROM slow_queries WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM chat_history WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM session_archive WHERE session_id = ?', (session_id,))
     
     def clear_all(self):
         """Delete all chat history"""
-        conn = self.get_connection()
-        conn.execute('DELETE FROM chat_history')
-        conn.commit()
-        conn.close()
+        self._read_your_writes()
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM token_usage')
+            conn.execute('DELETE FROM trace_spans')
+            conn.execute('DELETE FROM slow_queries')
+            conn.execute('DELETE FROM chat_history')
+            conn.execute('DELETE FROM session_archive')
 
 
 # Test the database
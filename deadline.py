@@ -0,0 +1,102 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.runnables import RunnableLambda
+
+
+# Absolute time.monotonic() deadline of the request running in this context
+_current_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a step is started after its request's deadline has passed"""
+
+
+def from_budget(budget_ms: Optional[float]) -> Optional[float]:
+    """
+    Turn a latency budget into an absolute deadline
+
+    Args:
+        budget_ms: Milliseconds the request may take, or None for no deadline
+
+    Returns:
+        time.monotonic() value the request must finish by, or None
+    """
+    if budget_ms is None:
+        return None
+    return time.monotonic() + budget_ms / 1000
+
+
+@contextmanager
+def scope(deadline_at: Optional[float]):
+    """
+    Make a deadline visible to everything called in this block
+
+    Args:
+        deadline_at: Absolute time.monotonic() deadline, or None for none
+    """
+    token = _current_deadline.set(deadline_at)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining(deadline_at: Optional[float] = None) -> Optional[float]:
+    """
+    Seconds left before a deadline
+
+    Args:
+        deadline_at: Deadline to check (defaults to the current context's)
+
+    Returns:
+        Seconds remaining (negative once passed), or None if there is no deadline
+    """
+    if deadline_at is None:
+        deadline_at = _current_deadline.get()
+    if deadline_at is None:
+        return None
+    return deadline_at - time.monotonic()
+
+
+def timeout(default: Optional[float]) -> Optional[float]:
+    """
+    Cap a call's timeout by the time left on the current deadline
+
+    Args:
+        default: Timeout the call would use without a deadline
+
+    Returns:
+        Timeout in seconds
+
+    Raises:
+        DeadlineExceeded: If the deadline has already passed
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded(f"Request deadline exceeded by {-left * 1000:.0f} ms")
+    return left if default is None else min(default, left)
+
+
+def bounded(llm) -> RunnableLambda:
+    """
+    Wrap a chat model so each call's timeout is capped by the current deadline
+
+    Use in place of the model in a chain: `prompt | gate | bounded(llm) | parser`.
+
+    Args:
+        llm: Chat model
+
+    Returns:
+        Runnable that invokes the model with a per-call timeout when a deadline is set
+    """
+    def call(prompt_value, config):
+        if remaining() is None:
+            return llm.invoke(prompt_value, config=config)
+        return llm.invoke(prompt_value, config=config, timeout=timeout(None))
+
+    return RunnableLambda(call, name="bounded_llm")
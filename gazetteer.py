@@ -0,0 +1,392 @@
+"""
+Offline city gazetteer with fuzzy name resolution
+
+Usage:
+    python -m gazetteer build <geonames cities file> <output .tsv or .tsv.gz> [min population]
+"""
+
+import gzip
+import logging
+import os
+import re
+import sys
+import threading
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.tsv")
+
+# Words that introduce a city in a question, e.g. "weather in paris"
+_CITY_PREPOSITIONS = {"in", "for", "at"}
+_MAX_NAME_WORDS = 4
+
+# Capitalized words in weather questions that aren't places
+_NOT_PLACES = {
+    "i", "celsius", "fahrenheit", "uv",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "january", "february", "march", "april", "may", "june", "july",
+    "august", "september", "october", "november", "december",
+}
+
+# Gazetteers loaded by from_env, by path
+_shared: Dict[str, "Gazetteer"] = {}
+_shared_lock = threading.Lock()
+
+
+class City(NamedTuple):
+    id: int
+    name: str
+    country: str
+    population: int
+
+
+def normalize(name: str) -> str:
+    """
+    Reduce a place name to lowercase ASCII words
+
+    "São Paulo", "sao-paulo" and " SAO  PAULO " all become "sao paulo".
+    """
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", ascii_name.lower()).split())
+
+
+def _trigrams(name: str) -> set:
+    """Character trigrams of a normalized name, padded so word starts weigh more"""
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Edit distance between two strings, counting a swap of adjacent letters
+    ("Dehli") as one edit
+
+    Returns:
+        The distance, or limit + 1 once it exceeds limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+def _max_edits(name: str) -> int:
+    """Typos tolerated in a name: one, or two in long names"""
+    return 1 if len(name) <= 8 else 2
+
+
+def _open(path: str, mode: str):
+    """Open a plain or gzip-compressed text file"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class Gazetteer:
+    def __init__(self, cities: List[City], aliases: Dict[int, List[str]] = None, min_similarity: float = 0.3):
+        """
+        In-memory index of city names for resolving them without the weather API
+
+        Exact names and aliases are looked up in a dict. On request, anything
+        else is matched against the names sharing enough character trigrams
+        with it, accepting one typo (two in long names), so "Londn" and
+        "Mumbay" resolve but "Atlantis" doesn't become "Atlanta". Ambiguous
+        names go to the most populous city unless a country code is given
+        ("London, CA").
+
+        Args:
+            cities: Known cities
+            aliases: Extra names per city id
+            min_similarity: Lowest trigram (Dice) similarity for a name to be
+                considered as a fuzzy match
+        """
+        self.min_similarity = min_similarity
+        self.cities = {city.id: city for city in cities}
+        self._names: Dict[str, List[City]] = defaultdict(list)
+        self._trigram_index: Dict[str, set] = defaultdict(set)
+        self._trigram_counts: Dict[str, int] = {}
+        self._resolved: Dict[Tuple[str, bool], Optional[City]] = {}
+        self._lock = threading.Lock()
+
+        aliases = aliases or {}
+        for city in cities:
+            for name in [city.name] + aliases.get(city.id, []):
+                key = normalize(name)
+                if key and city not in self._names[key]:
+                    self._names[key].append(city)
+        for key, matches in self._names.items():
+            matches.sort(key=lambda city: -city.population)
+            trigrams = _trigrams(key)
+            self._trigram_counts[key] = len(trigrams)
+            for trigram in trigrams:
+                self._trigram_index[trigram].add(key)
+        self.countries = {city.country.lower() for city in cities}
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH, min_similarity: float = 0.3) -> "Gazetteer":
+        """
+        Load a gazetteer file
+
+        Lines are "id<TAB>name<TAB>country<TAB>population[<TAB>alias|alias...]";
+        blank lines and lines starting with "#" are skipped. Files ending in
+        .gz are read compressed.
+
+        Args:
+            path: Gazetteer file
+            min_similarity: Lowest trigram similarity for a fuzzy match candidate
+
+        Returns:
+            Gazetteer instance
+        """
+        cities = []
+        aliases = {}
+        with _open(path, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                city = City(int(fields[0]), fields[1], fields[2].upper(), int(fields[3] or 0))
+                cities.append(city)
+                if len(fields) > 4 and fields[4]:
+                    aliases[city.id] = fields[4].split("|")
+        logger.debug("gazetteer_loaded path=%s cities=%d", path, len(cities))
+        return cls(cities, aliases, min_similarity)
+
+    @classmethod
+    def from_env(cls) -> Optional["Gazetteer"]:
+        """
+        Get the gazetteer configured by GAZETTEER_PATH (defaults to the bundled
+        data/cities.tsv; "off" disables it) and GAZETTEER_MIN_SIMILARITY
+
+        Each file is loaded once and shared by every caller.
+
+        Returns:
+            Gazetteer, or None when disabled or unreadable
+        """
+        path = os.getenv("GAZETTEER_PATH", DEFAULT_PATH)
+        if path.lower() == "off":
+            return None
+        with _shared_lock:
+            if path not in _shared:
+                try:
+                    _shared[path] = cls.load(path, float(os.getenv("GAZETTEER_MIN_SIMILARITY", "0.3")))
+                except (OSError, ValueError, IndexError) as e:
+                    logger.warning("gazetteer_load_failed path=%s error=%s", path, e)
+                    return None
+            return _shared[path]
+
+    def _match(self, key: str, country: Optional[str], fuzzy: bool = False) -> Optional[City]:
+        """Best city for a normalized name, exactly or, if fuzzy, by trigram similarity"""
+        def pick(candidates):
+            for city in candidates:
+                if country is None or city.country.lower() == country:
+                    return city
+            return None
+
+        if key in self._names:
+            return pick(self._names[key])
+        if not fuzzy:
+            return None
+
+        # Count shared trigrams with every indexed name that has any in common
+        trigrams = _trigrams(key)
+        shared = defaultdict(int)
+        for trigram in trigrams:
+            for name in self._trigram_index.get(trigram, ()):
+                shared[name] += 1
+
+        # Closest candidate by edit distance, then similarity, then population
+        limit = _max_edits(key)
+        best, best_rank = None, None
+        for name, count in shared.items():
+            score = 2 * count / (len(trigrams) + self._trigram_counts[name])
+            if score < self.min_similarity:
+                continue
+            city = pick(self._names[name])
+            if city is None:
+                continue
+            distance = _edit_distance(key, name, limit)
+            if distance > limit:
+                continue
+            rank = (distance, -score, -city.population)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = city, rank
+        return best
+
+    def resolve(self, name: str, fuzzy: bool = False) -> Optional[City]:
+        """
+        Resolve a city name to a known city
+
+        Fuzzy matches are only a guess: the index lists major cities only,
+        so a name one typo away from one of them is as likely to be a place
+        it doesn't list ("Leon" isn't Lyon, "Laos" isn't Lagos).
+
+        Args:
+            name: City name as written by a user or the LLM, optionally
+                followed by a country code ("Paris, US")
+            fuzzy: Also accept the closest name within a typo or two
+
+        Returns:
+            The matching city, or None when it isn't in the gazetteer
+        """
+        if (name, fuzzy) in self._resolved:
+            return self._resolved[(name, fuzzy)]
+
+        place, _, qualifier = name.partition(",")
+        country = normalize(qualifier) or None
+        city = None
+        # Only country codes are understood as qualifiers; anything else
+        # ("Paris, Texas") is left to the weather API
+        if country is None or country in self.countries:
+            city = self._match(normalize(place), country, fuzzy)
+
+        with self._lock:
+            if len(self._resolved) >= 10000:
+                self._resolved.clear()
+            self._resolved[(name, fuzzy)] = city
+        return city
+
+    def find_mentions(self, text: str) -> List[City]:
+        """
+        Find cities named in a question, without the LLM
+
+        Only exact names and aliases count, and only when they are written
+        capitalized or right after "in", "for" or "at", so ordinary words
+        that happen to be city names aren't picked up. Longer names win
+        ("New York" rather than "York"), and a country code after a comma
+        picks the city in that country ("London, CA").
+
+        Args:
+            text: User query
+
+        Returns:
+            Cities in the order mentioned, without duplicates
+        """
+        return self._scan(text)[0]
+
+    def extract(self, text: str) -> Optional[List[City]]:
+        """
+        Cities named in a question, if the gazetteer accounts for all of them
+
+        Unlike find_mentions, this gives up when the question also has a
+        capitalized word that may be a place the gazetteer doesn't know
+        ("Delhi and Springfield") or a qualifier it can't apply ("Paris,
+        Texas"), so the caller can ask the LLM for the whole list instead
+        of answering for part of it. Words starting a sentence don't count.
+
+        Args:
+            text: User query
+
+        Returns:
+            Cities in the order mentioned, or None when the question names
+            none or names something else too
+        """
+        mentions, unknown = self._scan(text)
+        if not mentions or unknown:
+            return None
+        return mentions
+
+    def _scan(self, text: str) -> Tuple[List[City], List[str]]:
+        """
+        Split a question into the cities it names and the capitalized words
+        left over that may be places
+
+        Returns:
+            Tuple of (cities without duplicates, unknown words)
+        """
+        tokens = list(re.finditer(r"[^\W_]+(?:[.'-][^\W_]+)*\.?", text))
+        words = [token.group() for token in tokens]
+        keys = [normalize(word) for word in words]
+
+        def separator(i):
+            """Text between word i - 1 and word i"""
+            return text[tokens[i - 1].end():tokens[i].start()] if i > 0 else ""
+
+        mentions, unknown = [], []
+        i = 0
+        while i < len(words):
+            city = None
+            for length in range(min(_MAX_NAME_WORDS, len(words) - i), 0, -1):
+                key = " ".join(k for k in keys[i:i + length] if k)
+                if key not in self._names:
+                    continue
+                capitalized = all(word[0].isupper() for word in words[i:i + length] if word[0].isalpha())
+                if not capitalized and (i == 0 or keys[i - 1] not in _CITY_PREPOSITIONS):
+                    continue
+                city = self._names[key][0]
+                i += length
+                # "London, CA": a country code qualifies the name
+                if (i < len(words) and "," in separator(i) and len(words[i]) == 2 and words[i].isupper()
+                        and keys[i] in self.countries):
+                    city = self._match(key, keys[i]) or city
+                    i += 1
+                break
+
+            if city is not None:
+                if city not in mentions:
+                    mentions.append(city)
+                continue
+            sentence_start = i == 0 or words[i - 1].endswith(".") or any(mark in separator(i) for mark in ".!?")
+            if words[i][0].isupper() and not sentence_start and keys[i] not in _NOT_PLACES:
+                unknown.append(words[i])
+            i += 1
+        return mentions, unknown
+
+
+def build(geonames_path: str, output_path: str, min_population: int = 15000) -> int:
+    """
+    Build a gazetteer file from a GeoNames cities dump (e.g. cities15000.txt)
+
+    Alternate names are kept when they are plain Latin script, which covers
+    common English and local spellings without every translation.
+
+    Args:
+        geonames_path: GeoNames cities file
+        output_path: Gazetteer file to write (.gz to compress)
+        min_population: Smallest population included
+
+    Returns:
+        Number of cities written
+    """
+    written = 0
+    with _open(geonames_path, "r") as source, _open(output_path, "w") as out:
+        out.write("# id\tname\tcountry\tpopulation\taliases (|-separated)\n")
+        for line in source:
+            fields = line.rstrip("\n").split("\t")
+            population = int(fields[14] or 0)
+            if population < min_population:
+                continue
+            names = {fields[1], fields[2]}
+            aliases = sorted({
+                alias for alias in fields[3].split(",")
+                if alias not in names and len(alias) <= 40 and normalize(alias)
+                and all(not char.isalpha() or "LATIN" in unicodedata.name(char, "") for char in alias)
+            })
+            if fields[2] != fields[1]:
+                aliases.insert(0, fields[2])
+            out.write(f"{fields[0]}\t{fields[1]}\t{fields[8]}\t{population}\t{'|'.join(aliases)}\n")
+            written += 1
+    return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "build":
+        print(__doc__)
+        sys.exit(1)
+    count = build(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 15000)
+    print(f"Wrote {count} cities to {sys.argv[3]}")
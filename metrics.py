@@ -0,0 +1,319 @@
+import json
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+import tracing
+import usage
+
+
+# Per-request breakdown for whichever run is active in the current context
+_current_request: ContextVar[Optional[dict]] = ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, max_samples: int = 10000):
+        """
+        Latency histogram backed by a fixed-size reservoir sample
+
+        Args:
+            max_samples: Maximum number of observations kept for percentiles
+        """
+        self.max_samples = max_samples
+        self.samples: List[float] = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """
+        Record one observation
+
+        Args:
+            value: Observed value
+        """
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            # Reservoir sampling keeps the percentiles unbiased once full
+            slot = random.randrange(self.count)
+            if slot < self.max_samples:
+                self.samples[slot] = value
+
+    def percentile(self, p: float) -> float:
+        """
+        Get a percentile of the recorded values
+
+        Args:
+            p: Percentile between 0 and 100
+
+        Returns:
+            Value at that percentile, or 0.0 if nothing was recorded
+        """
+        if not self.samples:
+            return 0.0
+
+        ordered = sorted(self.samples)
+        # Nearest-rank percentile
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def snapshot(self) -> Dict:
+        """
+        Summarize the histogram
+
+        Returns:
+            Dict with count, sum, max and p50/p95/p99
+        """
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "max": round(self.max, 3),
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3)
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Initialize an empty registry of step latencies and counters"""
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[tuple, float] = {}
+
+    def observe(self, step: str, value_ms: float):
+        """
+        Record the latency of a pipeline step
+
+        Args:
+            step: Step name, e.g. "classify_intent" or "rag.embed"
+            value_ms: Duration in milliseconds
+        """
+        with self._lock:
+            if step not in self.histograms:
+                self.histograms[step] = Histogram()
+            self.histograms[step].observe(value_ms)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        """
+        Add to a counter
+
+        Args:
+            name: Counter name
+            amount: Amount to add
+            **labels: Label values identifying the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self) -> Dict:
+        """
+        Get a point-in-time copy of every metric
+
+        Returns:
+            Dict with "latency_ms" per step and a list of "counters"
+        """
+        with self._lock:
+            return {
+                "latency_ms": {step: hist.snapshot() for step, hist in sorted(self.histograms.items())},
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ]
+            }
+
+    def to_json(self) -> str:
+        """Export all metrics as JSON"""
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Export all metrics in the Prometheus text exposition format
+
+        Returns:
+            Exposition text, with step latencies as a summary and counters as counters
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP agent_step_latency_ms Latency of agent pipeline steps in milliseconds",
+            "# TYPE agent_step_latency_ms summary"
+        ]
+        for step, stats in snapshot["latency_ms"].items():
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                lines.append(f'agent_step_latency_ms{{step="{step}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'agent_step_latency_ms_sum{{step="{step}"}} {stats["sum"]}')
+            lines.append(f'agent_step_latency_ms_count{{step="{step}"}} {stats["count"]}')
+
+        seen = set()
+        for counter in snapshot["counters"]:
+            name = counter["name"]
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            labels = ",".join(f'{key}="{value}"' for key, value in counter["labels"].items())
+            series = f"{name}{{{labels}}}" if labels else name
+            lines.append(f"{series} {counter['value']}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Drop all recorded metrics"""
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+# Process-wide registry shared by every pipeline
+registry = MetricsRegistry()
+
+
+@contextmanager
+def request_scope():
+    """
+    Collect a timing, token and cache breakdown for one request
+
+    Yields:
+        Dict with "timings_ms" per step, "tokens" totals, "cache" hit/miss
+        per cached node and the priced "model_calls", filled in as the
+        request runs
+    """
+    breakdown = {
+        "timings_ms": {},
+        "tokens": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "cache": {},
+        "model_calls": []
+    }
+    token = _current_request.set(breakdown)
+    try:
+        yield breakdown
+    finally:
+        _current_request.reset(token)
+
+
+@contextmanager
+def timer(step: str):
+    """
+    Time a block and record it as a pipeline step
+
+    The block also runs inside a trace span of the same name, which is
+    free when no trace is active.
+
+    Args:
+        step: Step name
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span(step):
+            yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        registry.observe(step, elapsed_ms)
+
+        breakdown = _current_request.get()
+        if breakdown is not None:
+            timings = breakdown["timings_ms"]
+            timings[step] = round(timings.get(step, 0.0) + elapsed_ms, 3)
+
+
+def record_tokens(step: str, prompt_tokens: int, completion_tokens: int = 0, model: str = None):
+    """
+    Record token usage for a model call
+
+    Args:
+        step: Step that made the call
+        prompt_tokens: Input tokens
+        completion_tokens: Output tokens
+        model: Model that served the call, used to price it
+    """
+    cost = usage.cost_usd(model, prompt_tokens, completion_tokens)
+    registry.increment("agent_tokens_total", prompt_tokens, step=step, kind="prompt")
+    registry.increment("agent_tokens_total", completion_tokens, step=step, kind="completion")
+    registry.increment("agent_cost_usd_total", cost, step=step, model=model or "unknown")
+    tracing.add_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    breakdown = _current_request.get()
+    if breakdown is not None:
+        tokens = breakdown["tokens"]
+        tokens["prompt_tokens"] += prompt_tokens
+        tokens["completion_tokens"] += completion_tokens
+        tokens["total_tokens"] += prompt_tokens + completion_tokens
+        breakdown["model_calls"].append({
+            "step": step,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": cost
+        })
+
+
+def record_cache(node: str, hit: bool):
+    """
+    Record a node cache lookup
+
+    Args:
+        node: Graph node name
+        hit: Whether a cached result was used
+    """
+    result = "hit" if hit else "miss"
+    registry.increment("agent_node_cache_total", node=node, result=result)
+
+    breakdown = _current_request.get()
+    if breakdown is not None:
+        breakdown["cache"][node] = result
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    def __init__(self, step: str):
+        """
+        LangChain callback that records token usage of chat model calls
+
+        Args:
+            step: Step name the usage is attributed to
+        """
+        self.step = step
+
+    def on_llm_end(self, response, **kwargs):
+        """Record usage reported by the model provider"""
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens", 0)
+        completion_tokens = token_usage.get("completion_tokens", 0)
+        model = llm_output.get("model_name")
+
+        if not token_usage:
+            # Newer providers report usage and model on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    usage_metadata = getattr(message, "usage_metadata", None) or {}
+                    prompt_tokens += usage_metadata.get("input_tokens", 0)
+                    completion_tokens += usage_metadata.get("output_tokens", 0)
+                    response_metadata = getattr(message, "response_metadata", None) or {}
+                    model = model or response_metadata.get("model_name")
+
+        record_tokens(self.step, prompt_tokens, completion_tokens, model=model)
+
+
+def llm_config(step: str) -> Dict:
+    """
+    Build the runnable config for a timed model call
+
+    Args:
+        step: Step name the call's token usage is attributed to
+
+    Returns:
+        Config dict with a TokenUsageCallback attached
+    """
+    return {"callbacks": [TokenUsageCallback(step)]}
@@ -0,0 +1,288 @@
+"""
+Versioned schema migrations for the chat history database
+
+The file's schema version is kept in SQLite's PRAGMA user_version: version
+N means the first N entries of MIGRATIONS have been applied. migrate()
+applies whichever are pending in one transaction, so a file is either
+fully at the new version or untouched. To change the schema, append a
+migration; never edit or reorder one that has shipped, since files in the
+wild have already recorded running it.
+
+Files created before versioning was introduced are at version 0 and may
+already hold any of the tables the first migrations create, which is why
+those use IF NOT EXISTS throughout.
+"""
+
+import logging
+import sqlite3
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    """Whether the database has a table (or virtual table) called name"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def _baseline(conn: sqlite3.Connection):
+    """Chat history, trace spans, slow queries and token usage"""
+    if not _table_exists(conn, "chat_history"):
+        conn.execute('''
+            CREATE TABLE chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                user_query TEXT NOT NULL,
+                ai_response TEXT NOT NULL,
+                intent TEXT,
+                pdf_name TEXT,
+                created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            )
+        ''')
+    elif "pdf_name" not in [column[1] for column in conn.execute("PRAGMA table_info(chat_history)")]:
+        # History written before PDFs were recorded per message
+        conn.execute("ALTER TABLE chat_history ADD COLUMN pdf_name TEXT")
+
+    # Request tracing spans, linked to the chat_history row they produced
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trace_spans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trace_id TEXT NOT NULL,
+            span_id TEXT NOT NULL,
+            parent_span_id TEXT,
+            message_id INTEGER,
+            name TEXT NOT NULL,
+            start_time REAL NOT NULL,
+            duration_ms REAL,
+            attributes TEXT,
+            error TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_trace ON trace_spans (trace_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_message ON trace_spans (message_id)")
+
+    # Full span trees of requests that exceeded the slow query threshold
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS slow_queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trace_id TEXT NOT NULL,
+            message_id INTEGER,
+            session_id TEXT,
+            user_query TEXT,
+            duration_ms REAL NOT NULL,
+            span_tree TEXT NOT NULL,
+            created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )
+    ''')
+
+    # Token usage and cost of every model call; ingestion calls have no
+    # session or message, weather and unclassified requests no PDF
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS token_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER,
+            session_id TEXT,
+            pdf_name TEXT,
+            step TEXT NOT NULL,
+            model TEXT,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_usd REAL NOT NULL,
+            created_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_session ON token_usage (session_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_pdf ON token_usage (pdf_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_message ON token_usage (message_id)")
+
+
+def _history_indexes(conn: sqlite3.Connection):
+    """Indexes for reading a session's history and its latest PDF"""
+    # Session history and a session's latest PDF are read by session in
+    # time order; the partial index holds only the rows that name a PDF
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history (session_id, created_at)")
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_session_pdf
+        ON chat_history (session_id, created_at) WHERE pdf_name IS NOT NULL
+    ''')
+
+
+def _sessions_table(conn: sqlite3.Connection):
+    """Per-session summary rows for the sidebar listing, kept by triggers"""
+    # One row per session, kept up to date by triggers so listing sessions
+    # doesn't aggregate chat_history
+    existed = _table_exists(conn, "sessions")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            last_message TEXT,
+            pdf_name TEXT
+        )
+    ''')
+    # Listed newest first; session_id breaks ties so pages can resume
+    # after any session
+    conn.execute("DROP INDEX IF EXISTS idx_sessions_last_message")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_recent ON sessions (last_message, session_id)")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_session_insert AFTER INSERT ON chat_history
+        BEGIN
+            INSERT INTO sessions (session_id, message_count, last_message, pdf_name)
+            VALUES (NEW.session_id, 1, NEW.created_at, NEW.pdf_name)
+            ON CONFLICT (session_id) DO UPDATE SET
+                message_count = message_count + 1,
+                last_message = MAX(last_message, excluded.last_message),
+                pdf_name = COALESCE(excluded.pdf_name, pdf_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_session_delete AFTER DELETE ON chat_history
+        BEGIN
+            UPDATE sessions SET
+                message_count = message_count - 1,
+                last_message = (SELECT MAX(created_at) FROM chat_history WHERE session_id = OLD.session_id),
+                pdf_name = (
+                    SELECT pdf_name FROM chat_history
+                    WHERE session_id = OLD.session_id AND pdf_name IS NOT NULL
+                    ORDER BY created_at DESC LIMIT 1
+                )
+            WHERE session_id = OLD.session_id;
+            DELETE FROM sessions WHERE session_id = OLD.session_id AND message_count <= 0;
+        END
+    ''')
+    if not existed:
+        # Summarize history written before the table existed
+        conn.execute('''
+            INSERT INTO sessions (session_id, message_count, last_message, pdf_name)
+            SELECT
+                session_id,
+                COUNT(*),
+                MAX(created_at),
+                (SELECT pdf_name FROM chat_history ch2
+                 WHERE ch2.session_id = chat_history.session_id
+                 AND ch2.pdf_name IS NOT NULL
+                 ORDER BY ch2.created_at DESC LIMIT 1)
+            FROM chat_history
+            GROUP BY session_id
+        ''')
+
+
+def _full_text_search(conn: sqlite3.Connection):
+    """FTS5 index over questions and answers"""
+    # The text itself stays in chat_history (external content); triggers
+    # keep the index in step. The session id is indexed too, hex-encoded
+    # into a single token, so a search within one session intersects with
+    # that session's few rows instead of filtering every match. Because the
+    # indexed value differs from the column, the index is filled by
+    # INSERT ... SELECT and never by FTS5's 'rebuild'
+    existed = _table_exists(conn, "chat_history_fts")
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+            session_id, user_query, ai_response,
+            content='chat_history', content_rowid='id', tokenize='porter unicode61'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (rowid, session_id, user_query, ai_response)
+            VALUES (NEW.id, hex(NEW.session_id), NEW.user_query, NEW.ai_response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, session_id, user_query, ai_response)
+            VALUES ('delete', OLD.id, hex(OLD.session_id), OLD.user_query, OLD.ai_response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE OF session_id, user_query, ai_response ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, session_id, user_query, ai_response)
+            VALUES ('delete', OLD.id, hex(OLD.session_id), OLD.user_query, OLD.ai_response);
+            INSERT INTO chat_history_fts (rowid, session_id, user_query, ai_response)
+            VALUES (NEW.id, hex(NEW.session_id), NEW.user_query, NEW.ai_response);
+        END
+    ''')
+    if not existed:
+        # Index history written before the table existed
+        conn.execute('''
+            INSERT INTO chat_history_fts (rowid, session_id, user_query, ai_response)
+            SELECT id, hex(session_id), user_query, ai_response FROM chat_history
+        ''')
+
+
+def _session_archive(conn: sqlite3.Connection):
+    """Compressed archive of sessions moved out of chat_history by retention"""
+    # One row per archived session. history is the session's chat_history
+    # rows as a zlib-compressed JSON list of
+    # [id, user_query, ai_response, intent, pdf_name, created_at]
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS session_archive (
+            session_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            first_message TEXT,
+            last_message TEXT,
+            pdf_name TEXT,
+            archived_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            history BLOB NOT NULL
+        )
+    ''')
+
+
+# Applied in order; a file at version N has had the first N applied.
+# Append only
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _baseline,
+    _history_indexes,
+    _sessions_table,
+    _full_text_search,
+    _session_archive,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """Number of migrations the database has had applied"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Bring a database up to SCHEMA_VERSION
+
+    The pending migrations and the new version are committed in one
+    transaction. It takes the write lock before reading the version, so
+    processes starting at the same time apply each migration once.
+
+    Args:
+        conn: Connection to the database, with no transaction open
+
+    Returns:
+        Number of migrations applied
+    """
+    version = schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            logger.warning("schema_newer_than_code version=%d expected=%d", version, SCHEMA_VERSION)
+        return 0
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another process may have migrated while we waited for the lock
+        version = schema_version(conn)
+        pending = MIGRATIONS[version:]
+        for number, migration in enumerate(pending, start=version + 1):
+            migration(conn)
+            logger.info("schema_migrated version=%d name=%s", number, migration.__name__.lstrip("_"))
+        if pending:
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(pending)
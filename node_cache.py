@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+
+from langgraph.cache.base import BaseCache, FullKey, Namespace
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Most node results the in-memory cache holds before evicting the least
+# recently used
+MEMORY_CACHE_SIZE = int(os.getenv("AGENT_NODE_CACHE_SIZE", "2048"))
+
+
+class LRUCache(BaseCache):
+    def __init__(self, max_entries: int = None, *, serde=None):
+        """
+        LangGraph node cache in process memory, bounded in size
+
+        LangGraph's InMemoryCache only drops an expired entry when the same
+        key is read again, so in a long-running process it grows with every
+        distinct query. This one evicts the least recently used entry once
+        max_entries are stored.
+
+        Args:
+            max_entries: Most entries kept (defaults to MEMORY_CACHE_SIZE)
+            serde: Serializer for cached values (defaults to LangGraph's)
+        """
+        super().__init__(serde=serde)
+        self.max_entries = max_entries or MEMORY_CACHE_SIZE
+        self._entries: "OrderedDict[FullKey, Tuple[str, bytes, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Get the unexpired cached values for the given keys, marking them recently used"""
+        now = time.time()
+        found = {}
+        with self._lock:
+            for namespace, key in keys:
+                full_key = (tuple(namespace), key)
+                entry = self._entries.get(full_key)
+                if entry is None:
+                    continue
+                if entry[2] is not None and now >= entry[2]:
+                    del self._entries[full_key]
+                    continue
+                self._entries.move_to_end(full_key)
+                found[full_key] = entry
+        return {full_key: self.serde.loads_typed(entry[:2]) for full_key, entry in found.items()}
+
+    async def aget(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Asynchronously get the cached values for the given keys"""
+        return self.get(keys)
+
+    def set(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Store values with their TTLs, evicting the least recently used beyond max_entries"""
+        now = time.time()
+        entries = [
+            ((tuple(namespace), key), (*self.serde.dumps_typed(value), now + ttl if ttl is not None else None))
+            for (namespace, key), (value, ttl) in pairs.items()
+        ]
+        evicted = 0
+        with self._lock:
+            for full_key, entry in entries:
+                self._entries[full_key] = entry
+                self._entries.move_to_end(full_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.registry.increment("node_cache_evictions_total", evicted)
+
+    async def aset(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Asynchronously store values with their TTLs"""
+        self.set(pairs)
+
+    def clear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Delete the cached values for the given namespaces, or everything"""
+        with self._lock:
+            if namespaces is None:
+                self._entries.clear()
+                return
+            namespaces = {tuple(namespace) for namespace in namespaces}
+            for full_key in [full_key for full_key in self._entries if full_key[0] in namespaces]:
+                del self._entries[full_key]
+
+    async def aclear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Asynchronously delete the cached values for the given namespaces"""
+        self.clear(namespaces)
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, db_name: str = "node_cache.db", *, serde=None):
+        """
+        LangGraph node cache stored in SQLite, shared across processes and restarts
+
+        Args:
+            db_name: SQLite file to store cached node results in
+            serde: Serializer for cached values (defaults to LangGraph's)
+        """
+        super().__init__(serde=serde)
+        self.db_name = db_name
+        self.create_table()
+
+    def get_connection(self):
+        """Get database connection"""
+        return sqlite3.connect(self.db_name, timeout=10)
+
+    def create_table(self):
+        """Create the cache table if it doesn't exist"""
+        conn = self.get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS node_cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Get the unexpired cached values for the given keys"""
+        if not keys:
+            return {}
+
+        now = time.time()
+        values = {}
+        conn = self.get_connection()
+        for namespace, key in keys:
+            row = conn.execute(
+                'SELECT encoding, value, expires_at FROM node_cache WHERE namespace = ? AND key = ?',
+                (json.dumps(list(namespace)), key)
+            ).fetchone()
+            if row is None:
+                continue
+            encoding, value, expires_at = row
+            if expires_at is None or now < expires_at:
+                values[(tuple(namespace), key)] = self.serde.loads_typed((encoding, value))
+        conn.close()
+        return values
+
+    async def aget(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Asynchronously get the cached values for the given keys"""
+        return self.get(keys)
+
+    def set(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Store values with their TTLs, dropping entries that have expired"""
+        now = time.time()
+        rows = []
+        for (namespace, key), (value, ttl) in pairs.items():
+            encoding, data = self.serde.dumps_typed(value)
+            expires_at = now + ttl if ttl is not None else None
+            rows.append((json.dumps(list(namespace)), key, encoding, data, expires_at))
+
+        conn = self.get_connection()
+        conn.executemany(
+            'INSERT OR REPLACE INTO node_cache (namespace, key, encoding, value, expires_at) VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.execute('DELETE FROM node_cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        conn.commit()
+        conn.close()
+
+    async def aset(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Asynchronously store values with their TTLs"""
+        self.set(pairs)
+
+    def clear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Delete the cached values for the given namespaces, or everything"""
+        conn = self.get_connection()
+        if namespaces is None:
+            conn.execute('DELETE FROM node_cache')
+        else:
+            conn.executemany(
+                'DELETE FROM node_cache WHERE namespace = ?',
+                [(json.dumps(list(namespace)),) for namespace in namespaces]
+            )
+        conn.commit()
+        conn.close()
+
+    async def aclear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Asynchronously delete the cached values for the given namespaces"""
+        self.clear(namespaces)
+
+
+class NodeCache(BaseCache):
+    def __init__(self, backend: BaseCache):
+        """
+        Node cache that reports hits and misses and never stores failures
+
+        Lookups are recorded per node in the metrics registry and in the
+        active request's breakdown. A node result that set "error" is not
+        cached, so a failed weather call or retrieval is retried next time.
+
+        Args:
+            backend: Cache that holds the values (LRUCache or SQLiteCache)
+        """
+        super().__init__(serde=backend.serde)
+        self.backend = backend
+
+    def get(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Get cached node results, recording a hit or miss per node"""
+        values = self.backend.get(keys)
+        for namespace, key in keys:
+            # LangGraph namespaces node results as (..., node name)
+            metrics.record_cache(namespace[-1], (tuple(namespace), key) in values)
+        return values
+
+    async def aget(self, keys: Sequence[FullKey]) -> Dict[FullKey, object]:
+        """Asynchronously get cached node results"""
+        return self.get(keys)
+
+    def set(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Store node results that completed without an error"""
+        pairs = {
+            full_key: (writes, ttl)
+            for full_key, (writes, ttl) in pairs.items()
+            if not any(channel == "error" and value for channel, value in writes)
+        }
+        if not pairs:
+            return
+        try:
+            self.backend.set(pairs)
+        except Exception as e:
+            # A result that can't be cached is simply recomputed next time
+            logger.warning("node_cache_set_failed error=%s", e)
+
+    async def aset(self, pairs: Mapping[FullKey, Tuple[object, Optional[int]]]) -> None:
+        """Asynchronously store node results"""
+        self.set(pairs)
+
+    def clear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Delete cached node results"""
+        self.backend.clear(namespaces)
+
+    async def aclear(self, namespaces: Optional[Sequence[Namespace]] = None) -> None:
+        """Asynchronously delete cached node results"""
+        self.clear(namespaces)
+
+
+def from_env() -> Optional[NodeCache]:
+    """
+    Build the node cache configured by the environment
+
+    AGENT_NODE_CACHE selects the storage: "memory" (default, at most
+    AGENT_NODE_CACHE_SIZE entries), "sqlite" (file from
+    AGENT_NODE_CACHE_PATH, default node_cache.db) or "off".
+
+    Returns:
+        NodeCache, or None when caching is off
+    """
+    backend = os.getenv("AGENT_NODE_CACHE", "memory").lower()
+    if backend in ("off", "none", "0", "false"):
+        return None
+    if backend == "sqlite":
+        return NodeCache(SQLiteCache(os.getenv("AGENT_NODE_CACHE_PATH", "node_cache.db")))
+    if backend == "memory":
+        return NodeCache(LRUCache())
+    raise ValueError(f"Unknown AGENT_NODE_CACHE backend: {backend}")
@@ -0,0 +1,200 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Profile collecting samples for whichever request is active in this context
+_current_profile: ContextVar[Optional["Profile"]] = ContextVar("current_profile", default=None)
+
+
+def _frame_label(frame) -> str:
+    """
+    Describe a stack frame as "function (path:line)"
+
+    Library frames are shown relative to site-packages so LangChain,
+    Qdrant, flashrank and pypdf code is easy to tell apart from ours.
+    """
+    code = frame.f_code
+    filename = code.co_filename
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        filename = filename.split(marker, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class Profile:
+    def __init__(self, name: str, interval_ms: float = 5.0, max_samples: int = 20000):
+        """
+        Sampling profiler for a single request
+
+        A background thread periodically captures the stacks of the threads
+        registered with the profile and counts identical stacks.
+
+        Args:
+            name: Label used in the output file name
+            interval_ms: Time between samples
+            max_samples: Sampling stops after this many samples to bound memory
+        """
+        self.name = name
+        self.interval = max(interval_ms, 1.0) / 1000
+        self.max_samples = max_samples
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.path: Optional[str] = None
+        self._threads = {threading.get_ident()}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name=f"profiler-{name}", daemon=True)
+
+    def add_thread(self, thread_id: int):
+        """
+        Include another thread's stacks in this profile
+
+        Args:
+            thread_id: threading.get_ident() of the thread
+        """
+        self._threads.add(thread_id)
+
+    def _sample(self):
+        """Record the current stack of every registered thread"""
+        frames = sys._current_frames()
+        for thread_id in list(self._threads):
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval) and self.samples < self.max_samples:
+            self._sample()
+
+    def start(self):
+        """Start sampling"""
+        self._sampler.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread"""
+        self._stop.set()
+        self._sampler.join()
+
+    def collapsed(self) -> List[str]:
+        """
+        Render samples in collapsed-stack format
+
+        Returns:
+            Lines of "root;caller;callee count", as read by flamegraph.pl and speedscope
+        """
+        return [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+
+    def write(self, output_dir: str) -> str:
+        """
+        Write the collapsed stacks to a new file
+
+        Args:
+            output_dir: Directory for profile files
+
+        Returns:
+            Path of the written file
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{self.name}_{uuid.uuid4().hex[:8]}.collapsed"
+        self.path = os.path.join(output_dir, filename)
+        with open(self.path, "w") as f:
+            f.write("\n".join(self.collapsed()) + "\n")
+        return self.path
+
+
+def register_thread():
+    """Include the calling thread in the active profile, if any"""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_thread(threading.get_ident())
+
+
+class Profiler:
+    def __init__(self, sample_rate: float = 0.0, output_dir: str = "profiles", interval_ms: float = 5.0):
+        """
+        Opt-in per-request profiling
+
+        Args:
+            sample_rate: Fraction of calls profiled when not forced (0 disables)
+            output_dir: Directory profile files are written to
+            interval_ms: Time between stack samples
+        """
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.interval_ms = interval_ms
+
+    @classmethod
+    def from_env(cls) -> "Profiler":
+        """
+        Create a profiler configured by AGENT_PROFILE_RATE, AGENT_PROFILE_DIR
+        and AGENT_PROFILE_INTERVAL_MS
+
+        Returns:
+            Profiler instance
+        """
+        return cls(
+            sample_rate=float(os.getenv("AGENT_PROFILE_RATE", "0")),
+            output_dir=os.getenv("AGENT_PROFILE_DIR", "profiles"),
+            interval_ms=float(os.getenv("AGENT_PROFILE_INTERVAL_MS", "5"))
+        )
+
+    def should_profile(self, force: Optional[bool] = None) -> bool:
+        """
+        Decide whether to profile a call
+
+        Args:
+            force: True to always profile, False to never, None to sample at sample_rate
+
+        Returns:
+            True if the call should be profiled
+        """
+        if force is not None:
+            return force
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, name: str, force: Optional[bool] = None):
+        """
+        Profile a block and write its collapsed stacks when it finishes
+
+        Args:
+            name: Label for the output file, e.g. "agent_run"
+            force: True to always profile, False to never, None to sample
+
+        Yields:
+            The Profile (its path is set once the block exits), or None when not profiling
+        """
+        if not self.should_profile(force):
+            yield None
+            return
+
+        profile = Profile(name, interval_ms=self.interval_ms)
+        token = _current_profile.set(profile)
+        profile.start()
+        try:
+            yield profile
+        finally:
+            profile.stop()
+            _current_profile.reset(token)
+            try:
+                profile.write(self.output_dir)
+                logger.info("profile_written name=%s samples=%d path=%s", name, profile.samples, profile.path)
+            except OSError as e:
+                logger.warning("profile_write_failed name=%s error=%s", name, e)
@@ -1,27 +1,100 @@
 import os
-from typing import List, Dict
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
 
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_qdrant import QdrantVectorStore
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
 from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
 
+from clients import get_chat_model, get_embeddings
+from database import ChatDatabase
+from resilience import CircuitBreaker, Hedger
+from scheduler import BACKGROUND, ScheduledEmbeddings, get_scheduler, priority
+import deadline
+import metrics
+import profiling
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+NO_PDF_ANSWER = "No PDF loaded. Please upload a PDF first."
+
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a helpful assistant. Use the following context to answer the question. If the context doesn't contain relevant information, say so."),
+    ("system", "Context: {context}"),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}")
+])
+
 
 class RAGTool:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings()
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.7)
-        self.client = QdrantClient(url="http://localhost:6333")
-        self.vectorstore = None
-        self.current_pdf_name = None
-        self.current_collection_name = None
+    def __init__(self, llm=None, embeddings=None, client: QdrantClient = None,
+                 profiler: profiling.Profiler = None, db_name: str = None, cassette=None,
+                 model_breaker: CircuitBreaker = None):
+        """
+        Retrieval over per-PDF Qdrant collections
+        
+        The tool holds no per-session state: the PDF to search is passed to
+        every query, so a single instance can serve concurrent sessions.
+        
+        Qdrant, embedding and chat calls each go through their own circuit
+        breaker, so an outage fails queries at once instead of after a
+        timeout. Vector searches can also be hedged (QDRANT_HEDGE_PERCENTILE).
+        
+        Args:
+            llm: Chat model (defaults to the shared gpt-4o-mini client)
+            embeddings: Embeddings client (defaults to the shared OpenAI client)
+            client: Qdrant client (defaults to a local server on port 6333)
+            profiler: Ingestion profiler (defaults to one configured from the environment)
+            db_name: SQLite file ingestion token usage is recorded in (None to not record it)
+            cassette: Cassette that records or replays the model and Qdrant calls;
+                when replaying, no real clients are created
+            model_breaker: Circuit breaker for chat model calls, to share one
+                with other users of the same model API (defaults to a new
+                one named "chat")
+        """
+        self.cassette = cassette
+        if cassette is None or cassette.recording:
+            llm = llm or get_chat_model(temperature=0.7)
+            embeddings = embeddings or get_embeddings()
+            client = client or QdrantClient(url="http://localhost:6333")
+        if cassette is not None:
+            llm = cassette.chat_model(llm)
+            embeddings = cassette.embeddings(embeddings)
+            client = cassette.qdrant_client(client)
+        self.qdrant_breaker = CircuitBreaker.from_env("qdrant")
+        self.qdrant_hedger = Hedger.from_env("qdrant")
+        self.model_breaker = model_breaker or CircuitBreaker.from_env("chat", excluded=(deadline.DeadlineExceeded,))
+        self.embeddings = ScheduledEmbeddings(
+            embeddings, get_scheduler("embeddings"), breaker=CircuitBreaker.from_env("embeddings")
+        )
+        self.llm = llm
+        admit = get_scheduler("chat").gate()
+        # Like the agent's chains, answer generation times out no later than
+        # the request's deadline
+        self.qa_chain = QA_PROMPT | admit | self.model_breaker.guard(deadline.bounded(self.llm)) | StrOutputParser()
+        self.client = client
+        self.profiler = profiler or profiling.Profiler.from_env()
+        self.db_name = db_name
+        self.embedding_cache_size = 1024
+        self._query_embeddings = OrderedDict()
+        self._embedding_lock = threading.Lock()
+        self._ranker = None
+        self._ranker_lock = threading.Lock()
+        self._vectorstores: Dict[str, QdrantVectorStore] = {}
+        self._ingest_ids: Dict[str, str] = {}
+        self._vectorstore_lock = threading.Lock()
+        self._ingest_lock = threading.Lock()
     
     def _sanitize_collection_name(self, pdf_name: str) -> str:
         """
@@ -41,101 +114,271 @@ class RAGTool:
         name = f"pdf_{name[:50]}"
         return name.lower()
     
-    def load_pdf(self, pdf_path: str) -> bool:
+    def _collection_exists(self, collection_name: str) -> bool:
+        """
+        Check whether a Qdrant collection exists
+        
+        Args:
+            collection_name: Collection to look for
+            
+        Returns:
+            True if it exists
+        """
+        collections = self.qdrant_breaker.call(self.client.get_collections).collections
+        return collection_name in [col.name for col in collections]
+    
+    def _get_vectorstore(self, pdf_name: str) -> Optional[QdrantVectorStore]:
+        """
+        Get the vector store for a PDF's collection
+        
+        Vector store handles are cached per collection and shared by all
+        sessions; they are read-only wrappers around the shared client.
+        
+        Args:
+            pdf_name: Name of the PDF file
+            
+        Returns:
+            Vector store, or None if the PDF has not been loaded
+        """
+        if not pdf_name:
+            return None
+        
+        collection_name = self._sanitize_collection_name(pdf_name)
+        with self._vectorstore_lock:
+            vectorstore = self._vectorstores.get(collection_name)
+        if vectorstore is not None:
+            return vectorstore
+        
+        if not self._collection_exists(collection_name):
+            return None
+        
+        return self._register_vectorstore(collection_name)
+    
+    def _register_vectorstore(self, collection_name: str) -> QdrantVectorStore:
+        """
+        Create and cache the vector store handle for a collection
+        
+        Args:
+            collection_name: Existing Qdrant collection
+            
+        Returns:
+            Cached vector store
+        """
+        vectorstore = QdrantVectorStore(
+            client=self.client,
+            collection_name=collection_name,
+            embedding=self.embeddings
+        )
+        with self._vectorstore_lock:
+            return self._vectorstores.setdefault(collection_name, vectorstore)
+    
+    def load_pdf(self, pdf_path: str, replace: bool = False, profile: bool = None) -> bool:
         """
         Load and process PDF into its own vector store collection
         
         Args:
             pdf_path: Path to PDF file
+            replace: Re-ingest the PDF even if its collection already exists
+            profile: True to profile the ingestion, False to never profile it,
+                None to sample at AGENT_PROFILE_RATE
             
         Returns:
             True if successful, False otherwise
         """
+        if self.cassette is not None:
+            self.cassette.log("load_pdf", pdf_path=pdf_path, replace=replace)
+        with self.profiler.profile("load_pdf", force=profile), metrics.request_scope() as breakdown:
+            loaded = self._load_pdf(pdf_path, replace)
+        self._record_ingest_usage(os.path.basename(pdf_path), breakdown["model_calls"])
+        return loaded
+    
+    def _record_ingest_usage(self, pdf_name: str, calls: List[Dict]):
+        """
+        Attribute the embedding calls of an ingestion to its PDF
+        
+        Args:
+            pdf_name: Name of the ingested PDF
+            calls: Priced model calls made while ingesting
+        """
+        if not self.db_name or not calls:
+            return
+        try:
+            ChatDatabase(self.db_name).insert_usage([{**call, "pdf_name": pdf_name} for call in calls])
+        except Exception as e:
+            logger.warning("ingest_usage_not_recorded pdf=%s error=%s", pdf_name, e)
+    
+    def _load_pdf(self, pdf_path: str, replace: bool) -> bool:
+        """Ingest a PDF; see load_pdf"""
         try:
             pdf_name = os.path.basename(pdf_path)
             collection_name = self._sanitize_collection_name(pdf_name)
             
-            # Check if collection already exists
-            collections = self.client.get_collections().collections
-            collection_names = [col.name for col in collections]
-            
-            if collection_name not in collection_names:
-                print(f"📦 Creating new collection: {collection_name}")
-                
-                # Create collection
-                self.client.create_collection(
-                    collection_name=collection_name,
-                    vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
-                )
-                
-                # Load PDF
-                loader = PyPDFLoader(pdf_path)
-                documents = loader.load()
-                
-                # Split into chunks
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=1000,
-                    chunk_overlap=200,
-                    length_function=len
-                )
-                splits = text_splitter.split_documents(documents)
-                
-                # Store in Qdrant
-                QdrantVectorStore.from_documents(
-                    documents=splits,
-                    embedding=self.embeddings,
-                    url="http://localhost:6333",
-                    collection_name=collection_name
-                )
+            # Serialize ingestion so two sessions can't create the same collection;
+            # its embedding calls yield to interactive queries
+            with self._ingest_lock, priority(BACKGROUND):
+                if replace and self._collection_exists(collection_name):
+                    print(f"♻️ Replacing collection: {collection_name}")
+                    self.qdrant_breaker.call(self.client.delete_collection, collection_name)
+                    with self._vectorstore_lock:
+                        self._vectorstores.pop(collection_name, None)
                 
-                print(f"✅ Loaded {len(splits)} chunks into collection: {collection_name}")
-            else:
-                print(f"📚 Collection already exists: {collection_name}")
-            
-            # Switch to this collection
-            self.vectorstore = QdrantVectorStore(
-                client=self.client,
-                collection_name=collection_name,
-                embedding=self.embeddings
-            )
-            
-            self.current_pdf_name = pdf_name
-            self.current_collection_name = collection_name
+                if not self._collection_exists(collection_name):
+                    print(f"📦 Creating new collection: {collection_name}")
+                    
+                    # Create collection
+                    self.qdrant_breaker.call(
+                        self.client.create_collection,
+                        collection_name=collection_name,
+                        vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
+                    )
+                    
+                    # Load PDF
+                    loader = PyPDFLoader(pdf_path)
+                    documents = loader.load()
+                    
+                    # Split into chunks
+                    text_splitter = RecursiveCharacterTextSplitter(
+                        chunk_size=1000,
+                        chunk_overlap=200,
+                        length_function=len
+                    )
+                    splits = text_splitter.split_documents(documents)
+                    
+                    # Tag every chunk with this ingestion so cached retrievals
+                    # from an earlier version of the collection never match
+                    ingest_id = uuid.uuid4().hex
+                    for split in splits:
+                        split.metadata["ingest_id"] = ingest_id
+                    
+                    # Store in Qdrant through the shared client
+                    self._register_vectorstore(collection_name).add_documents(splits)
+                    with self._vectorstore_lock:
+                        self._ingest_ids[collection_name] = ingest_id
+                    
+                    print(f"✅ Loaded {len(splits)} chunks into collection: {collection_name}")
+                else:
+                    print(f"📚 Collection already exists: {collection_name}")
             
+            self._register_vectorstore(collection_name)
             return True
             
         except Exception as e:
             print(f"❌ Error loading PDF: {str(e)}")
             return False
     
-    def switch_to_pdf(self, pdf_name: str) -> bool:
+    def has_pdf(self, pdf_name: str) -> bool:
         """
-        Switch to an existing PDF's collection
+        Check whether a PDF's collection is available for querying
         
         Args:
             pdf_name: Name of the PDF file
             
         Returns:
-            True if collection exists and switched, False otherwise
+            True if the collection exists, False otherwise
         """
-        collection_name = self._sanitize_collection_name(pdf_name)
+        return self._get_vectorstore(pdf_name) is not None
+    
+    def ingest_id(self, pdf_name: str) -> str:
+        """
+        Identify the current ingestion of a PDF's collection
+        
+        Changes whenever the PDF is re-ingested, so it can be used to
+        version anything derived from the collection's contents.
+        
+        Args:
+            pdf_name: Name of the PDF file
+            
+        Returns:
+            Ingestion id, or "" if unknown (not loaded, or ingested before ids were recorded)
+        """
+        if not pdf_name:
+            return ""
         
-        collections = self.client.get_collections().collections
-        collection_names = [col.name for col in collections]
+        collection_name = self._sanitize_collection_name(pdf_name)
+        with self._vectorstore_lock:
+            ingest_id = self._ingest_ids.get(collection_name)
+        if ingest_id is not None:
+            return ingest_id
         
-        if collection_name in collection_names:
-            self.vectorstore = QdrantVectorStore(
-                client=self.client,
-                collection_name=collection_name,
-                embedding=self.embeddings
+        ingest_id = ""
+        if self._collection_exists(collection_name):
+            points, _ = self.qdrant_breaker.call(
+                self.client.scroll, collection_name, limit=1, with_payload=True, with_vectors=False
             )
-            self.current_pdf_name = pdf_name
-            self.current_collection_name = collection_name
-            print(f"🔄 Switched to collection: {collection_name}")
-            return True
-        else:
-            print(f"⚠️ Collection not found: {collection_name}")
-            return False
+            if points:
+                ingest_id = (points[0].payload or {}).get("metadata", {}).get("ingest_id", "")
+        with self._vectorstore_lock:
+            return self._ingest_ids.setdefault(collection_name, ingest_id)
+    
+    def _cached_query_embedding(self, question: str) -> Optional[List[float]]:
+        """
+        Look up a previously computed embedding for a question
+        
+        Args:
+            question: User question
+            
+        Returns:
+            Embedding vector, or None if it hasn't been computed yet
+        """
+        with self._embedding_lock:
+            vector = self._query_embeddings.get(question)
+            if vector is not None:
+                self._query_embeddings.move_to_end(question)
+            return vector
+    
+    def _store_query_embeddings(self, questions: List[str], vectors: List[List[float]]):
+        """
+        Add question embeddings to the LRU cache
+        
+        Args:
+            questions: Embedded questions
+            vectors: Their embedding vectors
+        """
+        with self._embedding_lock:
+            for question, vector in zip(questions, vectors):
+                self._query_embeddings[question] = vector
+                self._query_embeddings.move_to_end(question)
+            while len(self._query_embeddings) > self.embedding_cache_size:
+                self._query_embeddings.popitem(last=False)
+    
+    def embed_queries(self, questions: List[str]) -> List[List[float]]:
+        """
+        Embed several questions with a single embeddings request
+        
+        Vectors are kept in a bounded LRU cache so that later calls to
+        query() for the same questions skip the embedding round trip.
+        
+        Args:
+            questions: Questions to embed
+            
+        Returns:
+            Embedding vectors in the same order as the questions
+        """
+        missing = []
+        for question in questions:
+            if self._cached_query_embedding(question) is None and question not in missing:
+                missing.append(question)
+        
+        if missing:
+            with metrics.timer("rag.embed_batch"):
+                vectors = self.embeddings.embed_documents(missing)
+            self._store_query_embeddings(missing, vectors)
+        
+        return [self._cached_query_embedding(question) for question in questions]
+    
+    def _get_ranker(self):
+        """
+        Get the shared Flashrank ranker, loading the model on first use
+        
+        Returns:
+            Ranker instance
+        """
+        from flashrank import Ranker
+        
+        with self._ranker_lock:
+            if self._ranker is None:
+                self._ranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2")
+            return self._ranker
     
     def _rerank_documents(self, query: str, documents: List) -> List:
         """
@@ -148,91 +391,132 @@ class RAGTool:
         Returns:
             Reranked documents (top 3)
         """
-        from flashrank import Ranker, RerankRequest
+        from flashrank import RerankRequest
         
-        ranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2")
+        ranker = self._get_ranker()
         
         passages = [{"id": i, "text": doc.page_content} for i, doc in enumerate(documents)]
         
         rerank_request = RerankRequest(query=query, passages=passages)
         results = ranker.rerank(rerank_request)
 
-        print("\n--- Reranking Scores ---")
-        for result in results[:5]:
-            print(f"Doc {result['id']}: Score = {result['score']:.4f}")
+        if logger.isEnabledFor(logging.DEBUG):
+            scores = " ".join(f"{result['id']}:{result['score']:.4f}" for result in results[:5])
+            logger.debug("reranked scores=%s", scores)
         
         top_indices = [result['id'] for result in results[:3]]
         
         return [documents[i] for i in top_indices]
     
-    def query(self, question: str, chat_history: List = None) -> Dict:
+    def retrieve(self, question: str, pdf_name: str, k: int = 5, rerank: bool = True) -> Optional[List]:
         """
-        Answer question using RAG with reranking
+        Find the chunks of a PDF most relevant to a question
+        
+        Args:
+            question: User question
+            pdf_name: Name of the PDF to search
+            k: Number of chunks to retrieve
+            rerank: Rerank the retrieved chunks (otherwise the top 3 by vector score are used)
+            
+        Returns:
+            Up to 3 documents, or None if the PDF has not been loaded
+        """
+        vectorstore = self._get_vectorstore(pdf_name)
+        if not vectorstore:
+            return None
+        
+        # Reuse a batch-computed embedding if we have one
+        query_vector = self._cached_query_embedding(question)
+        if query_vector is None:
+            with metrics.timer("rag.embed"):
+                query_vector = self.embeddings.embed_query(question)
+            self._store_query_embeddings([question], [query_vector])
+        
+        with metrics.timer("rag.vector_search"):
+            docs = self.qdrant_breaker.call(
+                self.qdrant_hedger.call, vectorstore.similarity_search_by_vector, query_vector, k=k
+            )
+        
+        logger.debug("retrieved documents=%d collection=%s", len(docs), vectorstore.collection_name)
+        
+        if not docs:
+            return []
+        
+        # Rerank documents
+        if rerank:
+            with metrics.timer("rag.rerank"):
+                return self._rerank_documents(question, docs)
+        return docs[:3]
+    
+    def answer(self, question: str, documents: List, chat_history: List = None) -> Dict:
+        """
+        Generate an answer from retrieved documents
         
         Args:
             question: User question
+            documents: Documents returned by retrieve()
             chat_history: List of previous messages
             
         Returns:
             Dict with answer and sources
         """
-        if not self.vectorstore:
+        if not documents:
             return {
-                "answer": "No PDF loaded. Please upload a PDF first.",
+                "answer": "No relevant information found in the document.",
                 "sources": []
             }
         
-        if chat_history is None:
-            chat_history = []
+        # Create context
+        context = "\n\n".join([doc.page_content for doc in documents])
         
-        try:
-            # Direct retrieval
-            retriever = self.vectorstore.as_retriever(search_kwargs={"k": 5})
-            docs = retriever.invoke(question)
-            
-            print(f"\n--- Retrieved {len(docs)} documents from {self.current_collection_name} ---")
+        # Generate answer
+        with metrics.timer("llm.rag_answer"):
+            answer = self.qa_chain.invoke(
+                {
+                    "input": question,
+                    "context": context,
+                    "chat_history": chat_history or []
+                },
+                config=metrics.llm_config("llm.rag_answer")
+            )
+        
+        return {
+            "answer": answer,
+            "sources": [
+                {
+                    "content": doc.page_content[:200] + "...",
+                    "metadata": doc.metadata
+                }
+                for doc in documents
+            ]
+        }
+    
+    def query(self, question: str, chat_history: List = None, pdf_name: str = None,
+              k: int = 5, rerank: bool = True) -> Dict:
+        """
+        Answer question using RAG with reranking
+        
+        Args:
+            question: User question
+            chat_history: List of previous messages
+            pdf_name: Name of the PDF to answer from
+            k: Number of chunks to retrieve
+            rerank: Rerank the retrieved chunks (otherwise the top 3 by vector score are used)
             
-            if not docs:
+        Returns:
+            Dict with answer and sources
+        """
+        try:
+            documents = self.retrieve(question, pdf_name, k=k, rerank=rerank)
+            if documents is None:
                 return {
-                    "answer": "No relevant information found in the document.",
+                    "answer": NO_PDF_ANSWER,
                     "sources": []
                 }
-            
-            # Rerank documents
-            reranked_docs = self._rerank_documents(question, docs)
-            
-            # Create context
-            context = "\n\n".join([doc.page_content for doc in reranked_docs])
-            
-            # Create QA prompt
-            qa_prompt = ChatPromptTemplate.from_messages([
-                ("system", "You are a helpful assistant. Use the following context to answer the question. If the context doesn't contain relevant information, say so."),
-                ("system", "Context: {context}"),
-                MessagesPlaceholder("chat_history"),
-                ("human", "{input}")
-            ])
-            
-            # Generate answer
-            chain = qa_prompt | self.llm | StrOutputParser()
-            answer = chain.invoke({
-                "input": question,
-                "context": context,
-                "chat_history": chat_history
-            })
-            
-            return {
-                "answer": answer,
-                "sources": [
-                    {
-                        "content": doc.page_content[:200] + "...",
-                        "metadata": doc.metadata
-                    }
-                    for doc in reranked_docs
-                ]
-            }
+            return self.answer(question, documents, chat_history)
             
         except Exception as e:
-            print(f"❌ Query error: {str(e)}")
+            logger.error("query_failed error=%s", e)
             return {
                 "answer": f"Error processing query: {str(e)}",
                 "sources": []
@@ -246,7 +530,7 @@ if __name__ == "__main__":
     pdf_path = "sample.pdf"
     if os.path.exists(pdf_path):
         rag.load_pdf(pdf_path)
-        result = rag.query("What is this document about?")
+        result = rag.query("What is this document about?", pdf_name=os.path.basename(pdf_path))
         print(f"\nAnswer: {result['answer']}")
     else:
         print(f"PDF not found: {pdf_path}")
\ No newline at end of file
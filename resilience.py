@@ -0,0 +1,359 @@
+"""
+Circuit breakers and hedged requests for calls to external services
+"""
+
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional, Tuple, Type
+
+from langchain_core.runnables import RunnableLambda
+
+import deadline
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open"""
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    """HTTP status of an error response (OpenAI, Qdrant, httpx or requests errors), if it has one"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 half_open_max_calls: int = 1, excluded: Tuple[Type[BaseException], ...] = ()):
+        """
+        Fail fast while a dependency is unhealthy
+
+        The circuit opens after failure_threshold consecutive failures. Only
+        errors that point at the dependency count: client errors other than
+        429 and errors raised after the caller's own deadline has passed are
+        ignored, as are the excluded types. While it is open, calls raise
+        CircuitOpenError straight away instead of waiting for the
+        dependency's timeout. After recovery_timeout seconds it lets a few
+        probe calls through (half-open): a successful probe closes it again,
+        a failed one reopens it for another recovery_timeout.
+
+        Args:
+            name: Dependency name, used in metrics and logs
+            failure_threshold: Consecutive failures that open the circuit (0 disables it)
+            recovery_timeout: Seconds the circuit stays open before probing
+            half_open_max_calls: Probe calls allowed at once while half-open
+            excluded: Exception types that say nothing about the dependency's
+                health (unknown city, deadline passed); they count as neither
+                successes nor failures
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.excluded = excluded
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name: str, excluded: Tuple[Type[BaseException], ...] = ()) -> "CircuitBreaker":
+        """
+        Create a breaker configured by CIRCUIT_FAILURE_THRESHOLD (default 5;
+        0 disables circuit breaking) and CIRCUIT_RECOVERY_SECONDS (default 30)
+
+        Args:
+            name: Dependency name
+            excluded: Exception types that don't count as failures
+
+        Returns:
+            CircuitBreaker instance
+        """
+        return cls(
+            name,
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            recovery_timeout=float(os.getenv("CIRCUIT_RECOVERY_SECONDS", "30")),
+            excluded=excluded
+        )
+
+    @property
+    def state(self) -> str:
+        """Current state: closed, open or half_open"""
+        with self._lock:
+            self._check_recovery(time.monotonic())
+            return self._state
+
+    def _transition(self, state: str):
+        """Move to a new state; the caller holds the lock"""
+        self._state = state
+        self._probes = 0
+        metrics.registry.increment("circuit_state_changes_total", circuit=self.name, state=state)
+        if state == OPEN:
+            logger.warning("circuit_opened circuit=%s failures=%d", self.name, self.failures)
+        else:
+            logger.info("circuit_%s circuit=%s", state, self.name)
+
+    def _check_recovery(self, now: float):
+        """Let probes through once the open circuit has cooled down; the caller holds the lock"""
+        if self._state == OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._transition(HALF_OPEN)
+
+    def allow(self):
+        """
+        Get permission for one call
+
+        Every allowed call must be followed by record_success or record_failure.
+
+        Raises:
+            CircuitOpenError: The circuit is open, or half-open with its probes in flight
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._check_recovery(now)
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+            retry_in = max(0.0, self.recovery_timeout - (now - self._opened_at))
+
+        metrics.registry.increment("circuit_rejections_total", circuit=self.name)
+        tracing.add_attributes(circuit_open=self.name)
+        raise CircuitOpenError(f"{self.name} is unavailable (circuit open, retrying in {retry_in:.0f}s)")
+
+    def record_success(self):
+        """Record a successful call, closing a half-open circuit"""
+        with self._lock:
+            self.failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        """Record a failed call, opening the circuit once there are enough in a row"""
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def _is_failure(self, error: BaseException) -> bool:
+        """Whether an error says the dependency is unhealthy"""
+        if isinstance(error, self.excluded):
+            return False
+        status = _status_code(error)
+        if status is not None and 400 <= status < 500 and status != 429:
+            # The request was rejected (bad key, bad input), not the service failing
+            return False
+        left = deadline.remaining()
+        if left is not None and left <= 0:
+            # The caller's budget ran out: its timeout was cut short by the
+            # deadline, not by the dependency's usual latency
+            return False
+        return True
+
+    def _record(self, error: Optional[BaseException]):
+        """Record a call's outcome, ignoring errors that aren't the dependency's fault"""
+        if self.failure_threshold <= 0:
+            return
+        if error is None:
+            self.record_success()
+        elif not self._is_failure(error):
+            # Neither a success nor a failure; free the probe slot it may hold
+            with self._lock:
+                if self._state == HALF_OPEN and self._probes > 0:
+                    self._probes -= 1
+        else:
+            self.record_failure()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn through the breaker
+
+        Args:
+            fn: Function that calls the dependency
+            *args, **kwargs: Passed to fn
+
+        Returns:
+            fn's result
+
+        Raises:
+            CircuitOpenError: The circuit is open
+        """
+        self.allow()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record(None)
+        return result
+
+    async def acall(self, fn, *args, **kwargs):
+        """Await the coroutine function fn through the breaker (see call)"""
+        self.allow()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record(None)
+        return result
+
+    def guard(self, runnable) -> RunnableLambda:
+        """
+        Wrap a chat model (or any runnable) so its calls go through the breaker
+
+        Use in place of the model in a chain: `prompt | gate | breaker.guard(llm) | parser`.
+
+        Args:
+            runnable: Runnable to protect
+
+        Returns:
+            Runnable that invokes the wrapped one through the breaker
+        """
+        def call(value, config):
+            return self.call(runnable.invoke, value, config=config)
+
+        return RunnableLambda(call, name=f"circuit_{self.name}")
+
+
+class Hedger:
+    def __init__(self, name: str, percentile: Optional[float] = None, min_samples: int = 20,
+                 window: int = 200, max_workers: int = 16):
+        """
+        Cut tail latency by sending a duplicate of a slow request
+
+        When a call hasn't finished after the given percentile of recent
+        successful call latencies, the same call is started again and
+        whichever finishes first wins; the other is left to complete in
+        the background. Only use it for idempotent reads: a hedged call
+        may run twice.
+
+        Args:
+            name: Dependency name, used in metrics
+            percentile: Latency percentile (0-100) after which to hedge; None
+                or 0 disables hedging and calls run in the caller's thread
+            min_samples: Successful calls observed before hedging starts
+            window: Recent latencies the percentile is computed over
+            max_workers: Threads running hedged calls
+        """
+        self.name = name
+        self.percentile = percentile or None
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def from_env(cls, name: str) -> "Hedger":
+        """
+        Create a hedger configured by <NAME>_HEDGE_PERCENTILE, e.g.
+        WEATHER_HEDGE_PERCENTILE=95 (default 0, hedging off)
+
+        Args:
+            name: Dependency name
+
+        Returns:
+            Hedger instance
+        """
+        return cls(name, percentile=float(os.getenv(f"{name.upper()}_HEDGE_PERCENTILE", "0")))
+
+    def _observe(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """
+        Seconds to wait before hedging a call
+
+        Returns:
+            The configured percentile of recent latencies, or None while
+            hedging is off or too few calls have been observed
+        """
+        if self.percentile is None:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, max(0, math.ceil(self.percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix=f"hedge-{self.name}"
+                )
+            return self._executor
+
+    def _timed(self, fn, args, kwargs):
+        """Run fn, recording its latency when it succeeds"""
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        self._observe(time.monotonic() - start)
+        return result
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn, hedging it if it is slower than usual
+
+        Args:
+            fn: Function that calls the dependency
+            *args, **kwargs: Passed to fn
+
+        Returns:
+            Result of whichever attempt succeeded first
+
+        Raises:
+            Exception: The error of the last attempt, if every attempt failed
+        """
+        hedge_after = self.delay()
+        if hedge_after is None:
+            return self._timed(fn, args, kwargs)
+
+        executor = self._get_executor()
+        # Each attempt runs in a copy of the caller's context, so deadlines
+        # and request metrics carry over to the worker threads
+        primary = executor.submit(contextvars.copy_context().run, self._timed, fn, args, kwargs)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        metrics.registry.increment("hedged_requests_total", dependency=self.name)
+        hedge = executor.submit(contextvars.copy_context().run, self._timed, fn, args, kwargs)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    metrics.registry.increment("hedge_wins_total", dependency=self.name)
+                return result
+        raise error
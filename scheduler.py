@@ -0,0 +1,296 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+
+import deadline
+import metrics
+from resilience import CircuitBreaker
+
+
+# Lower numbers are admitted first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_current_priority: ContextVar[int] = ContextVar("model_call_priority", default=INTERACTIVE)
+
+# Rough size of a chat completion, reserved against the token budget up front
+COMPLETION_TOKEN_ESTIMATE = 256
+
+
+class AdmissionError(Exception):
+    """Raised when a model call is shed because it could not be admitted in time"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the token count of a text without a tokenizer
+
+    Args:
+        text: Prompt or document text
+
+    Returns:
+        Approximate number of tokens (about four characters per token)
+    """
+    return max(1, len(text) // 4)
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Run model calls in this block at the given priority
+
+    Args:
+        level: INTERACTIVE or BACKGROUND
+    """
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float = None):
+        """
+        Token bucket refilled continuously at a per-minute rate
+
+        Args:
+            per_minute: Refill rate per minute
+            capacity: Maximum burst size (defaults to one minute's worth)
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        """
+        Seconds until the bucket holds the given amount
+
+        Args:
+            amount: Tokens needed
+            now: Current monotonic time
+
+        Returns:
+            0.0 if available now, otherwise the wait in seconds
+        """
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float, now: float):
+        """
+        Remove tokens from the bucket
+
+        Args:
+            amount: Tokens to remove
+            now: Current monotonic time
+        """
+        self._refill(now)
+        self.tokens -= amount
+
+
+class ModelScheduler:
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float,
+                 max_queue_wait: float = 30.0, burst_seconds: float = 60.0):
+        """
+        Admission control for one model rate-limit budget
+
+        Calls queue in priority order (interactive before background, FIFO
+        within a priority) until both the request and token buckets can
+        cover them. A call that cannot be admitted within max_queue_wait
+        is shed with an AdmissionError instead of being sent to the API.
+
+        Args:
+            name: Budget name used in metrics and errors, e.g. "chat"
+            requests_per_minute: Request budget
+            tokens_per_minute: Token budget
+            max_queue_wait: Seconds a call may wait before it is shed
+            burst_seconds: How many seconds of budget may be spent at once
+        """
+        self.name = name
+        self.max_queue_wait = max_queue_wait
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute * burst_seconds / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute * burst_seconds / 60.0)
+        self._cond = threading.Condition()
+        self._waiters: List[tuple] = []
+        self._sequence = itertools.count()
+
+    def acquire(self, tokens: int = 1, priority: int = None, max_wait: float = None) -> float:
+        """
+        Wait until a model call fits in the budget, then reserve it
+
+        Args:
+            tokens: Estimated tokens the call will consume
+            priority: INTERACTIVE or BACKGROUND (defaults to the current context's)
+            max_wait: Override for max_queue_wait (always capped by the request deadline)
+
+        Returns:
+            Seconds spent queued
+
+        Raises:
+            AdmissionError: If the call could not be admitted before its deadline
+        """
+        if priority is None:
+            priority = _current_priority.get()
+        tokens = min(max(1, tokens), self.tokens.capacity)
+        max_wait = self.max_queue_wait if max_wait is None else max_wait
+        # Never queue past the request's own deadline
+        left = deadline.remaining()
+        if left is not None:
+            max_wait = max(0.0, min(max_wait, left))
+
+        start = time.monotonic()
+        expires = start + max_wait
+        entry = (priority, next(self._sequence))
+
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            # A new head may need to re-evaluate its wait
+            self._cond.notify_all()
+            try:
+                while True:
+                    now = time.monotonic()
+                    remaining = expires - now
+
+                    if self._waiters[0] == entry:
+                        wait = max(self.requests.time_until(1, now), self.tokens.time_until(tokens, now))
+                        if wait <= 0:
+                            self.requests.take(1, now)
+                            self.tokens.take(tokens, now)
+                            queued = now - start
+                            metrics.registry.observe(f"scheduler.{self.name}.queue_wait", queued * 1000)
+                            return queued
+                        if wait > remaining:
+                            # The budget won't recover in time; shed now rather than at the deadline
+                            self._shed(priority, now - start, max_wait)
+                        self._cond.wait(wait)
+                    else:
+                        if remaining <= 0:
+                            self._shed(priority, now - start, max_wait)
+                        self._cond.wait(remaining)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def _shed(self, priority: int, waited: float, max_wait: float):
+        """Count and raise a shed model call"""
+        level = "interactive" if priority == INTERACTIVE else "background"
+        metrics.registry.increment("model_calls_shed_total", budget=self.name, priority=level)
+        raise AdmissionError(
+            f"{self.name} model capacity exhausted: {level} call could not be admitted "
+            f"within {max_wait:.1f}s (waited {waited:.1f}s). Please try again shortly."
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls currently waiting"""
+        with self._cond:
+            return len(self._waiters)
+
+    def gate(self) -> RunnableLambda:
+        """
+        Build a chain step that admits the prompt before the model sees it
+
+        Use as `prompt | scheduler.gate() | llm | parser`.
+
+        Returns:
+            Runnable that passes its input through after acquiring budget
+        """
+        def admit(prompt_value):
+            text = prompt_value.to_string() if hasattr(prompt_value, "to_string") else str(prompt_value)
+            self.acquire(estimate_tokens(text) + COMPLETION_TOKEN_ESTIMATE)
+            return prompt_value
+
+        return RunnableLambda(admit, name=f"admit_{self.name}")
+
+
+class ScheduledEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, scheduler: ModelScheduler, breaker: CircuitBreaker = None):
+        """
+        Embeddings wrapper that admits every request through a scheduler
+        and records its token usage
+
+        The embeddings API doesn't report usage through LangChain, so the
+        same estimate that is reserved against the budget is recorded.
+
+        Args:
+            embeddings: Underlying embeddings client
+            scheduler: Scheduler holding the embedding budget
+            breaker: Circuit breaker the requests go through, if any
+        """
+        self.embeddings = embeddings
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.model = getattr(embeddings, "model", None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents once the batch is admitted"""
+        tokens = sum(estimate_tokens(text) for text in texts)
+        self.scheduler.acquire(tokens)
+        vectors = self._call(self.embeddings.embed_documents, texts)
+        metrics.record_tokens("embeddings", tokens, model=self.model)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query once it is admitted"""
+        tokens = estimate_tokens(text)
+        self.scheduler.acquire(tokens)
+        vector = self._call(self.embeddings.embed_query, text)
+        metrics.record_tokens("embeddings", tokens, model=self.model)
+        return vector
+
+    def _call(self, fn, *args):
+        """Call the embeddings API, through the breaker when there is one"""
+        if self.breaker is None:
+            return fn(*args)
+        return self.breaker.call(fn, *args)
+
+
+_schedulers: Dict[str, ModelScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+# Budgets per model family: (env prefix, default RPM, default TPM)
+_BUDGETS = {
+    "chat": ("CHAT", 500, 200000),
+    "embeddings": ("EMBEDDING", 3000, 1000000)
+}
+
+
+def get_scheduler(name: str) -> ModelScheduler:
+    """
+    Get the process-wide scheduler for a model budget
+
+    Limits come from <PREFIX>_RPM / <PREFIX>_TPM (CHAT_* or EMBEDDING_*) and
+    MODEL_QUEUE_DEADLINE, falling back to OpenAI's entry-tier limits.
+
+    Args:
+        name: "chat" or "embeddings"
+
+    Returns:
+        Shared ModelScheduler
+    """
+    with _schedulers_lock:
+        if name not in _schedulers:
+            prefix, default_rpm, default_tpm = _BUDGETS[name]
+            _schedulers[name] = ModelScheduler(
+                name,
+                requests_per_minute=float(os.getenv(f"{prefix}_RPM", default_rpm)),
+                tokens_per_minute=float(os.getenv(f"{prefix}_TPM", default_tpm)),
+                max_queue_wait=float(os.getenv("MODEL_QUEUE_DEADLINE", "30"))
+            )
+        return _schedulers[name]
@@ -0,0 +1,133 @@
+"""
+Unit tests for the offline benchmark harness
+Tests the fake backends and a small end-to-end benchmark run
+"""
+
+import json
+import pytest
+from unittest.mock import Mock
+import agent
+import bench
+import scheduler
+from benchmarks import pipeline
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings, FakeWeatherTool, write_sample_pdf
+
+
+class TestBench:
+    """Test suite for the benchmark harness"""
+
+    @pytest.fixture(autouse=True)
+    def restore_budgets(self, monkeypatch):
+        """Undo the harness's unthrottled budgets after each test"""
+        for name in ("CHAT_RPM", "CHAT_TPM", "EMBEDDING_RPM", "EMBEDDING_TPM"):
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        yield
+        scheduler._schedulers.clear()
+
+    def test_fake_chat_model_answers_pipeline_prompts(self):
+        """Test the fake model routes intent and city prompts sensibly"""
+        llm = FakeChatModel()
+
+        weather = (agent.INTENT_PROMPT | llm).invoke({"query": "Will it rain in Oslo?"})
+        document = (agent.INTENT_PROMPT | llm).invoke({"query": "Summarize the training data section"})
+        city = (agent.CITY_PROMPT | llm).invoke({"query": "What's the weather in New York?"})
+
+        assert weather.content == "weather"
+        assert document.content == "document"
+        assert city.content == "New York"
+        assert weather.usage_metadata["total_tokens"] > 0
+
+    def test_fake_embeddings_are_deterministic(self):
+        """Test identical texts get identical vectors of the collection size"""
+        embeddings = FakeEmbeddings(size=8)
+
+        first, second, other = embeddings.embed_documents(["a", "a", "b"])
+
+        assert first == second
+        assert first != other
+        assert len(first) == 8
+        assert embeddings.embed_query("a") == first
+
+    def test_fake_weather_tool_shape(self):
+        """Test fake weather data has the fields the pipeline formats"""
+        data = FakeWeatherTool().get_weather("Paris")
+
+        assert data["city"] == "Paris"
+        assert {"temperature", "feels_like", "humidity", "description", "wind_speed"} <= set(data)
+        assert FakeWeatherTool().get_weather("Paris") == data
+
+    def test_sample_pdf_is_readable(self, tmp_path):
+        """Test generated PDFs load with the same loader as real uploads"""
+        from langchain_community.document_loaders import PyPDFLoader
+
+        path = tmp_path / "sample.pdf"
+        write_sample_pdf(str(path), pages=2)
+
+        pages = PyPDFLoader(str(path)).load()
+        assert len(pages) == 2
+        assert len(pages[0].page_content) > 100
+
+    def test_summarize(self):
+        """Test percentile and throughput summary"""
+        summary = pipeline.summarize([float(i) for i in range(1, 101)], wall_seconds=2.0)
+
+        assert summary["count"] == 100
+        assert summary["p50_ms"] == 50.0
+        assert summary["p95_ms"] == 95.0
+        assert summary["requests_per_second"] == 50.0
+
+    def test_compare_flags_regressions(self):
+        """Test only p95 increases beyond the tolerance are reported"""
+        baseline = {"scenarios": {"weather_queries": {"p95_ms": 100.0}, "document_queries": {"p95_ms": 100.0}}}
+        current = {"scenarios": {"weather_queries": {"p95_ms": 150.0}, "document_queries": {"p95_ms": 105.0}}}
+
+        regressions = pipeline.compare(current, baseline, tolerance=0.1)
+
+        assert len(regressions) == 1
+        assert regressions[0].startswith("weather_queries")
+
+    def test_end_to_end_run_saves_json(self, tmp_path):
+        """Test a small run covers every scenario and writes its results"""
+        output = tmp_path / "results.json"
+
+        exit_code = bench.main(["--latency-ms", "0", "--queries", "4", "--concurrency", "2",
+                                "--documents", "1", "--pages", "2", "--output", str(output)])
+
+        assert exit_code == 0
+        results = json.loads(output.read_text())
+        assert set(results["scenarios"]) == {"ingestion", "document_queries", "weather_queries", "multi_city_weather_queries"}
+        assert results["scenarios"]["document_queries"]["count"] == 4
+        assert "rag.vector_search" in results["steps"]["document_queries"]
+        assert "weather.api" in results["steps"]["weather_queries"]
+
+    def test_replay_cassette(self, tmp_path):
+        """Test a recorded weather workload is replayed and summarized offline"""
+        from cassette import Cassette
+        from tracing import Tracer
+
+        path = str(tmp_path / "weather.cassette")
+        recorder = Cassette(path)
+        recorded = agent.AgentPipeline(
+            tracer=Tracer(enabled=False),
+            llm=FakeChatModel(),
+            weather_tool=FakeWeatherTool(),
+            rag_tool=Mock(),
+            db_name=str(tmp_path / "record.db"),
+            cassette=recorder
+        )
+        for city in ("Paris", "Oslo", "Lima"):
+            recorded.run(f"What's the weather in {city}?", "s1")
+        recorder.save()
+        output = tmp_path / "replay.json"
+
+        exit_code = bench.main(["--replay", path, "--latency-scale", "0", "--output", str(output)])
+
+        assert exit_code == 0
+        results = json.loads(output.read_text())
+        assert results["scenarios"]["replay_run"]["count"] == 3
+        assert "weather.api" in results["steps"]["replay"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
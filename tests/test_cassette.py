@@ -0,0 +1,167 @@
+"""
+Unit tests for the record/replay cassette
+Tests recording a workload against fake backends and replaying it offline
+"""
+
+import sys
+import time
+import pytest
+from unittest.mock import Mock
+import scheduler
+from agent import AgentPipeline
+from benchmarks.fakes import (
+    FakeChatModel, FakeEmbeddings, FakeRanker, FakeWeatherTool, in_memory_qdrant, write_sample_pdf
+)
+from cassette import REPLAY, Cassette, CassetteMiss, ReplayedError
+from rag import RAGTool
+from tracing import Tracer
+from weather import UnknownCityError, WeatherAPIError
+
+
+class TestCassette:
+    """Test suite for the cassette module"""
+
+    @pytest.fixture(autouse=True)
+    def fresh_schedulers(self):
+        """Don't share rate-limit budgets with other tests"""
+        scheduler._schedulers.clear()
+        yield
+        scheduler._schedulers.clear()
+
+    def build_pipeline(self, cassette, db_name, latency_ms=0.0):
+        """Build a pipeline on the cassette; fakes are only used when recording"""
+        fakes = cassette.recording
+        llm = FakeChatModel(latency_ms=latency_ms) if fakes else None
+        rag_tool = RAGTool(
+            llm=llm,
+            embeddings=FakeEmbeddings() if fakes else None,
+            client=in_memory_qdrant() if fakes else None,
+            cassette=cassette
+        )
+        rag_tool._ranker = FakeRanker()
+        return AgentPipeline(
+            tracer=Tracer(enabled=False),
+            llm=llm,
+            weather_tool=FakeWeatherTool(latency_ms=latency_ms) if fakes else None,
+            rag_tool=rag_tool,
+            db_name=db_name,
+            cassette=cassette
+        )
+
+    def test_replay_reproduces_recorded_workload(self, tmp_path):
+        """Test a recorded session replays offline with the same answers and token usage"""
+        pdf_path = str(tmp_path / "paper.pdf")
+        write_sample_pdf(pdf_path, pages=2)
+        path = str(tmp_path / "workload.cassette")
+
+        recorder = Cassette(path)
+        recorded_pipeline = self.build_pipeline(recorder, str(tmp_path / "record.db"))
+        recorded_pipeline.rag_tool.load_pdf(pdf_path)
+        recorded = [
+            recorded_pipeline.run("What does the document say about attention?", "s1", pdf_name="paper.pdf"),
+            recorded_pipeline.run("What's the weather in Paris?", "s1")
+        ]
+        recorder.save()
+
+        player = Cassette(path, mode=REPLAY, latency_scale=0)
+        steps = player.replay(self.build_pipeline(player, str(tmp_path / "replay.db")))
+
+        assert [step["kind"] for step in steps] == ["load_pdf", "run", "run"]
+        assert steps[0]["result"] is True
+        for original, step in zip(recorded, steps[1:]):
+            assert step["result"]["final_answer"] == original["final_answer"]
+            assert step["result"]["error"] == original["error"]
+            assert step["result"]["token_usage"]["total_tokens"] == original["token_usage"]["total_tokens"]
+
+    def test_replay_latency_scale(self, tmp_path):
+        """Test replayed calls take their recorded latency, scaled"""
+        path = str(tmp_path / "weather.cassette")
+        recorder = Cassette(path)
+        weather = recorder.weather_tool(FakeWeatherTool(latency_ms=50))
+        data = weather.get_weather("Oslo")
+        recorder.save()
+
+        for scale, low, high in ((1.0, 0.04, 1.0), (0.0, 0.0, 0.03)):
+            player = Cassette(path, mode=REPLAY, latency_scale=scale)
+            start = time.perf_counter()
+            assert player.weather_tool(None).get_weather("Oslo") == data
+            assert low <= time.perf_counter() - start < high
+
+    def test_recorded_failures_are_replayed(self, tmp_path):
+        """Test a backend error is raised again on replay with its type and message"""
+        path = str(tmp_path / "errors.cassette")
+        inner = Mock()
+        inner.get_weather.side_effect = UnknownCityError("city not found")
+        recorder = Cassette(path)
+        with pytest.raises(UnknownCityError):
+            recorder.weather_tool(inner).get_weather("Atlantis")
+        recorder.save()
+
+        player = Cassette(path, mode=REPLAY, latency_scale=0)
+        with pytest.raises(UnknownCityError, match="city not found"):
+            player.weather_tool(None).get_weather("Atlantis")
+
+    def test_replayed_status_errors_keep_status(self, tmp_path):
+        """Test an API error status is replayed along with its type"""
+        path = str(tmp_path / "errors.cassette")
+        inner = Mock()
+        inner.get_weather.side_effect = WeatherAPIError("401 Unauthorized", 401)
+        recorder = Cassette(path)
+        with pytest.raises(WeatherAPIError):
+            recorder.weather_tool(inner).get_weather("London")
+        recorder.save()
+
+        player = Cassette(path, mode=REPLAY, latency_scale=0)
+        with pytest.raises(WeatherAPIError, match="401") as replayed:
+            player.weather_tool(None).get_weather("London")
+        assert replayed.value.status_code == 401
+
+    def test_unregistered_failures_replayed_generically(self, tmp_path):
+        """Test error types outside the registry, including hostile names, replay as ReplayedError"""
+        class LocalError(Exception):
+            pass
+
+        path = str(tmp_path / "errors.cassette")
+        inner = Mock()
+        inner.get_weather.side_effect = LocalError("local")
+        recorder = Cassette(path)
+        for city in ["Atlantis", "Lemuria"]:
+            with pytest.raises(LocalError):
+                recorder.weather_tool(inner).get_weather(city)
+        recorder.interactions[recorder._key("weather", "Lemuria")][0]["error_type"] = "this:Boom"
+        recorder.save()
+
+        player = Cassette(path, mode=REPLAY, latency_scale=0)
+        with pytest.raises(ReplayedError, match="local"):
+            player.weather_tool(None).get_weather("Atlantis")
+        with pytest.raises(ReplayedError, match="local"):
+            player.weather_tool(None).get_weather("Lemuria")
+        assert "this" not in sys.modules
+
+    def test_unrecorded_call_misses(self, tmp_path):
+        """Test replaying a call that was never recorded fails loudly"""
+        path = str(tmp_path / "empty.cassette")
+        Cassette(path).save()
+
+        player = Cassette(path, mode=REPLAY)
+        with pytest.raises(CassetteMiss):
+            player.embeddings(None).embed_query("never asked")
+
+    def test_from_env(self, monkeypatch, tmp_path):
+        """Test cassettes are only used when AGENT_CASSETTE is set"""
+        monkeypatch.delenv("AGENT_CASSETTE", raising=False)
+        assert Cassette.from_env() is None
+
+        path = str(tmp_path / "env.cassette")
+        Cassette(path).save()
+        monkeypatch.setenv("AGENT_CASSETTE", path)
+        monkeypatch.setenv("AGENT_CASSETTE_MODE", "replay")
+        monkeypatch.setenv("AGENT_CASSETTE_LATENCY_SCALE", "0")
+
+        cassette = Cassette.from_env()
+        assert cassette.replaying
+        assert cassette.latency_scale == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,61 @@
+"""
+Unit tests for the shared model client factory
+Tests connection pool sharing and client reuse without calling OpenAI
+"""
+
+import pytest
+import clients
+
+
+class TestClients:
+    """Test suite for the clients module"""
+    
+    @pytest.fixture(autouse=True)
+    def fresh_clients(self, monkeypatch):
+        """Give every test its own set of shared clients"""
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        clients.reset_clients()
+        yield
+        clients.reset_clients()
+    
+    def test_chat_models_reused_per_settings(self):
+        """Test identical settings return the same client"""
+        first = clients.get_chat_model(temperature=0.3)
+        second = clients.get_chat_model(temperature=0.3)
+        other = clients.get_chat_model(temperature=0.7)
+        
+        assert first is second
+        assert first is not other
+    
+    def test_all_clients_share_connection_pool(self):
+        """Test chat and embedding clients use the one shared HTTP client"""
+        llm = clients.get_chat_model(temperature=0.3)
+        other_llm = clients.get_chat_model(temperature=0.7)
+        embeddings = clients.get_embeddings()
+        
+        shared = clients.get_http_client()
+        assert llm.http_client is shared
+        assert other_llm.http_client is shared
+        assert embeddings.http_client is shared
+        assert llm.root_client._client is shared
+    
+    def test_uniform_timeout_and_retries(self):
+        """Test every client gets the same timeout and retry policy"""
+        llm = clients.get_chat_model()
+        embeddings = clients.get_embeddings()
+        
+        assert llm.request_timeout == clients.MODEL_TIMEOUT
+        assert embeddings.request_timeout == clients.MODEL_TIMEOUT
+        assert llm.max_retries == clients.MODEL_MAX_RETRIES
+        assert embeddings.max_retries == clients.MODEL_MAX_RETRIES
+    
+    def test_reset_clients(self):
+        """Test reset drops cached clients"""
+        first = clients.get_chat_model()
+        clients.reset_clients()
+        
+        assert clients.get_chat_model() is not first
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
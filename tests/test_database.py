@@ -126,7 +126,11 @@ Tests database operations using in-memory SQLite
 
 import pytest
 import os
+import sqlite3
+import threading
 import time 
+import database
+import metrics
 from database import ChatDatabase
 
 
@@ -240,5 +244,558 @@ class TestChatDatabase:
         assert len(sessions) == 0
 
 
+    def test_insert_messages(self, db):
+        """Test inserting several messages at once"""
+        db.insert_messages([
+            {"session_id": "session_001", "user_query": "Q1", "ai_response": "A1", "intent": "weather"},
+            {"session_id": "session_001", "user_query": "Q2", "ai_response": "A2", "intent": "document", "pdf_name": "test.pdf"},
+            {"session_id": "session_002", "user_query": "Q3", "ai_response": "A3"}
+        ])
+        
+        history = db.get_session_history("session_001")
+        
+        assert [msg["content"] for msg in history] == ["Q1", "A1", "Q2", "A2"]
+        assert db.get_session_pdf("session_001") == "test.pdf"
+        assert len(db.get_all_sessions()) == 2
+
+    def test_wal_and_pragmas(self, db):
+        """Test the database runs in WAL mode with relaxed syncing and a busy timeout"""
+        conn = db.get_connection()
+
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == database.BUSY_TIMEOUT * 1000
+        conn.close()
+
+    def test_connection_reused_per_thread(self, db):
+        """Test handles on the same file share a connection in a thread but not across threads"""
+        other_thread = []
+        thread = threading.Thread(target=lambda: other_thread.append(db._connection()))
+        thread.start()
+        thread.join()
+
+        assert ChatDatabase(db.db_name)._connection() is db._connection()
+        assert other_thread[0] is not db._connection()
+
+    def test_get_connection_is_independent(self, db):
+        """Test closing a connection from get_connection leaves the handle usable"""
+        db.get_connection().close()
+        db.insert_message("session_001", "Q1", "A1", "weather")
+
+        assert len(db.get_session_history("session_001")) == 2
+
+    def test_close_reopens_on_next_call(self, db):
+        """Test a closed handle opens a new connection when used again"""
+        first = db._connection()
+        db.close()
+
+        db.insert_message("session_001", "Q1", "A1", "weather")
+
+        assert db._connection() is not first
+        assert len(db.get_session_history("session_001")) == 2
+
+    def test_failed_write_rolled_back(self, db):
+        """Test a failed batch leaves no rows and no open transaction behind"""
+        with pytest.raises(KeyError):
+            db.insert_messages([
+                {"session_id": "session_001", "user_query": "Q1", "ai_response": "A1"},
+                {"session_id": "session_001", "user_query": "Q2"}
+            ])
+
+        assert db._connection().in_transaction is False
+        assert db.get_session_history("session_001") == []
+
+    def test_concurrent_writers_and_readers(self, db):
+        """Test threads inserting and reading at the same time don't lock each other out"""
+        errors = []
+
+        def worker(index):
+            try:
+                for i in range(25):
+                    db.insert_message(f"session_{index}", f"Q{i}", f"A{i}", "weather")
+                    db.get_session_history(f"session_{index}")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                database.close_connections()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        sessions = db.get_all_sessions()
+        assert len(sessions) == 8
+        assert all(session["message_count"] == 25 for session in sessions)
+
+    def test_session_summary_follows_deletes(self, db):
+        """Test the sessions table is updated when messages are deleted"""
+        db.insert_message("session_001", "Q1", "A1", "document", "first.pdf")
+        db.insert_message("session_001", "Q2", "A2", "weather")
+        latest_id = db.insert_message("session_001", "Q3", "A3", "document", "second.pdf")
+        db.insert_message("session_002", "Q4", "A4", "weather")
+
+        conn = db.get_connection()
+        with conn:
+            conn.execute("DELETE FROM chat_history WHERE id = ?", (latest_id,))
+        conn.close()
+        sessions = {session["session_id"]: session for session in db.get_all_sessions()}
+
+        assert sessions["session_001"]["message_count"] == 2
+        assert sessions["session_001"]["pdf_name"] == "first.pdf"
+        db.clear_session("session_001")
+        assert [session["session_id"] for session in db.get_all_sessions()] == ["session_002"]
+
+    def test_sessions_backfilled_for_existing_history(self, tmp_path):
+        """Test history written before the sessions table existed is summarized once"""
+        db_name = str(tmp_path / "old.db")
+        conn = sqlite3.connect(db_name)
+        conn.execute('''
+            CREATE TABLE chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, user_query TEXT NOT NULL,
+                ai_response TEXT NOT NULL, intent TEXT, pdf_name TEXT, created_at TEXT
+            )
+        ''')
+        conn.executemany(
+            "INSERT INTO chat_history (session_id, user_query, ai_response, pdf_name, created_at) VALUES (?, ?, ?, ?, ?)",
+            [("old", "Q1", "A1", "old.pdf", "2024-01-01 10:00:00"), ("old", "Q2", "A2", None, "2024-01-01 11:00:00")]
+        )
+        conn.commit()
+        conn.close()
+
+        db = ChatDatabase(db_name)
+        ChatDatabase(db_name)
+
+        assert db.get_all_sessions() == [
+            {"session_id": "old", "message_count": 2, "last_message": "2024-01-01 11:00:00", "pdf_name": "old.pdf"}
+        ]
+
+    def test_history_queries_use_indexes(self, db):
+        """Test session lookups and the listing don't scan chat_history"""
+        conn = db.get_connection()
+
+        def plan(sql, params=()):
+            return " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+        assert "USING INDEX idx_sessions_recent" in plan(
+            "SELECT session_id, message_count, last_message, pdf_name FROM sessions "
+            "ORDER BY last_message DESC, session_id DESC LIMIT 10"
+        )
+        assert "USING INDEX idx_chat_history_session " in plan(
+            "SELECT user_query, ai_response FROM chat_history WHERE session_id = ? ORDER BY created_at, id", ("s",)
+        )
+        assert "USING INDEX idx_chat_history_session_pdf" in plan(
+            "SELECT pdf_name FROM chat_history WHERE session_id = ? AND pdf_name IS NOT NULL "
+            "ORDER BY created_at DESC LIMIT 1", ("s",)
+        )
+        conn.close()
+
+    def test_get_session_history_pages(self, db):
+        """Test history pages walk back from the latest turns, oldest first within a page"""
+        for i in range(5):
+            db.insert_message("session_001", f"Q{i}", f"A{i}", "weather")
+        db.insert_message("session_002", "Other", "Other", "weather")
+
+        latest = db.get_session_history("session_001", limit=2)
+        previous = db.get_session_history("session_001", limit=2, before=latest[0]["message_id"])
+        first = db.get_session_history("session_001", limit=2, before=previous[0]["message_id"])
+
+        assert [msg["content"] for msg in latest] == ["Q3", "A3", "Q4", "A4"]
+        assert [msg["content"] for msg in previous] == ["Q1", "A1", "Q2", "A2"]
+        assert [msg["content"] for msg in first] == ["Q0", "A0"]
+        assert db.get_recent_turns("session_001", 2) == latest
+        assert db.get_session_history("session_001", before=latest[0]["message_id"]) == first + previous
+
+    def test_get_all_sessions_pages(self, db):
+        """Test session pages resume after the last session listed, newest first"""
+        for i in range(5):
+            db.insert_message(f"session_{i}", "Q", "A", "weather")
+            time.sleep(0.01)
+
+        first = db.get_all_sessions(limit=2)
+        second = db.get_all_sessions(limit=2, before=first[-1]["session_id"])
+        last = db.get_all_sessions(limit=2, before=second[-1]["session_id"])
+
+        assert [s["session_id"] for s in first + second + last] == [f"session_{i}" for i in range(4, -1, -1)]
+        assert db.get_all_sessions(limit=2, before=last[-1]["session_id"]) == []
+        assert first + second + last == db.get_all_sessions()
+
+    def test_sessions_with_equal_timestamps_paged_once(self, db):
+        """Test sessions sharing a last_message are neither skipped nor repeated across pages"""
+        conn = db.get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chat_history (session_id, user_query, ai_response, created_at) VALUES (?, 'Q', 'A', ?)",
+                [(f"session_{i}", "2024-01-01 10:00:00") for i in range(5)]
+            )
+        conn.close()
+
+        seen = []
+        page = db.get_all_sessions(limit=2)
+        while page:
+            seen.extend(s["session_id"] for s in page)
+            page = db.get_all_sessions(limit=2, before=page[-1]["session_id"])
+
+        assert seen == [f"session_{i}" for i in range(4, -1, -1)]
+
+    def test_iter_session_history_batches(self, db):
+        """Test the export iterator yields every message in order, a batch per query"""
+        for i in range(7):
+            db.insert_message("session_001", f"Q{i}", f"A{i}", "weather")
+
+        messages = db.iter_session_history("session_001", batch_size=3)
+
+        assert next(messages)["content"] == "Q0"
+        assert [msg["content"] for msg in messages][-2:] == ["Q6", "A6"]
+        assert list(db.iter_session_history("session_001", batch_size=3)) == db.get_session_history("session_001")
+        assert list(db.iter_session_history("missing")) == []
+
+
+    def test_search_ranks_matches(self, db):
+        """Test search finds stemmed words in questions and answers, best match first"""
+        db.insert_message("session_001", "Is it raining in London?", "Light rain in London today.", "weather")
+        db.insert_message("session_002", "Weather in Paris?", "Sunny, no rain expected.", "weather")
+        db.insert_message("session_002", "What is attention?", "Attention weighs tokens.", "document", "paper.pdf")
+
+        results = db.search("rain london")
+
+        assert [result["session_id"] for result in results] == ["session_001"]
+        assert results[0]["answer_snippet"] == "Light **rain** in **London** today."
+        assert {result["session_id"] for result in db.search("rains")} == {"session_001", "session_002"}
+        assert db.search("attention")[0]["pdf_name"] == "paper.pdf"
+
+    def test_search_within_session(self, db):
+        """Test search can be limited to one session"""
+        db.insert_message("session_001", "Rain in Oslo?", "Rain all day.", "weather")
+        db.insert_message("session_002", "Rain in Rome?", "No rain.", "weather")
+
+        results = db.search("rain", session_id="session_002")
+
+        assert [result["session_id"] for result in results] == ["session_002"]
+        assert db.search("oslo", session_id="session_002") == []
+        assert db.search("rain", session_id="missing") == []
+
+    def test_search_ignores_punctuation_and_operators(self, db):
+        """Test text typed into the search box can't form an invalid FTS5 query"""
+        db.insert_message("session_001", "What's NOT in the paper?", "Nothing.", "document")
+
+        assert len(db.search('what\'s NOT "in')) == 1
+        assert db.search("?!*") == []
+        assert db.search("AND OR") == []
+
+    def test_search_follows_deletes(self, db):
+        """Test cleared messages can no longer be found"""
+        db.insert_message("session_001", "Rain in Oslo?", "Rain all day.", "weather")
+        db.insert_message("session_002", "Rain in Rome?", "No rain.", "weather")
+
+        db.clear_session("session_001")
+
+        assert [result["session_id"] for result in db.search("rain")] == ["session_002"]
+
+    def test_common_words_listed_newest_first(self, db, monkeypatch):
+        """Test words in too many messages to rank return the latest matches"""
+        monkeypatch.setattr(database, "SEARCH_RANK_MAX_MATCHES", 2)
+        ids = [db.insert_message("session_001", f"Rain question {i}", "Rain " * (5 - i), "weather") for i in range(5)]
+
+        assert [result["message_id"] for result in db.search("rain", limit=3)] == ids[:-4:-1]
+        assert [result["message_id"] for result in db.search("question 2")] == [ids[2]]
+
+    def test_history_indexed_for_search_on_upgrade(self, tmp_path):
+        """Test history written before the search index existed can be searched"""
+        db_name = str(tmp_path / "old.db")
+        conn = sqlite3.connect(db_name)
+        conn.execute('''
+            CREATE TABLE chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, user_query TEXT NOT NULL,
+                ai_response TEXT NOT NULL, intent TEXT, pdf_name TEXT, created_at TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO chat_history (session_id, user_query, ai_response) VALUES ('old', 'Rain?', 'Yes')")
+        conn.commit()
+        conn.close()
+
+        db = ChatDatabase(db_name)
+
+        assert [result["session_id"] for result in db.search("rain", session_id="old")] == ["old"]
+        db.clear_session("old")
+        assert db.search("rain") == []
+        db.insert_message("new", "Rain?", "Yes", "weather")
+        assert [result["session_id"] for result in db.search("rain", session_id="new")] == ["new"]
+
+class TestWriteBehind:
+    """Test suite for ChatDatabase's write-behind mode"""
+
+    @pytest.fixture
+    def db(self, tmp_path, monkeypatch):
+        """Create a write-behind database whose queue only commits when told to"""
+        monkeypatch.setattr(database, "WRITE_BEHIND_INTERVAL_MS", 60000)
+        db = ChatDatabase(db_name=str(tmp_path / "test_chat.db"), write_behind=True)
+        yield db
+        database.close_writers()
+
+    def committed(self, db, session_id="session_001"):
+        """Rows of a session visible to a connection that bypasses the queue"""
+        conn = sqlite3.connect(db.db_name)
+        count = conn.execute("SELECT COUNT(*) FROM chat_history WHERE session_id = ?", (session_id,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def wait_for(self, condition, timeout=5.0):
+        """Poll condition until it holds or timeout seconds pass"""
+        give_up_at = time.monotonic() + timeout
+        while not condition() and time.monotonic() < give_up_at:
+            time.sleep(0.01)
+        return condition()
+
+    def test_insert_queued_with_id(self, db):
+        """Test inserts return their id at once but are only committed later"""
+        first = db.insert_message("session_001", "Q1", "A1", "weather")
+        ids = db.insert_messages([
+            {"session_id": "session_001", "user_query": "Q2", "ai_response": "A2"},
+            {"session_id": "session_001", "user_query": "Q3", "ai_response": "A3"}
+        ])
+
+        assert ids == [first + 1, first + 2]
+        assert self.committed(db) == 0
+        db._writer().flush()
+        assert self.committed(db) == 3
+
+    def test_read_your_writes(self, db):
+        """Test reading a session commits its queued writes, and only reads that need them do"""
+        message_id = db.insert_message("session_001", "Q1", "A1", "document", "paper.pdf")
+        db.insert_usage([{
+            "message_id": message_id, "session_id": "session_001", "step": "llm.rag_answer",
+            "prompt_tokens": 10, "completion_tokens": 5, "cost_usd": 0.001
+        }])
+
+        assert db.get_session_history("session_002") == []
+        assert db._writer().pending("session_001")
+        assert [msg["message_id"] for msg in db.get_recent_turns("session_001", 1)] == [message_id] * 2
+        assert db.get_session_pdf("session_001") == "paper.pdf"
+        assert db.get_usage(session_id="session_001")["total_tokens"] == 15
+        assert not db._writer().pending()
+
+    def test_ids_continue_after_deleted_rows(self, db):
+        """Test queued ids never reuse the id of a deleted message"""
+        sync_db = ChatDatabase(db.db_name, write_behind=False)
+        database.close_writers()
+        last = sync_db.insert_message("session_001", "Q1", "A1", "weather")
+        sync_db.clear_session("session_001")
+
+        assert db.insert_message("session_001", "Q2", "A2", "weather") == last + 1
+        # Handles that didn't ask for write-behind use the file's queue too
+        assert sync_db.insert_message("session_001", "Q3", "A3", "weather") == last + 2
+
+    def test_full_batch_committed(self, db, monkeypatch):
+        """Test the writer commits as soon as a batch fills up"""
+        db.close()
+        monkeypatch.setattr(database, "WRITE_BEHIND_BATCH", 3)
+        for i in range(3):
+            db.insert_message("session_001", f"Q{i}", f"A{i}", "weather")
+
+        assert self.wait_for(lambda: self.committed(db) == 3)
+
+    def test_interval_commits(self, db, monkeypatch):
+        """Test a lone write is committed after the flush interval"""
+        db.close()
+        monkeypatch.setattr(database, "WRITE_BEHIND_INTERVAL_MS", 20)
+        db.insert_message("session_001", "Q1", "A1", "weather")
+
+        assert self.wait_for(lambda: self.committed(db) == 1)
+
+    def test_shutdown_commits_queue(self, db):
+        """Test closing the database, or the process exiting, commits what is queued"""
+        db.insert_message("session_001", "Q1", "A1", "weather")
+        db.close()
+        assert self.committed(db) == 1
+
+        db.insert_message("session_002", "Q2", "A2", "weather")
+        writer = db._writer()
+        database.close_writers()
+        assert self.committed(db, "session_002") == 1
+        assert not writer._thread.is_alive()
+
+    def test_clear_session_waits_for_queued_inserts(self, db):
+        """Test a queued insert is not committed after the session it belongs to is cleared"""
+        db.insert_message("session_001", "Q1", "A1", "weather")
+        db.clear_session("session_001")
+        db._writer().flush()
+
+        assert self.committed(db) == 0
+
+    def test_clear_session_waits_for_queued_spans(self, db):
+        """Test spans queued for a session's message don't outlive clearing the session"""
+        message_id = db.insert_message("session_001", "Q1", "A1", "weather")
+        db._writer().flush()
+        db.insert_spans(message_id, [{
+            "trace_id": "t1", "span_id": "s1", "parent_id": None, "name": "agent.run",
+            "start_time": 0.0, "duration_ms": 1.0, "attributes": {}, "error": None
+        }])
+        db.clear_session("session_001")
+        db._writer().flush()
+
+        conn = sqlite3.connect(db.db_name)
+        assert conn.execute("SELECT COUNT(*) FROM trace_spans").fetchone()[0] == 0
+        conn.close()
+
+    def test_failed_write_does_not_lose_batch(self, db):
+        """Test one bad write in a group commit doesn't drop the others"""
+        metrics.registry.reset()
+        db.insert_message("session_001", "Q1", "A1", "weather")
+        db._writer().submit("INSERT INTO missing_table VALUES (?)", [(1,)])
+        db.insert_message("session_001", "Q2", "A2", "weather")
+        db._writer().flush()
+
+        assert self.committed(db) == 2
+        counters = {counter["name"]: counter["value"] for counter in metrics.registry.snapshot()["counters"]}
+        assert counters["chat_db_write_errors_total"] == 1
+
+    def test_concurrent_inserts(self, db, monkeypatch):
+        """Test threads writing through the queue get unique ids and lose nothing"""
+        db.close()
+        monkeypatch.setattr(database, "WRITE_BEHIND_INTERVAL_MS", 5)
+        ids = []
+        lock = threading.Lock()
+
+        def worker(index):
+            own = [db.insert_message(f"session_{index}", f"Q{i}", f"A{i}", "weather") for i in range(50)]
+            with lock:
+                ids.extend(own)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(ids)) == 400
+        assert sum(session["message_count"] for session in db.get_all_sessions()) == 400
+
+class TestRetention:
+    """Test suite for archiving old sessions and vacuuming"""
+
+    @pytest.fixture
+    def db(self, tmp_path):
+        """Create a temporary test database"""
+        return ChatDatabase(db_name=str(tmp_path / "test_chat.db"))
+
+    def insert_old(self, db, session_id, turns, day="2020-01-01", pdf_name="old.pdf"):
+        """Insert turns of a session written on day, long before any retention cutoff"""
+        conn = db.get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chat_history (session_id, user_query, ai_response, pdf_name, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(session_id, f"Old question {i}", "Old answer " * 50, pdf_name, f"{day} 10:00:{i:02d}.000")
+                 for i in range(turns)]
+            )
+        conn.close()
+
+    def test_old_sessions_archived(self, db):
+        """Test only sessions past the cutoff move to the archive, and read back unchanged"""
+        self.insert_old(db, "old", 5)
+        db.insert_message("new", "Rain?", "Yes", "weather")
+        history = db.get_session_history("old")
+
+        report = db.archive_sessions(older_than_days=30)
+
+        assert report["sessions"] == 1
+        assert report["messages"] == 5
+        assert 0 < report["archived_bytes"] < report["raw_bytes"]
+        assert db.get_session_history("old") == history
+        assert db.get_session_pdf("old") == "old.pdf"
+        assert list(db.iter_session_history("old", batch_size=2)) == history
+        assert [session["session_id"] for session in db.get_all_sessions()] == ["new"]
+        assert db.search("old question") == []
+        assert db.archive_sessions(older_than_days=30)["sessions"] == 0
+
+    def test_archived_history_pages(self, db):
+        """Test limit and before page through an archived session like a live one"""
+        self.insert_old(db, "old", 6)
+        last_page = db.get_session_history("old", limit=2)
+        before_page = db.get_session_history("old", limit=2, before=last_page[0]["message_id"])
+
+        db.archive_sessions(older_than_days=30)
+
+        assert db.get_session_history("old", limit=2) == last_page
+        assert db.get_session_history("old", limit=2, before=last_page[0]["message_id"]) == before_page
+        assert db.get_recent_turns("old", 1) == last_page[2:]
+
+    def test_archived_session_written_again(self, db):
+        """Test new messages in an archived session are read after the archived ones"""
+        self.insert_old(db, "old", 3)
+        db.archive_sessions(older_than_days=30)
+        message_id = db.insert_message("old", "Back again", "Welcome back", "document")
+
+        history = db.get_session_history("old")
+        assert len(history) == 8
+        assert history[-2]["content"] == "Back again"
+        assert db.get_session_history("old", limit=1)[0]["message_id"] == message_id
+
+    def test_archived_session_archived_again(self, db):
+        """Test a session that was written to after archiving is merged into its archive row"""
+        self.insert_old(db, "old", 3)
+        db.archive_sessions(older_than_days=30)
+        self.insert_old(db, "old", 1, day="2021-01-01", pdf_name="later.pdf")
+        history = db.get_session_history("old")
+        db.archive_sessions(older_than_days=30)
+        assert db.get_session_history("old") == history
+        assert db.get_session_pdf("old") == "later.pdf"
+        conn = db.get_connection()
+        assert conn.execute("SELECT message_count FROM session_archive WHERE session_id = 'old'").fetchone()[0] == 4
+        conn.close()
+
+    def test_archive_in_batches(self, db):
+        """Test sessions beyond the first batch are archived too"""
+        for index in range(5):
+            self.insert_old(db, f"old_{index}", 2)
+
+        report = db.archive_sessions(older_than_days=30, batch_size=2)
+
+        assert report["sessions"] == 5
+        assert db.get_all_sessions() == []
+
+    def test_clear_session_removes_archive(self, db):
+        """Test clearing a session deletes its archived history too"""
+        self.insert_old(db, "old", 2)
+        db.archive_sessions(older_than_days=30)
+
+        db.clear_session("old")
+
+        assert db.get_session_history("old") == []
+        assert db.get_session_pdf("old") is None
+
+    def test_vacuum_reclaims_archived_space(self, db):
+        """Test vacuum gives the pages archiving freed back to the file system"""
+        for index in range(20):
+            self.insert_old(db, f"old_{index}", 20)
+        report = db.archive_sessions(older_than_days=30)
+
+        vacuumed = db.vacuum()
+
+        assert report["freed_bytes"] > 0
+        assert not vacuumed["full_vacuum"]
+        assert vacuumed["pages_after"] < vacuumed["pages_before"]
+        assert vacuumed["reclaimed_bytes"] >= report["freed_bytes"]
+        conn = db.get_connection()
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+        conn.close()
+
+    def test_vacuum_converts_old_file(self, tmp_path):
+        """Test a file created without incremental auto-vacuum is converted by one full vacuum"""
+        db_name = str(tmp_path / "old.db")
+        conn = sqlite3.connect(db_name)
+        conn.execute("CREATE TABLE chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+                     "user_query TEXT NOT NULL, ai_response TEXT NOT NULL, intent TEXT, pdf_name TEXT, created_at TEXT)")
+        conn.commit()
+        conn.close()
+        db = ChatDatabase(db_name)
+
+        assert db.vacuum()["full_vacuum"]
+        assert not db.vacuum()["full_vacuum"]
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""
+Unit tests for request deadlines
+Tests timeout capping and deadline-bounded model calls
+"""
+
+import time
+import pytest
+from unittest.mock import Mock
+import deadline
+from deadline import DeadlineExceeded
+
+
+class TestDeadline:
+    """Test suite for the deadline module"""
+
+    def test_no_deadline_keeps_default_timeout(self):
+        """Test calls outside a deadline scope keep their own timeout"""
+        assert deadline.remaining() is None
+        assert deadline.timeout(10) == 10
+
+    def test_timeout_capped_by_deadline(self):
+        """Test a call's timeout never outlasts the request"""
+        with deadline.scope(deadline.from_budget(500)):
+            assert 0 < deadline.timeout(10) <= 0.5
+
+        assert deadline.remaining() is None
+
+    def test_expired_deadline_raises(self):
+        """Test starting a call after the deadline fails fast"""
+        with deadline.scope(time.monotonic() - 1):
+            with pytest.raises(DeadlineExceeded):
+                deadline.timeout(10)
+
+    def test_bounded_llm_passes_timeout(self):
+        """Test the wrapped model gets a per-call timeout only under a deadline"""
+        llm = Mock()
+        llm.invoke.return_value = "ok"
+        bounded = deadline.bounded(llm)
+
+        assert bounded.invoke("prompt") == "ok"
+        assert "timeout" not in llm.invoke.call_args[1]
+
+        with deadline.scope(deadline.from_budget(1000)):
+            bounded.invoke("prompt")
+        assert 0 < llm.invoke.call_args[1]["timeout"] <= 1.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,129 @@
+"""
+Unit tests for the city gazetteer
+Tests exact, alias and fuzzy resolution, mention detection and index files
+"""
+
+import gzip
+import pytest
+import gazetteer
+from gazetteer import City, Gazetteer
+
+
+class TestGazetteer:
+    """Test suite for the gazetteer module"""
+
+    @pytest.fixture
+    def index(self):
+        """Load the bundled gazetteer"""
+        return Gazetteer.load()
+
+    def test_resolve_exact_and_alias(self, index):
+        """Test names and aliases resolve regardless of case and accents"""
+        assert index.resolve("London").id == 2643743
+        assert index.resolve("  new   YORK ").name == "New York"
+        assert index.resolve("Bombay").name == "Mumbai"
+        assert index.resolve("sao paulo").name == "São Paulo"
+
+    def test_resolve_misspellings(self, index):
+        """Test typos, including swapped letters, resolve to the intended city when fuzzy"""
+        assert index.resolve("Londn", fuzzy=True).name == "London"
+        assert index.resolve("Mumbay", fuzzy=True).name == "Mumbai"
+        assert index.resolve("Dehli", fuzzy=True).name == "Delhi"
+        assert index.resolve("Philadelpia", fuzzy=True).name == "Philadelphia"
+
+    def test_resolve_exact_by_default(self, index):
+        """Test unlisted places a typo away from a listed city aren't rewritten to it"""
+        assert index.resolve("Leon") is None
+        assert index.resolve("Laos") is None
+        assert index.resolve("Londn") is None
+        assert index.resolve("Leon", fuzzy=True).name == "Lyon"
+
+    def test_resolve_rejects_different_names(self, index):
+        """Test names more than a typo away from any city don't resolve"""
+        assert index.resolve("Atlantis", fuzzy=True) is None
+        assert index.resolve("Parma", fuzzy=True) is None
+        assert index.resolve("", fuzzy=True) is None
+
+    def test_resolve_ambiguous_names(self, index):
+        """Test ambiguous names prefer the most populous city unless qualified"""
+        assert index.resolve("London").country == "GB"
+        assert index.resolve("London, CA").country == "CA"
+        assert index.resolve("Paris,us").id == 4717560
+        # Qualifiers other than country codes are left to the weather API
+        assert index.resolve("Paris, Texas") is None
+
+    def test_find_mentions(self, index):
+        """Test cities in a question are found in order, longest name first"""
+        mentions = index.find_mentions("Compare the weather in Delhi, Mumbai and New York")
+
+        assert [city.name for city in mentions] == ["Delhi", "Mumbai", "New York"]
+
+    def test_find_mentions_needs_capital_or_preposition(self, index):
+        """Test lowercase names only count right after "in", "for" or "at\""""
+        assert [city.name for city in index.find_mentions("weather in paris")] == ["Paris"]
+        assert index.find_mentions("is rome or lima warmer") == []
+        assert index.find_mentions("How hot is it?") == []
+
+    def test_find_mentions_country_qualifier(self, index):
+        """Test a country code after a comma picks the city in that country"""
+        assert [city.country for city in index.find_mentions("Weather in London, CA?")] == ["CA"]
+
+    def test_extract_only_when_every_place_known(self, index):
+        """Test extract gives up on questions naming places or qualifiers it doesn't know"""
+        assert [city.name for city in index.extract("Is it colder in NYC or in london on Monday?")] == \
+            ["New York", "London"]
+        assert index.extract("Compare the weather in Delhi and Springfield") is None
+        assert index.extract("Mumbai, Delhi and Timbuktu") is None
+        assert index.extract("weather in Paris, Texas") is None
+        assert index.extract("How hot is it?") is None
+
+    def test_load_compressed_file(self, tmp_path):
+        """Test gzip-compressed index files and their aliases load"""
+        path = str(tmp_path / "cities.tsv.gz")
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write("# comment\n1\tSpringfield\tUS\t100\tSpringfeld|Shelbyville\n\n2\tOgdenville\tUS\t50\n")
+
+        index = Gazetteer.load(path)
+
+        assert index.resolve("Shelbyville") == City(1, "Springfield", "US", 100)
+        assert index.resolve("ogdenvile", fuzzy=True).id == 2
+
+    def test_build_from_geonames(self, tmp_path):
+        """Test a GeoNames dump is filtered by population and keeps Latin aliases"""
+        def row(geoname_id, name, ascii_name, alternates, country, population):
+            fields = [str(geoname_id), name, ascii_name, alternates, "0", "0", "P", "PPLC", country]
+            fields += [""] * 5 + [str(population)] + [""] * 4
+            return "\t".join(fields) + "\n"
+
+        source = tmp_path / "cities15000.txt"
+        source.write_text(
+            row(3054643, "Budapest", "Budapest", "Buda-Pesth,Будапешт,Budapeste", "HU", 1752286)
+            + row(1, "Tiny", "Tiny", "", "HU", 10),
+            encoding="utf-8"
+        )
+        output = str(tmp_path / "cities.tsv")
+
+        assert gazetteer.build(str(source), output) == 1
+        index = Gazetteer.load(output)
+        assert index.resolve("Buda-Pesth").name == "Budapest"
+        assert index.resolve("Будапешт") is None
+        assert index.resolve("Tiny") is None
+
+    def test_from_env(self, monkeypatch, tmp_path):
+        """Test the configured gazetteer is loaded once and can be turned off"""
+        monkeypatch.setenv("GAZETTEER_PATH", "off")
+        assert Gazetteer.from_env() is None
+
+        path = tmp_path / "cities.tsv"
+        path.write_text("1\tSpringfield\tUS\t100\n")
+        monkeypatch.setenv("GAZETTEER_PATH", str(path))
+
+        assert Gazetteer.from_env().resolve("Springfield").id == 1
+        assert Gazetteer.from_env() is Gazetteer.from_env()
+
+        monkeypatch.setenv("GAZETTEER_PATH", str(tmp_path / "missing.tsv"))
+        assert Gazetteer.from_env() is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
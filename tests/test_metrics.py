@@ -0,0 +1,124 @@
+"""
+Unit tests for metrics
+Tests histograms, per-request breakdowns and exporters
+"""
+
+import json
+import pytest
+from unittest.mock import Mock
+import metrics
+from metrics import Histogram, MetricsRegistry
+
+
+class TestMetrics:
+    """Test suite for the metrics module"""
+    
+    @pytest.fixture(autouse=True)
+    def clean_registry(self):
+        """Start every test with an empty process-wide registry"""
+        metrics.registry.reset()
+        yield
+        metrics.registry.reset()
+    
+    def test_histogram_percentiles(self):
+        """Test nearest-rank percentiles over recorded values"""
+        hist = Histogram()
+        for value in range(1, 101):
+            hist.observe(value)
+        
+        assert hist.percentile(50) == 50
+        assert hist.percentile(95) == 95
+        assert hist.percentile(99) == 99
+        assert hist.snapshot()["count"] == 100
+        assert hist.snapshot()["max"] == 100
+    
+    def test_histogram_reservoir_is_bounded(self):
+        """Test the sample reservoir never grows past its limit"""
+        hist = Histogram(max_samples=10)
+        for value in range(1000):
+            hist.observe(value)
+        
+        assert len(hist.samples) == 10
+        assert hist.count == 1000
+    
+    def test_timer_records_into_request_scope(self):
+        """Test timers feed both the registry and the active request"""
+        with metrics.request_scope() as breakdown:
+            with metrics.timer("rag.embed"):
+                pass
+            with metrics.timer("rag.embed"):
+                pass
+        
+        assert "rag.embed" in breakdown["timings_ms"]
+        assert metrics.registry.histograms["rag.embed"].count == 2
+    
+    def test_timer_outside_request_scope(self):
+        """Test timers work without an active request"""
+        with metrics.timer("standalone"):
+            pass
+        
+        assert metrics.registry.histograms["standalone"].count == 1
+    
+    def test_token_callback_reads_llm_output(self):
+        """Test token usage is taken from the provider's llm_output"""
+        response = Mock()
+        response.llm_output = {"token_usage": {"prompt_tokens": 12, "completion_tokens": 3}}
+        
+        with metrics.request_scope() as breakdown:
+            metrics.TokenUsageCallback("llm.classify_intent").on_llm_end(response)
+        
+        assert breakdown["tokens"] == {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15}
+        assert breakdown["model_calls"][0]["model"] is None
+        assert breakdown["model_calls"][0]["cost_usd"] == 0.0
+    
+    def test_token_callback_reads_usage_metadata(self):
+        """Test token usage falls back to message usage_metadata"""
+        message = Mock(usage_metadata={"input_tokens": 7, "output_tokens": 2}, response_metadata={})
+        response = Mock(llm_output=None, generations=[[Mock(message=message)]])
+        
+        with metrics.request_scope() as breakdown:
+            metrics.TokenUsageCallback("llm.rag_answer").on_llm_end(response)
+        
+        assert breakdown["tokens"]["total_tokens"] == 9
+    
+    def test_model_calls_are_priced(self):
+        """Test each call is recorded with its model and cost"""
+        response = Mock()
+        response.llm_output = {
+            "token_usage": {"prompt_tokens": 1000000, "completion_tokens": 1000000},
+            "model_name": "gpt-4o-mini-2024-07-18"
+        }
+        
+        with metrics.request_scope() as breakdown:
+            metrics.TokenUsageCallback("llm.rag_answer").on_llm_end(response)
+        
+        call = breakdown["model_calls"][0]
+        assert call["step"] == "llm.rag_answer"
+        assert call["model"] == "gpt-4o-mini-2024-07-18"
+        assert call["cost_usd"] == pytest.approx(0.75)
+    
+    def test_prometheus_export(self):
+        """Test Prometheus text output contains summaries and counters"""
+        registry = MetricsRegistry()
+        registry.observe("classify_intent", 12.0)
+        registry.increment("agent_tokens_total", 5, step="llm.classify_intent", kind="prompt")
+        
+        text = registry.to_prometheus()
+        
+        assert '# TYPE agent_step_latency_ms summary' in text
+        assert 'agent_step_latency_ms{step="classify_intent",quantile="0.99"} 12.0' in text
+        assert 'agent_step_latency_ms_count{step="classify_intent"} 1' in text
+        assert 'agent_tokens_total{kind="prompt",step="llm.classify_intent"} 5' in text
+    
+    def test_json_export(self):
+        """Test JSON output round-trips"""
+        registry = MetricsRegistry()
+        registry.observe("fetch_weather", 40.0)
+        
+        data = json.loads(registry.to_json())
+        
+        assert data["latency_ms"]["fetch_weather"]["p50"] == 40.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,135 @@
+"""
+Unit tests for schema migrations
+Tests PRAGMA user_version bookkeeping, upgrades of older files and that
+ChatDatabase migrates a file once per process
+"""
+
+import os
+import pytest
+import sqlite3
+import migrations
+from database import ChatDatabase
+
+
+def _tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+
+
+class TestMigrations:
+    """Test suite for the migrations module"""
+
+    @pytest.fixture
+    def db_name(self, tmp_path):
+        """Path of a database file that doesn't exist yet"""
+        return str(tmp_path / "test_chat.db")
+
+    def test_new_file_reaches_current_version(self, db_name):
+        """Test a new file gets every table and records the schema version"""
+        db = ChatDatabase(db_name)
+        conn = db.get_connection()
+
+        assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION
+        assert {
+            "chat_history", "sessions", "chat_history_fts", "session_archive", "trace_spans", "slow_queries",
+            "token_usage", "idx_chat_history_session", "idx_sessions_recent"
+        } <= _tables(conn)
+        conn.close()
+
+    def test_legacy_file_upgraded(self, db_name):
+        """Test a file from before PDFs, sessions and search were stored is brought up to date"""
+        conn = sqlite3.connect(db_name)
+        conn.execute('''
+            CREATE TABLE chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, user_query TEXT NOT NULL,
+                ai_response TEXT NOT NULL, intent TEXT, created_at TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO chat_history (session_id, user_query, ai_response, created_at) "
+                     "VALUES ('old', 'Rain?', 'Yes', '2024-01-01 10:00:00')")
+        conn.commit()
+        conn.close()
+
+        db = ChatDatabase(db_name)
+        db.insert_message("old", "Snow?", "No", "weather", "paper.pdf")
+
+        assert [session["message_count"] for session in db.get_all_sessions()] == [2]
+        assert db.get_session_pdf("old") == "paper.pdf"
+        assert [result["session_id"] for result in db.search("rain")] == ["old"]
+
+    def test_unversioned_current_schema_not_backfilled_twice(self, db_name):
+        """Test a file that already has every table but no version keeps its summaries and index"""
+        db = ChatDatabase(db_name)
+        db.insert_message("s1", "Rain?", "Yes", "weather")
+        conn = sqlite3.connect(db_name)
+        conn.execute("PRAGMA user_version = 0")
+
+        assert migrations.migrate(conn) == migrations.SCHEMA_VERSION
+        assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION
+        conn.close()
+        assert [session["message_count"] for session in db.get_all_sessions()] == [1]
+        assert len(db.search("rain")) == 1
+
+    def test_current_file_not_migrated_again(self, db_name):
+        """Test migrating an up-to-date file does nothing"""
+        ChatDatabase(db_name)
+        conn = sqlite3.connect(db_name)
+
+        assert migrations.migrate(conn) == 0
+        conn.close()
+
+    def test_new_handles_only_read_version(self, db_name):
+        """Test constructing more handles on a migrated file only reads its schema version"""
+        db = ChatDatabase(db_name)
+        statements = []
+        db._connection().set_trace_callback(statements.append)
+
+        ChatDatabase(db_name)
+        ChatDatabase(db_name).migrate()
+
+        db._connection().set_trace_callback(None)
+        assert statements == ["PRAGMA user_version"] * 3
+
+    def test_recreated_file_migrated_again(self, db_name):
+        """Test a file deleted and recreated at the same path gets the schema again"""
+        ChatDatabase(db_name).close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_name + suffix):
+                os.remove(db_name + suffix)
+        sqlite3.connect(db_name).close()
+
+        db = ChatDatabase(db_name)
+        db.insert_message("s1", "Rain?", "Yes", "weather")
+
+        assert migrations.schema_version(db.get_connection()) == migrations.SCHEMA_VERSION
+        assert [session["message_count"] for session in db.get_all_sessions()] == [1]
+
+    def test_failed_migration_rolled_back(self, db_name, monkeypatch):
+        """Test a migration that fails leaves the file at its previous version"""
+        ChatDatabase(db_name)
+
+        def broken(conn):
+            conn.execute("CREATE TABLE half_done (id INTEGER)")
+            conn.execute("SELECT * FROM missing_table")
+        monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [broken])
+        monkeypatch.setattr(migrations, "SCHEMA_VERSION", len(migrations.MIGRATIONS))
+        conn = sqlite3.connect(db_name)
+
+        with pytest.raises(sqlite3.OperationalError):
+            migrations.migrate(conn)
+        assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION - 1
+        assert "half_done" not in _tables(conn)
+        conn.close()
+
+    def test_newer_file_left_alone(self, db_name):
+        """Test a file migrated by newer code isn't downgraded"""
+        ChatDatabase(db_name)
+        conn = sqlite3.connect(db_name)
+        conn.execute(f"PRAGMA user_version = {migrations.SCHEMA_VERSION + 1}")
+
+        assert migrations.migrate(conn) == 0
+        assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION + 1
+        conn.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
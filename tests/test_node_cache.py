@@ -0,0 +1,124 @@
+"""
+Unit tests for the graph node cache
+Tests SQLite and bounded in-memory storage, TTL expiry and hit/miss accounting
+"""
+
+import pytest
+from unittest.mock import patch
+from langchain_core.documents import Document
+import metrics
+import node_cache
+from node_cache import LRUCache, NodeCache, SQLiteCache
+
+
+NAMESPACE = ("__pregel_ns_writes", "agent.node", "fetch_weather")
+
+
+class TestNodeCache:
+    """Test suite for the node_cache module"""
+
+    @pytest.fixture
+    def sqlite_cache(self, tmp_path):
+        """Create a SQLite cache in a temporary file"""
+        return SQLiteCache(str(tmp_path / "node_cache.db"))
+
+    def test_sqlite_round_trip(self, sqlite_cache):
+        """Test node writes, including documents, survive storage"""
+        writes = [("documents", [Document(page_content="chunk", metadata={"page": 1})]), ("city", "Paris")]
+        sqlite_cache.set({(NAMESPACE, "k1"): (writes, None)})
+
+        values = sqlite_cache.get([(NAMESPACE, "k1"), (NAMESPACE, "missing")])
+
+        assert list(values) == [(NAMESPACE, "k1")]
+        documents = dict(values[(NAMESPACE, "k1")])["documents"]
+        assert documents[0].page_content == "chunk"
+        assert documents[0].metadata == {"page": 1}
+
+    def test_sqlite_shared_between_instances(self, sqlite_cache):
+        """Test a second cache on the same file sees stored results"""
+        sqlite_cache.set({(NAMESPACE, "k1"): ([("city", "Paris")], None)})
+
+        other = SQLiteCache(sqlite_cache.db_name)
+
+        writes = other.get([(NAMESPACE, "k1")])[(NAMESPACE, "k1")]
+        assert [tuple(write) for write in writes] == [("city", "Paris")]
+
+    def test_sqlite_ttl_expiry(self, sqlite_cache):
+        """Test entries are not returned after their TTL"""
+        with patch('node_cache.time.time', return_value=1000.0):
+            sqlite_cache.set({(NAMESPACE, "k1"): ([("city", "Paris")], 60)})
+
+        with patch('node_cache.time.time', return_value=1059.0):
+            assert sqlite_cache.get([(NAMESPACE, "k1")])
+        with patch('node_cache.time.time', return_value=1061.0):
+            assert not sqlite_cache.get([(NAMESPACE, "k1")])
+
+    def test_sqlite_clear_namespace(self, sqlite_cache):
+        """Test clearing one node's namespace keeps the others"""
+        other = ("__pregel_ns_writes", "agent.node", "extract_city")
+        sqlite_cache.set({(NAMESPACE, "k1"): ([("a", 1)], None), (other, "k1"): ([("b", 2)], None)})
+
+        sqlite_cache.clear([NAMESPACE])
+
+        assert not sqlite_cache.get([(NAMESPACE, "k1")])
+        assert sqlite_cache.get([(other, "k1")])
+
+    def test_lru_evicts_least_recently_used(self):
+        """Test the in-memory cache keeps at most max_entries, dropping the least recently read"""
+        cache = LRUCache(max_entries=2)
+        cache.set({(NAMESPACE, "k1"): ([("a", 1)], None), (NAMESPACE, "k2"): ([("b", 2)], None)})
+        cache.get([(NAMESPACE, "k1")])
+
+        cache.set({(NAMESPACE, "k3"): ([("c", 3)], None)})
+
+        assert len(cache) == 2
+        assert set(cache.get([(NAMESPACE, "k1"), (NAMESPACE, "k2"), (NAMESPACE, "k3")])) == {
+            (NAMESPACE, "k1"), (NAMESPACE, "k3")
+        }
+
+    def test_lru_ttl_expiry(self):
+        """Test expired in-memory entries are not returned and are dropped"""
+        cache = LRUCache()
+        with patch('node_cache.time.time', return_value=1000.0):
+            cache.set({(NAMESPACE, "k1"): ([("city", "Paris")], 60)})
+
+        with patch('node_cache.time.time', return_value=1059.0):
+            assert cache.get([(NAMESPACE, "k1")])
+        with patch('node_cache.time.time', return_value=1061.0):
+            assert not cache.get([(NAMESPACE, "k1")])
+        assert len(cache) == 0
+
+    def test_records_hits_and_misses(self):
+        """Test lookups are reported per node in the request breakdown"""
+        cache = NodeCache(LRUCache())
+        cache.set({(NAMESPACE, "k1"): ([("city", "Paris")], None)})
+
+        with metrics.request_scope() as breakdown:
+            cache.get([(NAMESPACE, "k2")])
+            assert breakdown["cache"] == {"fetch_weather": "miss"}
+            cache.get([(NAMESPACE, "k1")])
+            assert breakdown["cache"] == {"fetch_weather": "hit"}
+
+    def test_failed_results_not_stored(self):
+        """Test node results that set an error are not cached"""
+        cache = NodeCache(LRUCache())
+
+        cache.set({(NAMESPACE, "k1"): ([("weather_data", {}), ("error", "Weather fetch failed")], None)})
+
+        assert not cache.get([(NAMESPACE, "k1")])
+
+    def test_from_env(self, monkeypatch, tmp_path):
+        """Test the storage backend is selected by AGENT_NODE_CACHE"""
+        monkeypatch.setenv("AGENT_NODE_CACHE", "off")
+        assert node_cache.from_env() is None
+
+        monkeypatch.setenv("AGENT_NODE_CACHE", "sqlite")
+        monkeypatch.setenv("AGENT_NODE_CACHE_PATH", str(tmp_path / "cache.db"))
+        assert isinstance(node_cache.from_env().backend, SQLiteCache)
+
+        monkeypatch.delenv("AGENT_NODE_CACHE")
+        assert isinstance(node_cache.from_env().backend, LRUCache)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,81 @@
+"""
+Unit tests for the per-request profiler
+Tests sampling decisions, thread registration and collapsed-stack output
+"""
+
+import contextvars
+import threading
+import time
+import pytest
+import profiling
+from profiling import Profiler
+
+
+def busy_wait(seconds: float):
+    """Spin so the sampler sees this function on the stack"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiling:
+    """Test suite for the profiling module"""
+
+    def test_should_profile(self):
+        """Test forced, disabled and sampled decisions"""
+        assert Profiler(sample_rate=0).should_profile() is False
+        assert Profiler(sample_rate=1).should_profile() is True
+        assert Profiler(sample_rate=0).should_profile(force=True) is True
+        assert Profiler(sample_rate=1).should_profile(force=False) is False
+
+    def test_not_profiling_yields_none(self, tmp_path):
+        """Test unprofiled calls write nothing"""
+        profiler = Profiler(sample_rate=0, output_dir=str(tmp_path))
+
+        with profiler.profile("agent_run") as profile:
+            pass
+
+        assert profile is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_writes_collapsed_stacks(self, tmp_path):
+        """Test a profiled block produces a flame graph file naming its hot function"""
+        profiler = Profiler(output_dir=str(tmp_path), interval_ms=1)
+
+        with profiler.profile("agent_run", force=True) as profile:
+            busy_wait(0.1)
+
+        assert profile.path.startswith(str(tmp_path))
+        lines = open(profile.path).read().split("\n")
+        stack, count = lines[0].rsplit(" ", 1)
+        assert int(count) > 0
+        assert any("busy_wait (test_profiling.py:" in line for line in lines)
+
+    def test_registered_threads_are_sampled(self, tmp_path):
+        """Test work on another thread is included once that thread registers"""
+        profiler = Profiler(output_dir=str(tmp_path), interval_ms=1)
+
+        def worker():
+            profiling.register_thread()
+            busy_wait(0.1)
+
+        with profiler.profile("load_pdf", force=True) as profile:
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(worker,))
+            thread.start()
+            thread.join()
+
+        assert any("worker" in stack for stack in profile.stacks)
+
+    def test_from_env(self, monkeypatch):
+        """Test profiler configuration from environment variables"""
+        monkeypatch.setenv("AGENT_PROFILE_RATE", "0.01")
+        monkeypatch.setenv("AGENT_PROFILE_DIR", "/tmp/agent-profiles")
+
+        profiler = Profiler.from_env()
+
+        assert profiler.sample_rate == 0.01
+        assert profiler.output_dir == "/tmp/agent-profiles"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
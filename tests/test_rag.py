@@ -5,7 +5,12 @@ Tests PDF loading, retrieval, and querying with mocked dependencies
 
 import pytest
 from unittest.mock import Mock, patch, MagicMock
+from langchain_core.runnables import RunnableLambda
+import deadline
 from rag import RAGTool
+from database import ChatDatabase
+from resilience import CircuitBreaker, CircuitOpenError
+from benchmarks.fakes import FakeEmbeddings, in_memory_qdrant, write_sample_pdf
 
 
 class TestRAGTool:
@@ -56,8 +61,21 @@ class TestRAGTool:
         result = rag_tool.load_pdf("test.pdf")
         
         assert result is True
-        assert rag_tool.current_pdf_name == "test.pdf"
-        assert rag_tool.current_collection_name == "pdf_test"
+        assert rag_tool.has_pdf("test.pdf")
+        assert "pdf_test" in rag_tool._vectorstores
+    
+    def test_load_pdf_records_ingest_usage(self, tmp_path):
+        """Test embedding tokens spent on ingestion are attributed to the PDF"""
+        db_name = str(tmp_path / "chat.db")
+        pdf_path = tmp_path / "paper.pdf"
+        write_sample_pdf(str(pdf_path), pages=2)
+        rag_tool = RAGTool(llm=Mock(), embeddings=FakeEmbeddings(), client=in_memory_qdrant(), db_name=db_name)
+        
+        assert rag_tool.load_pdf(str(pdf_path)) is True
+        
+        spent = ChatDatabase(db_name).get_usage(pdf_name="paper.pdf")
+        assert spent["prompt_tokens"] > 0
+        assert spent["completion_tokens"] == 0
     
     @patch('rag.PyPDFLoader')
     def test_load_pdf_failure(self, mock_loader, rag_tool):
@@ -69,25 +87,26 @@ class TestRAGTool:
         
         assert result is False
     
-    def test_switch_to_pdf_exists(self, rag_tool):
-        """Test switching to existing PDF collection"""
+    def test_has_pdf_exists(self, rag_tool):
+        """Test checking an existing PDF collection"""
         # Mock collection exists
         mock_collection = Mock()
         mock_collection.name = "pdf_test"
         rag_tool.client.get_collections.return_value.collections = [mock_collection]
         
         with patch('rag.QdrantVectorStore') as mock_vs:
-            result = rag_tool.switch_to_pdf("test.pdf")
+            assert rag_tool.has_pdf("test.pdf") is True
+            assert rag_tool.has_pdf("test.pdf") is True
             
-            assert result is True
-            assert rag_tool.current_pdf_name == "test.pdf"
+            # The vector store handle is built once and shared
+            assert mock_vs.call_count == 1
     
-    def test_switch_to_pdf_not_exists(self, rag_tool):
-        """Test switching to non-existent PDF collection"""
+    def test_has_pdf_not_exists(self, rag_tool):
+        """Test checking a non-existent PDF collection"""
         # Mock collection doesn't exist
         rag_tool.client.get_collections.return_value.collections = []
         
-        result = rag_tool.switch_to_pdf("test.pdf")
+        result = rag_tool.has_pdf("test.pdf")
         
         assert result is False
     
@@ -113,53 +132,176 @@ class TestRAGTool:
         assert result[0].page_content == "Content 2"
         assert result[1].page_content == "Content 0"
     
-    @patch('rag.StrOutputParser')
-    @patch('rag.ChatPromptTemplate')
-    def test_query_no_vectorstore(self, mock_prompt, mock_parser, rag_tool):
+    def test_query_no_vectorstore(self, rag_tool):
         """Test query when no PDF is loaded"""
-        rag_tool.vectorstore = None
-        
         result = rag_tool.query("What is this about?")
         
         assert "No PDF loaded" in result["answer"]
         assert result["sources"] == []
 
-    @patch('rag.StrOutputParser')
-    @patch('rag.ChatPromptTemplate')
     @patch('flashrank.Ranker')
-    def test_query_with_results(self, mock_ranker_class, mock_prompt_class, mock_parser_class, rag_tool):
+    def test_query_with_results(self, mock_ranker_class, rag_tool):
         """Test successful query with results"""
         # Setup mocks for documents and retriever
         mock_doc = Mock()
         mock_doc.page_content = "Test content"
         mock_doc.metadata = {"page": 1}
         
-        mock_retriever = Mock()
-        mock_retriever.invoke.return_value = [mock_doc]
+        rag_tool.embeddings = Mock()
+        rag_tool.embeddings.embed_query.return_value = [0.1, 0.2]
         
-        rag_tool.vectorstore = Mock()
-        rag_tool.vectorstore.as_retriever.return_value = mock_retriever
-        rag_tool.current_collection_name = "pdf_test"
+        vectorstore = Mock()
+        vectorstore.similarity_search_by_vector.return_value = [mock_doc]
+        rag_tool._vectorstores["pdf_test"] = vectorstore
         
         # Mock reranker
         mock_ranker = Mock()
         mock_ranker.rerank.return_value = [{"id": 0, "score": 0.9}]
         mock_ranker_class.return_value = mock_ranker
         
-        # Mock the entire LangChain chain
-        mock_chain = Mock()
-        mock_chain.invoke.return_value = "This is the answer"
-        
-        # Mock the chain construction (prompt | llm | parser)
-        # This simulates the `__or__` method used for the `|` pipe operator in LCEL
-        mock_prompt_instance = mock_prompt_class.from_messages.return_value
-        mock_prompt_instance.__or__.return_value.__or__.return_value = mock_chain
+        # Mock the precompiled LangChain chain (prompt | llm | parser)
+        rag_tool.qa_chain = Mock()
+        rag_tool.qa_chain.invoke.return_value = "This is the answer"
         
         # Test the query method
-        result = rag_tool.query("What is this about?")
+        result = rag_tool.query("What is this about?", pdf_name="test.pdf")
         
         assert result["answer"] == "This is the answer"
         assert len(result["sources"]) > 0
+        vectorstore.similarity_search_by_vector.assert_called_once_with([0.1, 0.2], k=5)
+
+    def test_embed_queries_groups_calls(self, rag_tool):
+        """Test batch embedding makes one request and caches the vectors"""
+        rag_tool.embeddings = Mock()
+        rag_tool.embeddings.embed_documents.return_value = [[0.1], [0.2]]
+        
+        vectors = rag_tool.embed_queries(["a", "b", "a"])
+        
+        assert vectors == [[0.1], [0.2], [0.1]]
+        rag_tool.embeddings.embed_documents.assert_called_once_with(["a", "b"])
+        
+        # Cached questions are not embedded again
+        rag_tool.embed_queries(["b"])
+        assert rag_tool.embeddings.embed_documents.call_count == 1
+
+    @patch('flashrank.Ranker')
+    def test_query_uses_cached_embedding(self, mock_ranker_class, rag_tool):
+        """Test query searches by vector when the question was pre-embedded"""
+        mock_doc = Mock(page_content="Test content", metadata={"page": 1})
+        vectorstore = Mock()
+        vectorstore.similarity_search_by_vector.return_value = [mock_doc]
+        rag_tool._vectorstores["pdf_test"] = vectorstore
+        rag_tool.embeddings = Mock()
+        rag_tool.embeddings.embed_documents.return_value = [[0.5, 0.5]]
+        rag_tool.embed_queries(["What is this about?"])
+        
+        mock_ranker_class.return_value.rerank.return_value = [{"id": 0, "score": 0.9}]
+        rag_tool.qa_chain = Mock()
+        rag_tool.qa_chain.invoke.return_value = "This is the answer"
+        
+        result = rag_tool.query("What is this about?", pdf_name="test.pdf")
+        
+        assert result["answer"] == "This is the answer"
+        vectorstore.similarity_search_by_vector.assert_called_once_with([0.5, 0.5], k=5)
+        rag_tool.embeddings.embed_query.assert_not_called()
+
+    @patch('flashrank.Ranker')
+    def test_query_sessions_use_their_own_pdf(self, mock_ranker_class, rag_tool):
+        """Test sessions on different PDFs don't see each other's documents"""
+        docs = {
+            "pdf_alpha": [Mock(page_content="alpha content", metadata={})],
+            "pdf_beta": [Mock(page_content="beta content", metadata={})]
+        }
+        for collection_name, collection_docs in docs.items():
+            vectorstore = Mock()
+            vectorstore.similarity_search_by_vector.return_value = collection_docs
+            rag_tool._vectorstores[collection_name] = vectorstore
+        rag_tool.embeddings = Mock()
+        rag_tool.embeddings.embed_query.return_value = [0.1]
+        mock_ranker_class.return_value.rerank.return_value = [{"id": 0, "score": 0.9}]
+        rag_tool.qa_chain = Mock()
+        rag_tool.qa_chain.invoke.side_effect = lambda inputs, **kwargs: inputs["context"]
+        
+        alpha = rag_tool.query("Q", pdf_name="alpha.pdf")
+        beta = rag_tool.query("Q", pdf_name="beta.pdf")
+        
+        assert alpha["answer"] == "alpha content"
+        assert beta["answer"] == "beta content"
+
+    def test_ingest_id_read_from_collection(self, rag_tool):
+        """Test the ingestion id of an existing collection is read once from its chunks"""
+        mock_collection = Mock()
+        mock_collection.name = "pdf_test"
+        rag_tool.client.get_collections.return_value.collections = [mock_collection]
+        point = Mock(payload={"page_content": "x", "metadata": {"ingest_id": "abc123"}})
+        rag_tool.client.scroll.return_value = ([point], None)
+        
+        assert rag_tool.ingest_id("test.pdf") == "abc123"
+        assert rag_tool.ingest_id("test.pdf") == "abc123"
+        assert rag_tool.client.scroll.call_count == 1
+        assert rag_tool.ingest_id("") == ""
+
+    def test_qdrant_outage_fails_fast(self, rag_tool):
+        """Test queries stop reaching Qdrant once its circuit opens"""
+        vectorstore = Mock()
+        vectorstore.similarity_search_by_vector.side_effect = ConnectionError("Qdrant unreachable")
+        rag_tool._vectorstores["pdf_test"] = vectorstore
+        rag_tool.embeddings = Mock()
+        rag_tool.embeddings.embed_query.return_value = [0.1]
+        rag_tool.qdrant_breaker = CircuitBreaker("qdrant", failure_threshold=2)
+
+        for _ in range(2):
+            assert "Qdrant unreachable" in rag_tool.query("Q", pdf_name="test.pdf")["answer"]
+        result = rag_tool.query("Q", pdf_name="test.pdf")
+
+        assert "qdrant is unavailable" in result["answer"]
+        assert vectorstore.similarity_search_by_vector.call_count == 2
+
+    def test_model_outage_fails_fast(self, monkeypatch):
+        """Test answers stop calling the chat model once its circuit opens"""
+        monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+        calls = []
+
+        def unreachable(prompt):
+            calls.append(prompt)
+            raise ConnectionError("OpenAI unreachable")
+
+        rag_tool = RAGTool(llm=RunnableLambda(unreachable), embeddings=FakeEmbeddings(), client=Mock())
+        documents = [Mock(page_content="Test content", metadata={})]
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                rag_tool.answer("Q", documents)
+        with pytest.raises(CircuitOpenError):
+            rag_tool.answer("Q", documents)
+
+        assert len(calls) == 2
+
+    def test_shared_model_breaker_open_fails_fast(self):
+        """Test a breaker opened by another caller of the model stops answers too"""
+        llm = Mock()
+        breaker = CircuitBreaker("chat", failure_threshold=1)
+        with pytest.raises(ConnectionError):
+            breaker.call(Mock(side_effect=ConnectionError("OpenAI unreachable")))
+        rag_tool = RAGTool(llm=llm, embeddings=FakeEmbeddings(), client=Mock(), model_breaker=breaker)
+
+        with pytest.raises(CircuitOpenError):
+            rag_tool.answer("Q", [Mock(page_content="Test content", metadata={})])
+
+        llm.invoke.assert_not_called()
+
+    def test_answer_timeout_capped_by_deadline(self):
+        """Test answer generation never outlasts the request's deadline"""
+        llm = Mock()
+        llm.invoke.return_value = "This is the answer"
+        rag_tool = RAGTool(llm=llm, embeddings=FakeEmbeddings(), client=Mock())
+        documents = [Mock(page_content="Test content", metadata={})]
+
+        with deadline.scope(deadline.from_budget(1000)):
+            result = rag_tool.answer("Q", documents)
+
+        assert result["answer"] == "This is the answer"
+        assert 0 < llm.invoke.call_args[1]["timeout"] <= 1
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
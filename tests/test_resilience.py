@@ -0,0 +1,302 @@
+"""
+Unit tests for circuit breakers and request hedging
+Tests state transitions, recovery probes and hedged calls
+"""
+
+import asyncio
+import threading
+import time
+import pytest
+from langchain_core.runnables import RunnableLambda
+import deadline
+import metrics
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, Hedger
+
+
+def failing():
+    raise ConnectionError("dependency down")
+
+
+class TestCircuitBreaker:
+    """Test suite for CircuitBreaker"""
+
+    @pytest.fixture
+    def breaker(self):
+        """Create a breaker that opens after three failures and probes after 50 ms"""
+        return CircuitBreaker("test", failure_threshold=3, recovery_timeout=0.05, excluded=(KeyError,))
+
+    def test_opens_after_consecutive_failures(self, breaker):
+        """Test the circuit opens on the threshold and then fails without calling"""
+        calls = []
+
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+
+        assert breaker.state == resilience.OPEN
+        with pytest.raises(CircuitOpenError, match="test is unavailable"):
+            breaker.call(calls.append, 1)
+        assert calls == []
+
+    def test_success_resets_failure_count(self, breaker):
+        """Test only failures in a row open the circuit"""
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+        breaker.call(lambda: None)
+        with pytest.raises(ConnectionError):
+            breaker.call(failing)
+
+        assert breaker.state == resilience.CLOSED
+
+    def test_excluded_errors_not_counted(self, breaker):
+        """Test errors that say nothing about the dependency's health don't open it"""
+        def unknown():
+            raise KeyError("unknown city")
+
+        for _ in range(5):
+            with pytest.raises(KeyError):
+                breaker.call(unknown)
+
+        assert breaker.state == resilience.CLOSED
+
+    def test_client_errors_not_counted(self, breaker):
+        """Test rejected requests don't open the circuit but rate limiting and server errors do"""
+        class StatusError(Exception):
+            def __init__(self, status_code):
+                super().__init__(f"HTTP {status_code}")
+                self.status_code = status_code
+
+        def rejected(status_code):
+            raise StatusError(status_code)
+
+        for status in [400, 401, 403, 422, 400]:
+            with pytest.raises(StatusError):
+                breaker.call(rejected, status)
+        assert breaker.state == resilience.CLOSED
+
+        for status in [429, 503, 500]:
+            with pytest.raises(StatusError):
+                breaker.call(rejected, status)
+        assert breaker.state == resilience.OPEN
+
+    def test_errors_after_deadline_not_counted(self, breaker):
+        """Test timeouts cut short by the caller's own deadline don't open the circuit"""
+        def timed_out():
+            time.sleep(0.02)
+            raise TimeoutError("read timed out")
+
+        with deadline.scope(deadline.from_budget(10)):
+            for _ in range(5):
+                with pytest.raises(TimeoutError):
+                    breaker.call(timed_out)
+        assert breaker.state == resilience.CLOSED
+
+        with deadline.scope(deadline.from_budget(10_000)):
+            for _ in range(3):
+                with pytest.raises(TimeoutError):
+                    breaker.call(timed_out)
+        assert breaker.state == resilience.OPEN
+
+    def test_probe_closes_recovered_circuit(self, breaker):
+        """Test a successful probe after the recovery timeout closes the circuit"""
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+        time.sleep(0.06)
+
+        assert breaker.state == resilience.HALF_OPEN
+        assert breaker.call(lambda: "ok") == "ok"
+        assert breaker.state == resilience.CLOSED
+
+    def test_failed_probe_reopens_circuit(self, breaker):
+        """Test a failed probe opens the circuit for another recovery timeout"""
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+        time.sleep(0.06)
+
+        with pytest.raises(ConnectionError):
+            breaker.call(failing)
+
+        assert breaker.state == resilience.OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: "ok")
+
+    def test_half_open_allows_one_probe_at_a_time(self, breaker):
+        """Test callers arriving during a probe are rejected instead of piling on"""
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+        time.sleep(0.06)
+        probing = threading.Event()
+        release = threading.Event()
+
+        def probe():
+            probing.set()
+            release.wait(1)
+
+        thread = threading.Thread(target=breaker.call, args=(probe,))
+        thread.start()
+        probing.wait(1)
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: "ok")
+        release.set()
+        thread.join()
+
+        assert breaker.state == resilience.CLOSED
+
+    def test_disabled_breaker_never_opens(self):
+        """Test a zero threshold turns circuit breaking off"""
+        breaker = CircuitBreaker("test", failure_threshold=0)
+
+        for _ in range(10):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+
+        assert breaker.state == resilience.CLOSED
+
+    def test_metrics_recorded(self, breaker):
+        """Test state changes and rejections are counted"""
+        metrics.registry.reset()
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                breaker.call(failing)
+        with pytest.raises(CircuitOpenError):
+            breaker.call(failing)
+
+        counters = {
+            (counter["name"], tuple(sorted(counter["labels"].items()))): counter["value"]
+            for counter in metrics.registry.snapshot()["counters"]
+        }
+        assert counters[("circuit_state_changes_total", (("circuit", "test"), ("state", "open")))] == 1
+        assert counters[("circuit_rejections_total", (("circuit", "test"),))] == 1
+
+    def test_acall(self, breaker):
+        """Test coroutines go through the breaker too"""
+        async def afailing():
+            raise ConnectionError("dependency down")
+
+        async def scenario():
+            for _ in range(3):
+                with pytest.raises(ConnectionError):
+                    await breaker.acall(afailing)
+            with pytest.raises(CircuitOpenError):
+                await breaker.acall(afailing)
+
+        asyncio.run(scenario())
+
+    def test_guard_runnable(self, breaker):
+        """Test a guarded runnable fails fast once its circuit is open"""
+        model = RunnableLambda(lambda prompt: failing())
+        guarded = breaker.guard(model)
+
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                guarded.invoke("hello")
+        with pytest.raises(CircuitOpenError):
+            guarded.invoke("hello")
+
+    def test_guard_passes_result_through(self, breaker):
+        """Test a guarded runnable returns the wrapped runnable's output"""
+        assert breaker.guard(RunnableLambda(str.upper)).invoke("hi") == "HI"
+
+    def test_from_env(self, monkeypatch):
+        """Test thresholds come from the environment"""
+        monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+        monkeypatch.setenv("CIRCUIT_RECOVERY_SECONDS", "7")
+
+        breaker = CircuitBreaker.from_env("weather")
+
+        assert breaker.failure_threshold == 2
+        assert breaker.recovery_timeout == 7
+
+
+class TestHedger:
+    """Test suite for Hedger"""
+
+    @pytest.fixture
+    def hedger(self):
+        """Create a hedger at p50 warmed up with five 50 ms calls"""
+        hedger = Hedger("test", percentile=50, min_samples=5)
+        for _ in range(5):
+            hedger.call(time.sleep, 0.05)
+        return hedger
+
+    def test_no_hedging_until_warmed_up(self):
+        """Test calls aren't hedged before enough latencies are observed"""
+        hedger = Hedger("test", percentile=50, min_samples=5)
+
+        assert hedger.delay() is None
+        for _ in range(5):
+            hedger.call(lambda: None)
+        assert hedger.delay() is not None
+
+    def test_disabled_hedger_runs_inline(self):
+        """Test calls run in the caller's thread when hedging is off"""
+        hedger = Hedger("test", percentile=0, min_samples=0)
+
+        assert hedger.call(threading.current_thread) is threading.current_thread()
+        assert hedger.delay() is None
+
+    def test_slow_call_hedged(self, hedger):
+        """Test a call slower than the percentile is duplicated and the fast attempt wins"""
+        attempts = []
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                attempts.append(1)
+                first = len(attempts) == 1
+            time.sleep(0.5 if first else 0.01)
+            return "slow" if first else "fast"
+
+        start = time.monotonic()
+        assert hedger.call(call) == "fast"
+        assert time.monotonic() - start < 0.3
+        assert len(attempts) == 2
+
+    def test_fast_call_not_hedged(self, hedger):
+        """Test calls finishing within the percentile run once"""
+        attempts = []
+
+        assert hedger.call(lambda: attempts.append(1) or "ok") == "ok"
+        assert len(attempts) == 1
+
+    def test_failed_attempt_falls_back(self, hedger):
+        """Test a failing attempt doesn't hide the other attempt's result"""
+        attempts = []
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                attempts.append(1)
+                first = len(attempts) == 1
+            if first:
+                time.sleep(0.1)
+                raise ConnectionError("reset")
+            time.sleep(0.1)
+            return "ok"
+
+        assert hedger.call(call) == "ok"
+
+    def test_all_attempts_fail(self, hedger):
+        """Test the error is raised when every attempt fails"""
+        def call():
+            time.sleep(0.1)
+            raise ConnectionError("down")
+
+        with pytest.raises(ConnectionError):
+            hedger.call(call)
+
+    def test_from_env(self, monkeypatch):
+        """Test the hedging percentile comes from <NAME>_HEDGE_PERCENTILE"""
+        monkeypatch.setenv("QDRANT_HEDGE_PERCENTILE", "95")
+
+        assert Hedger.from_env("qdrant").percentile == 95
+        assert Hedger.from_env("weather").percentile is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,138 @@
+"""
+Unit tests for the model call scheduler
+Tests token buckets, priority ordering and load shedding with real (short) waits
+"""
+
+import threading
+import time
+import pytest
+from unittest.mock import Mock
+from langchain_core.prompts import ChatPromptTemplate
+import deadline
+import metrics
+import scheduler
+from scheduler import AdmissionError, ModelScheduler, ScheduledEmbeddings, TokenBucket
+
+
+class TestScheduler:
+    """Test suite for the scheduler module"""
+    
+    def test_token_bucket_refill(self):
+        """Test a drained bucket reports the wait until it refills"""
+        bucket = TokenBucket(per_minute=60, capacity=1)
+        now = bucket.updated
+        
+        assert bucket.time_until(1, now) == 0.0
+        bucket.take(1, now)
+        assert bucket.time_until(1, now) == pytest.approx(1.0)
+        assert bucket.time_until(1, now + 1.0) == 0.0
+    
+    def test_acquire_within_budget(self):
+        """Test calls inside the budget are admitted immediately"""
+        sched = ModelScheduler("chat", requests_per_minute=600, tokens_per_minute=60000)
+        
+        for _ in range(5):
+            assert sched.acquire(tokens=100) < 0.05
+    
+    def test_sheds_when_budget_cannot_recover(self):
+        """Test a call is rejected with a clear error instead of waiting past its deadline"""
+        sched = ModelScheduler("chat", requests_per_minute=1, tokens_per_minute=1000, max_queue_wait=0.2)
+        sched.acquire()
+        
+        start = time.monotonic()
+        with pytest.raises(AdmissionError) as exc_info:
+            sched.acquire()
+        
+        assert time.monotonic() - start < 0.1
+        assert "chat model capacity exhausted" in str(exc_info.value)
+        assert sched.queue_depth == 0
+    
+    def test_queue_wait_capped_by_request_deadline(self):
+        """Test a queued call is shed when the request deadline comes before its budget"""
+        sched = ModelScheduler("chat", requests_per_minute=60, tokens_per_minute=60000, max_queue_wait=30, burst_seconds=1)
+        sched.acquire()
+        
+        with deadline.scope(deadline.from_budget(200)):
+            start = time.monotonic()
+            with pytest.raises(AdmissionError):
+                sched.acquire()
+        
+        assert time.monotonic() - start < 0.1
+    
+    def test_token_budget_is_enforced(self):
+        """Test a call larger than the remaining token budget waits"""
+        sched = ModelScheduler("embeddings", requests_per_minute=6000, tokens_per_minute=600,
+                               max_queue_wait=0.05, burst_seconds=10)
+        sched.acquire(tokens=100)
+        
+        with pytest.raises(AdmissionError):
+            sched.acquire(tokens=100)
+    
+    def test_interactive_admitted_before_background(self):
+        """Test interactive calls jump ahead of queued background calls"""
+        # 20 requests/s with a burst of one: each call waits ~50ms for a refill
+        sched = ModelScheduler("chat", requests_per_minute=1200, tokens_per_minute=10**6,
+                               max_queue_wait=2.0, burst_seconds=0.05)
+        sched.acquire()
+        order = []
+        
+        def call(level, label):
+            sched.acquire(priority=level)
+            order.append(label)
+        
+        background = threading.Thread(target=call, args=(scheduler.BACKGROUND, "background"))
+        background.start()
+        time.sleep(0.01)
+        interactive = threading.Thread(target=call, args=(scheduler.INTERACTIVE, "interactive"))
+        interactive.start()
+        background.join()
+        interactive.join()
+        
+        assert order == ["interactive", "background"]
+    
+    def test_priority_context(self):
+        """Test the priority context sets the default for calls inside it"""
+        sched = ModelScheduler("chat", requests_per_minute=1, tokens_per_minute=1000, max_queue_wait=0)
+        sched.acquire()
+        
+        with scheduler.priority(scheduler.BACKGROUND):
+            with pytest.raises(AdmissionError) as exc_info:
+                sched.acquire()
+        
+        assert "background call" in str(exc_info.value)
+    
+    def test_gate_admits_prompt(self):
+        """Test the chain gate reserves budget and passes the prompt through"""
+        sched = Mock(wraps=ModelScheduler("chat", requests_per_minute=60, tokens_per_minute=100000))
+        gate = ModelScheduler.gate(sched)
+        prompt = ChatPromptTemplate.from_template("Query: {query}")
+        
+        result = (prompt | gate).invoke({"query": "x" * 400})
+        
+        assert result.to_string().endswith("x" * 400)
+        tokens = sched.acquire.call_args[0][0]
+        assert tokens >= 100 + scheduler.COMPLETION_TOKEN_ESTIMATE
+    
+    def test_scheduled_embeddings(self):
+        """Test embedding calls are admitted before reaching the client and their tokens recorded"""
+        inner = Mock(model="text-embedding-ada-002")
+        inner.embed_documents.return_value = [[0.1], [0.2]]
+        sched = Mock()
+        
+        embeddings = ScheduledEmbeddings(inner, sched)
+        with metrics.request_scope() as breakdown:
+            vectors = embeddings.embed_documents(["a" * 40, "b" * 40])
+        
+        assert vectors == [[0.1], [0.2]]
+        sched.acquire.assert_called_once_with(20)
+        assert breakdown["model_calls"] == [{
+            "step": "embeddings",
+            "model": "text-embedding-ada-002",
+            "prompt_tokens": 20,
+            "completion_tokens": 0,
+            "cost_usd": pytest.approx(0.000002)
+        }]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,106 @@
+"""
+Unit tests for tracing
+Tests span nesting, the disabled fast path and persistence
+"""
+
+import pytest
+from unittest.mock import Mock
+import tracing
+from tracing import Tracer
+from database import ChatDatabase
+
+
+class TestTracing:
+    """Test suite for the tracing module"""
+    
+    @pytest.fixture
+    def db(self, tmp_path):
+        """Create a temporary test database"""
+        return ChatDatabase(db_name=str(tmp_path / "test_chat.db"))
+    
+    def test_disabled_tracer_is_noop(self):
+        """Test nothing is collected when tracing is off"""
+        tracer = Tracer()
+        
+        with tracer.trace("agent.run") as trace:
+            with tracing.span("classify_intent") as span:
+                assert span is None
+            assert tracing.current_trace_id() is None
+        
+        assert trace is None
+    
+    def test_spans_nest_under_parents(self):
+        """Test child spans record their enclosing span as parent"""
+        tracer = Tracer(enabled=True)
+        
+        with tracer.trace("agent.run", query="hi") as trace:
+            with tracing.span("query_documents") as node:
+                with tracing.span("rag.rerank") as rerank:
+                    tracing.add_attributes(documents=5)
+        
+        assert node.parent_id == trace.root.span_id
+        assert rerank.parent_id == node.span_id
+        assert rerank.attributes == {"documents": 5}
+        assert trace.duration_ms >= rerank.duration_ms
+        
+        tree = trace.span_tree()
+        assert tree["name"] == "agent.run"
+        assert tree["children"][0]["children"][0]["name"] == "rag.rerank"
+    
+    def test_span_records_error(self):
+        """Test a span that raises keeps the error message"""
+        tracer = Tracer(enabled=True)
+        
+        with pytest.raises(ValueError):
+            with tracer.trace("agent.run") as trace:
+                with tracing.span("fetch_weather"):
+                    raise ValueError("boom")
+        
+        assert trace.spans[1].error == "ValueError: boom"
+        assert trace.root.error == "ValueError: boom"
+    
+    def test_persist_spans_and_slow_query(self, db):
+        """Test spans are stored per message and slow requests are logged"""
+        tracer = Tracer(enabled=True, slow_query_ms=0)
+        message_id = db.insert_message("session_001", "Q", "A", "document")
+        
+        with tracer.trace("agent.run") as trace:
+            with tracing.span("rag.vector_search"):
+                pass
+        
+        tracer.persist(trace, db, message_id, "session_001", "Q")
+        
+        spans = db.get_trace(trace.trace_id)
+        assert [s["name"] for s in spans] == ["agent.run", "rag.vector_search"]
+        assert all(s["message_id"] == message_id for s in spans)
+        
+        slow = db.get_slow_queries()
+        assert len(slow) == 1
+        assert slow[0]["span_tree"]["children"][0]["name"] == "rag.vector_search"
+    
+    def test_slow_query_log_without_full_tracing(self):
+        """Test fast requests are not logged and spans aren't stored when only the slow log is on"""
+        tracer = Tracer(slow_query_ms=60000)
+        db = Mock()
+        
+        with tracer.trace("agent.run") as trace:
+            pass
+        
+        tracer.persist(trace, db, 1, "session_001", "Q")
+        
+        db.insert_spans.assert_not_called()
+        db.insert_slow_query.assert_not_called()
+    
+    def test_from_env(self, monkeypatch):
+        """Test tracer configuration from environment variables"""
+        monkeypatch.setenv("AGENT_TRACING", "1")
+        monkeypatch.setenv("AGENT_SLOW_QUERY_MS", "1500")
+        
+        tracer = Tracer.from_env()
+        
+        assert tracer.enabled is True
+        assert tracer.slow_query_ms == 1500.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,82 @@
+"""
+Unit tests for token accounting and session budgets
+Tests model pricing, budget states and usage aggregation in ChatDatabase
+"""
+
+import pytest
+import usage
+from database import ChatDatabase
+from usage import SessionBudget
+
+
+class TestUsage:
+    """Test suite for the usage module"""
+
+    @pytest.fixture
+    def db(self, tmp_path):
+        """Create a temporary test database"""
+        return ChatDatabase(db_name=str(tmp_path / "test_chat.db"))
+
+    def test_cost_uses_base_model_price(self):
+        """Test dated model versions are priced as their base model, not a shorter prefix"""
+        assert usage.cost_usd("gpt-4o-mini-2024-07-18", 1000000, 1000000) == pytest.approx(0.75)
+        assert usage.cost_usd("gpt-4o", 1000000) == pytest.approx(2.50)
+
+    def test_unknown_model_is_free(self):
+        """Test unpriced models don't break accounting"""
+        assert usage.cost_usd(None, 500, 20) == 0.0
+        assert usage.cost_usd("fake-chat", 500, 20) == 0.0
+
+    def test_budget_status(self):
+        """Test sessions move from ok to economy to exhausted on either limit"""
+        budget = SessionBudget(max_tokens=1000, max_cost_usd=0.01, economy_ratio=0.8)
+
+        assert budget.status({"total_tokens": 100, "cost_usd": 0.001}) == usage.OK
+        assert budget.status({"total_tokens": 800, "cost_usd": 0.001}) == usage.ECONOMY
+        assert budget.status({"total_tokens": 100, "cost_usd": 0.009}) == usage.ECONOMY
+        assert budget.status({"total_tokens": 1000, "cost_usd": 0.0}) == usage.EXHAUSTED
+
+    def test_budget_from_env(self, monkeypatch):
+        """Test budgets are disabled unless configured"""
+        assert SessionBudget.from_env().enabled is False
+
+        monkeypatch.setenv("SESSION_TOKEN_BUDGET", "50000")
+        budget = SessionBudget.from_env()
+
+        assert budget.enabled is True
+        assert budget.max_tokens == 50000
+        assert budget.max_cost_usd is None
+
+    def test_usage_aggregated_by_session_pdf_and_request(self, db):
+        """Test stored calls are summed per session, per PDF and per request"""
+        call = {"step": "llm.rag_answer", "model": "gpt-4o-mini", "prompt_tokens": 100,
+                "completion_tokens": 10, "cost_usd": 0.001}
+        db.insert_usage([
+            {**call, "message_id": 1, "session_id": "s1", "pdf_name": "a.pdf"},
+            {**call, "message_id": 2, "session_id": "s1", "pdf_name": None},
+            {**call, "message_id": 3, "session_id": "s2", "pdf_name": "a.pdf"},
+            {**call, "step": "embeddings", "completion_tokens": 0, "pdf_name": "a.pdf"}
+        ])
+
+        assert db.get_usage(session_id="s1") == {
+            "prompt_tokens": 200, "completion_tokens": 20, "total_tokens": 220,
+            "cost_usd": pytest.approx(0.002), "calls": 2
+        }
+        assert db.get_usage(pdf_name="a.pdf")["total_tokens"] == 320
+        assert db.get_usage(message_id=3)["calls"] == 1
+        assert db.get_usage()["calls"] == 4
+
+    def test_usage_survives_clear_session(self, db):
+        """Test clearing a session's history doesn't reset its spend"""
+        db.insert_usage([{"session_id": "s1", "step": "llm.classify_intent", "model": "gpt-4o-mini",
+                          "prompt_tokens": 50, "completion_tokens": 1, "cost_usd": 0.0}])
+
+        db.clear_session("s1")
+        assert db.get_usage(session_id="s1")["total_tokens"] == 51
+
+        db.clear_all()
+        assert db.get_usage(session_id="s1")["total_tokens"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
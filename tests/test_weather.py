@@ -3,9 +3,44 @@ Unit tests for WeatherTool
 Tests weather API handling without making real API calls
 """
 
+import asyncio
+import time
+from email.utils import formatdate
 import pytest
+import requests
 from unittest.mock import Mock, patch
-from weather import WeatherTool
+import metrics
+import weather
+import resilience
+from benchmarks.weather_http import StubWeatherServer
+from resilience import CircuitBreaker, CircuitOpenError, Hedger
+from weather import UnknownCityError, WeatherAPIError, WeatherTool
+
+
+def api_response(name="London", temp=15.5):
+    """Build a successful OpenWeatherMap response"""
+    response = Mock()
+    response.json.return_value = {
+        "name": name,
+        "sys": {"country": "GB"},
+        "main": {"temp": temp, "feels_like": temp - 1, "humidity": 72},
+        "weather": [{"description": "cloudy"}],
+        "wind": {"speed": 5.5}
+    }
+    response.raise_for_status = Mock()
+    return response
+
+
+def not_found_response():
+    """Build a 404 OpenWeatherMap response"""
+    response = Mock(status_code=404)
+    response.raise_for_status.side_effect = requests.HTTPError("404 Client Error", response=response)
+    return response
+
+
+def cache_count(result):
+    """Current value of the weather cache counter for a result"""
+    return metrics.registry.counters.get(("weather_cache_total", (("result", result),)), 0)
 
 
 class TestWeatherTool:
@@ -16,7 +51,7 @@ class TestWeatherTool:
         """Create a WeatherTool instance for testing"""
         return WeatherTool()
     
-    @patch('weather.requests.get')
+    @patch('weather.requests.Session.get')
     def test_get_weather_success(self, mock_get, weather_tool):
         """Test successful weather data retrieval"""
         # Mock API response
@@ -47,7 +82,7 @@ class TestWeatherTool:
         assert result["description"] == "cloudy"
         assert result["wind_speed"] == 5.5
     
-    @patch('weather.requests.get')
+    @patch('weather.requests.Session.get')
     def test_get_weather_invalid_city(self, mock_get, weather_tool):
         """Test handling of invalid city name"""
         # Mock 404 response
@@ -61,7 +96,7 @@ class TestWeatherTool:
         
         assert "Failed to fetch weather" in str(exc_info.value)
     
-    @patch('weather.requests.get')
+    @patch('weather.requests.Session.get')
     def test_get_weather_api_timeout(self, mock_get, weather_tool):
         """Test handling of API timeout"""
         # Mock timeout
@@ -73,7 +108,7 @@ class TestWeatherTool:
         
         assert "Failed to fetch weather" in str(exc_info.value)
     
-    @patch('weather.requests.get')
+    @patch('weather.requests.Session.get')
     def test_get_weather_api_key_used(self, mock_get, weather_tool):
         """Test that API key is included in request"""
         mock_response = Mock()
@@ -89,12 +124,411 @@ class TestWeatherTool:
         
         weather_tool.get_weather("Paris")
         
-        # Verify API call was made with correct parameters
+        # Verify API call was made with correct parameters; known cities
+        # are sent as their OpenWeatherMap id
         call_args = mock_get.call_args
-        assert call_args[1]['params']['q'] == "Paris"
+        assert call_args[1]['params']['id'] == 2988507
+        assert 'q' not in call_args[1]['params']
         assert 'appid' in call_args[1]['params']
         assert call_args[1]['params']['units'] == "metric"
 
 
+
+class TestWeatherCache:
+    """Test suite for WeatherTool's response cache"""
+    
+    @pytest.fixture
+    def weather_tool(self):
+        """Create a WeatherTool with a 10 minute TTL and 30 minutes of staleness"""
+        return WeatherTool(fresh_ttl=600, stale_ttl=1800, negative_ttl=3600)
+    
+    @patch('weather.requests.Session.get')
+    def test_normalized_city_hits_cache(self, mock_get, weather_tool):
+        """Test spelling variants of a city share one API call"""
+        mock_get.return_value = api_response()
+        hits = cache_count("hit")
+        
+        first = weather_tool.get_weather("London")
+        second = weather_tool.get_weather("  london ")
+        
+        assert mock_get.call_count == 1
+        assert first == second
+        assert cache_count("hit") == hits + 1
+    
+    @patch('weather.requests.Session.get')
+    def test_alias_resolved_before_request(self, mock_get, weather_tool):
+        """Test an aliased city is sent as its id and shares its cache entry"""
+        mock_get.return_value = api_response(name="Mumbai")
+        
+        weather_tool.get_weather("Bombay")
+        weather_tool.get_weather("Mumbai")
+        
+        assert mock_get.call_count == 1
+        assert mock_get.call_args[1]["params"]["id"] == 1275339
+    
+    @patch('weather.requests.Session.get')
+    def test_near_miss_not_rewritten(self, mock_get, weather_tool):
+        """Test unlisted places that look like a listed city are sent by name and cached apart"""
+        mock_get.side_effect = lambda url, params, timeout: api_response(name=params.get("q", "Lyon"))
+        
+        assert weather_tool.get_weather("Leon")["city"] == "Leon"
+        assert weather_tool.get_weather("Laos")["city"] == "Laos"
+        weather_tool.get_weather("Lyon")
+        
+        assert [call[1]["params"].get("q") for call in mock_get.call_args_list] == ["Leon", "Laos", None]
+        assert mock_get.call_args[1]["params"]["id"] == 2996944
+    
+    @patch('weather.requests.Session.get')
+    def test_misspelling_guessed_after_unknown(self, mock_get, weather_tool):
+        """Test a name the API doesn't know is retried as the gazetteer's closest city"""
+        mock_get.side_effect = [not_found_response(), api_response()]
+        
+        assert weather_tool.get_weather("Londn")["city"] == "London"
+        
+        assert mock_get.call_args_list[0][1]["params"]["q"] == "Londn"
+        assert mock_get.call_args_list[1][1]["params"]["id"] == 2643743
+    
+    @patch('weather.requests.Session.get')
+    def test_unresolved_city_sent_by_name(self, mock_get, weather_tool):
+        """Test cities missing from the gazetteer are still looked up by name"""
+        mock_get.return_value = api_response(name="Tromsø")
+        
+        weather_tool.get_weather("Tromsø")
+        
+        assert mock_get.call_args[1]["params"]["q"] == "Tromsø"
+        assert "id" not in mock_get.call_args[1]["params"]
+    
+    @patch('weather.requests.Session.get')
+    def test_units_cached_separately(self, mock_get):
+        """Test metric and imperial results are different entries"""
+        mock_get.return_value = api_response()
+        
+        WeatherTool(fresh_ttl=600).get_weather("London")
+        imperial = WeatherTool(units="imperial", fresh_ttl=600)
+        imperial.get_weather("London")
+        
+        assert mock_get.call_args[1]["params"]["units"] == "imperial"
+        assert mock_get.call_count == 2
+    
+    @patch('weather.requests.Session.get')
+    def test_stale_entry_served_while_refreshing(self, mock_get, weather_tool):
+        """Test an expired entry is returned at once and refreshed in the background"""
+        mock_get.side_effect = [api_response(temp=10.0), api_response(temp=20.0)]
+        
+        with patch('weather.time.monotonic', return_value=1000.0):
+            weather_tool.get_weather("London")
+        with patch('weather.time.monotonic', return_value=1700.0):
+            stale = weather_tool.get_weather("London")
+            
+            deadline = time.time() + 2
+            while mock_get.call_count < 2 or weather_tool._refreshing:
+                assert time.time() < deadline, "background refresh did not finish"
+                time.sleep(0.01)
+            
+            refreshed = weather_tool.get_weather("London")
+        
+        assert stale["temperature"] == 10.0
+        assert refreshed["temperature"] == 20.0
+    
+    @patch('weather.requests.Session.get')
+    def test_expired_entry_fetched_synchronously(self, mock_get, weather_tool):
+        """Test entries past the stale window are fetched before answering"""
+        mock_get.side_effect = [api_response(temp=10.0), api_response(temp=20.0)]
+        
+        with patch('weather.time.monotonic', return_value=1000.0):
+            weather_tool.get_weather("London")
+        with patch('weather.time.monotonic', return_value=1000.0 + 600 + 1800 + 1):
+            result = weather_tool.get_weather("London")
+        
+        assert result["temperature"] == 20.0
+    
+    @patch('weather.requests.Session.get')
+    def test_unknown_city_negatively_cached(self, mock_get, weather_tool):
+        """Test a 404 is remembered so the API isn't asked again"""
+        mock_get.return_value = not_found_response()
+        
+        for _ in range(2):
+            with pytest.raises(UnknownCityError) as exc_info:
+                weather_tool.get_weather("Atlantis")
+        
+        assert "Failed to fetch weather" in str(exc_info.value)
+        assert mock_get.call_count == 1
+    
+    @patch('weather.requests.Session.get')
+    def test_transient_errors_not_cached(self, mock_get, weather_tool):
+        """Test timeouts are retried on the next question"""
+        mock_get.side_effect = [Exception("Timeout"), api_response()]
+        
+        with pytest.raises(Exception):
+            weather_tool.get_weather("London")
+        
+        assert weather_tool.get_weather("London")["city"] == "London"
+    
+    @patch('weather.requests.Session.get')
+    def test_cache_disabled(self, mock_get):
+        """Test a zero TTL calls the API every time"""
+        mock_get.return_value = api_response()
+        weather_tool = WeatherTool(fresh_ttl=0)
+        
+        weather_tool.get_weather("London")
+        weather_tool.get_weather("London")
+        
+        assert mock_get.call_count == 2
+
+
+class TestWeatherClient:
+    """Test suite for WeatherTool's pooled HTTP clients and retries"""
+    
+    @pytest.fixture
+    def server(self):
+        """Start a local stub of the OpenWeatherMap API"""
+        with StubWeatherServer(unknown_cities=["Atlantis"]) as server:
+            yield server
+    
+    @pytest.fixture
+    def weather_tool(self, server):
+        """Create an uncached WeatherTool pointed at the stub with fast backoff"""
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, max_retries=2)
+        tool.backoff = 0.01
+        yield tool
+        tool.close()
+    
+    def test_connection_reused(self, server, weather_tool):
+        """Test sequential calls share one keep-alive connection"""
+        for city in ["London", "Paris", "Tokyo"]:
+            assert weather_tool.get_weather(city)["city"] == city
+        
+        assert server.requests == 3
+        assert server.connections == 1
+    
+    def test_retries_server_errors(self, server, weather_tool):
+        """Test 5xx responses are retried until one succeeds"""
+        server.fail_next(503, times=2)
+        
+        result = weather_tool.get_weather("London")
+        
+        assert result["city"] == "London"
+        assert server.requests == 3
+    
+    def test_gives_up_after_max_retries(self, server, weather_tool):
+        """Test the last error is raised once retries run out"""
+        server.fail_next(429, retry_after="0", times=3)
+        
+        with pytest.raises(Exception, match="429"):
+            weather_tool.get_weather("London")
+        assert server.requests == 3
+    
+    def test_honors_retry_after(self, server, weather_tool):
+        """Test the delay a 429 asks for is waited out"""
+        server.fail_next(429, retry_after="0.2")
+        
+        start = time.monotonic()
+        weather_tool.get_weather("London")
+        
+        assert time.monotonic() - start >= 0.2
+    
+    def test_retry_after_beyond_timeout_fails_fast(self, server, weather_tool):
+        """Test a Retry-After longer than the timeout isn't waited for"""
+        server.fail_next(429, retry_after="30")
+        
+        start = time.monotonic()
+        with pytest.raises(Exception, match="429"):
+            weather_tool.get_weather("London", timeout=1)
+        assert time.monotonic() - start < 1
+        assert server.requests == 1
+    
+    def test_client_errors_not_retried(self, server, weather_tool):
+        """Test 404 maps to UnknownCityError without retrying"""
+        with pytest.raises(UnknownCityError):
+            weather_tool.get_weather("Atlantis")
+        assert server.requests == 1
+    
+    def test_prefetch_uses_group_request(self, server):
+        """Test listed cities are fetched with one group request and then served from the cache"""
+        tool = WeatherTool(base_url=server.url)
+        
+        assert tool.prefetch(["London", "Paris", "Tokyo"]) == 3
+        assert [tool.get_weather(city)["city"] for city in ["London", "Paris", "Tokyo"]] == ["London", "Paris", "Tokyo"]
+        assert server.requests == 1
+        tool.close()
+    
+    def test_prefetch_only_when_every_city_listed(self, server):
+        """Test nothing is prefetched while an uncached city has no gazetteer id"""
+        tool = WeatherTool(base_url=server.url)
+        
+        assert tool.prefetch(["London", "Tromsø"]) == 0
+        assert server.requests == 0
+        
+        tool.get_weather("Tromsø")
+        assert tool.prefetch(["London", "Tromsø", "Paris"]) == 2
+        assert server.requests == 2
+        tool.close()
+    
+    def test_prefetch_failure_left_to_get_weather(self, server):
+        """Test a failed group request caches nothing and single lookups still work"""
+        tool = WeatherTool(base_url=server.url, max_retries=0)
+        server.fail_next(503)
+        
+        assert tool.prefetch(["London", "Paris"]) == 0
+        assert tool.get_weather("London")["city"] == "London"
+        assert server.requests == 2
+        tool.close()
+    
+    def test_retry_after_http_date(self):
+        """Test Retry-After is parsed as seconds or an HTTP date"""
+        assert weather._retry_after_seconds("3") == 3.0
+        assert 8 < weather._retry_after_seconds(formatdate(time.time() + 10, usegmt=True)) <= 10
+        assert weather._retry_after_seconds(None) is None
+        assert weather._retry_after_seconds("soon") is None
+    
+    def test_aget_weather(self, server, weather_tool):
+        """Test concurrent async calls share pooled connections and retry"""
+        server.fail_next(502)
+        
+        async def fetch_all():
+            try:
+                return await asyncio.gather(*(weather_tool.aget_weather(city) for city in ["London", "Paris"]))
+            finally:
+                await weather_tool.aclose()
+        
+        results = asyncio.run(fetch_all())
+        
+        assert [result["city"] for result in results] == ["London", "Paris"]
+        assert server.requests == 3
+        assert server.connections <= 2
+    
+    def test_aget_weather_unknown_city_cached(self, server):
+        """Test async lookups share the negative cache with get_weather"""
+        tool = WeatherTool(base_url=server.url)
+        
+        async def fetch():
+            try:
+                await tool.aget_weather("Atlantis")
+            finally:
+                await tool.aclose()
+        
+        with pytest.raises(UnknownCityError):
+            asyncio.run(fetch())
+        with pytest.raises(UnknownCityError):
+            tool.get_weather("atlantis")
+        assert server.requests == 1
+
+
+class TestWeatherResilience:
+    """Test suite for WeatherTool's circuit breaker and hedging against a flaky stub"""
+
+    @pytest.fixture
+    def server(self):
+        """Start a local stub of the OpenWeatherMap API"""
+        with StubWeatherServer(unknown_cities=["Atlantis"]) as server:
+            yield server
+
+    @pytest.fixture
+    def weather_tool(self, server):
+        """Create an uncached, non-retrying WeatherTool whose circuit opens after two failures"""
+        breaker = CircuitBreaker("weather", failure_threshold=2, recovery_timeout=0.2,
+                                 excluded=(UnknownCityError,))
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, max_retries=0, breaker=breaker)
+        yield tool
+        tool.close()
+
+    def test_outage_fails_fast(self, server, weather_tool):
+        """Test calls stop waiting out the timeout once the circuit opens"""
+        server.delay_next(1000, times=2)
+        for _ in range(2):
+            with pytest.raises(Exception, match="Failed to fetch weather"):
+                weather_tool.get_weather("London", timeout=0.1)
+
+        start = time.monotonic()
+        with pytest.raises(CircuitOpenError):
+            weather_tool.get_weather("London", timeout=0.1)
+
+        assert time.monotonic() - start < 0.05
+        assert server.requests == 2
+
+    def test_recovers_after_probe(self, server, weather_tool):
+        """Test the first call after the recovery timeout probes and closes the circuit"""
+        server.fail_next(503, times=2)
+        for _ in range(2):
+            with pytest.raises(Exception, match="503"):
+                weather_tool.get_weather("London")
+        time.sleep(0.25)
+
+        assert weather_tool.get_weather("London")["city"] == "London"
+        assert weather_tool.breaker.state == resilience.CLOSED
+
+    def test_unknown_cities_keep_circuit_closed(self, server, weather_tool):
+        """Test 404s don't count as the API failing"""
+        for _ in range(3):
+            with pytest.raises(UnknownCityError):
+                weather_tool.get_weather("Atlantis")
+
+        assert weather_tool.get_weather("London")["city"] == "London"
+
+    def test_rejected_requests_keep_circuit_closed(self, server, weather_tool):
+        """Test client errors such as a bad API key don't count as the API failing"""
+        server.fail_next(401, times=3)
+        for _ in range(3):
+            with pytest.raises(WeatherAPIError, match="401"):
+                weather_tool.get_weather("London")
+
+        assert weather_tool.breaker.state == resilience.CLOSED
+
+    def test_async_calls_share_breaker(self, server, weather_tool):
+        """Test aget_weather fails fast once the circuit is open"""
+        server.fail_next(503, times=2)
+
+        async def fetch(city):
+            return await weather_tool.aget_weather(city)
+
+        async def scenario():
+            try:
+                for _ in range(2):
+                    with pytest.raises(Exception, match="503"):
+                        await fetch("London")
+                with pytest.raises(CircuitOpenError):
+                    await fetch("London")
+            finally:
+                await weather_tool.aclose()
+
+        asyncio.run(scenario())
+        assert server.requests == 2
+
+    def test_slow_response_hedged(self, server):
+        """Test a response slower than usual is raced by a duplicate request"""
+        hedger = Hedger("weather", percentile=90, min_samples=5)
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, hedger=hedger)
+        server.delay_next(20, times=5)
+        for city in ["London", "Paris", "Tokyo", "Oslo", "Rome"]:
+            tool.get_weather(city)
+
+        server.delay_next(2000)
+        start = time.monotonic()
+        result = tool.get_weather("London")
+
+        assert result["city"] == "London"
+        assert time.monotonic() - start < 1
+        assert server.requests == 7
+        tool.close()
+
+    def test_backoff_not_hedged(self, server):
+        """Test waiting out a 429 and the retries after it don't send duplicate requests"""
+        hedger = Hedger("weather", percentile=90, min_samples=5)
+        tool = WeatherTool(fresh_ttl=0, base_url=server.url, max_retries=2, hedger=hedger)
+        server.delay_next(20, times=5)
+        for city in ["London", "Paris", "Tokyo", "Oslo", "Rome"]:
+            tool.get_weather(city)
+
+        hedged = metrics.registry.counters.get(("hedged_requests_total", (("dependency", "weather"),)), 0)
+        server.fail_next(429, retry_after="0.2", times=2)
+        result = tool.get_weather("London")
+        time.sleep(0.1)
+
+        assert result["city"] == "London"
+        assert server.requests == 8
+        assert metrics.registry.counters.get(("hedged_requests_total", (("dependency", "weather"),)), 0) == hedged
+        tool.close()
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
@@ -0,0 +1,95 @@
+"""
+Unit tests for template weather answers
+Tests question classification and rendering for single and multiple cities
+"""
+
+import pytest
+from weather_answers import classify_question, render
+
+
+def weather(city="London", temperature=15.5, description="clear sky", humidity=55, wind_speed=3.0):
+    """Build weather data shaped like WeatherTool.get_weather's result"""
+    return {
+        "city": city, "country": "GB", "temperature": temperature, "feels_like": temperature - 1,
+        "description": description, "humidity": humidity, "wind_speed": wind_speed
+    }
+
+
+class TestWeatherAnswers:
+    """Test suite for the weather_answers module"""
+
+    @pytest.mark.parametrize("query, question_type", [
+        ("What's the weather in London?", "conditions"),
+        ("London weather right now", "conditions"),
+        ("Will I need an umbrella in Paris?", "rain"),
+        ("Do I need an umbrella in Paris today?", "rain"),
+        ("Do I need a jacket in Oslo?", "clothing"),
+        ("How windy is it in Chicago?", "wind"),
+        ("Is it humid in Mumbai?", "humidity"),
+        ("How hot is it in Delhi?", "temperature"),
+        ("Is Delhi warmer than Mumbai?", "temperature"),
+    ])
+    def test_classify_question(self, query, question_type):
+        """Test recognized questions get a template type"""
+        assert classify_question(query) == question_type
+
+    @pytest.mark.parametrize("query", [
+        "Will it rain in London tomorrow?",
+        "What's the forecast for Paris this weekend?",
+        "Is it a good day for a picnic in Rome?",
+        "Why is it so foggy in San Francisco?",
+        "Should I fly to Tokyo today?",
+        "Should I take an umbrella in Paris?",
+        "Why is it so cold in London?",
+        "Is it safe to drive in this storm?",
+        "Explain why it is so humid",
+    ])
+    def test_open_ended_questions(self, query):
+        """Test questions about other times, advice or explanations are left to the LLM"""
+        assert classify_question(query) is None
+
+    def test_rain_answer_follows_conditions(self):
+        """Test umbrella questions are answered from the current conditions"""
+        rainy = render("rain", "Umbrella in London?", [{"city": "London", "data": weather(description="light rain")}])
+        dry = render("rain", "Umbrella in London?", [{"city": "London", "data": weather()}])
+        snowy = render("rain", "Umbrella in London?", [{"city": "London", "data": weather(description="snow")}])
+
+        assert "umbrella" in rainy.lower() and "light rain" in rainy
+        assert "No umbrella" in dry or "isn't raining" in dry
+        assert "snow" in snowy
+
+    def test_clothing_answer_follows_temperature(self):
+        """Test clothing advice changes with temperature and mentions rain"""
+        cold = render("clothing", "What should I wear?", [{"city": "Oslo", "data": weather("Oslo", 2)}])
+        warm = render("clothing", "What should I wear?",
+                      [{"city": "Rome", "data": weather("Rome", 27, "moderate rain")}])
+
+        assert "warm coat" in cold
+        assert "light clothes" in warm and "umbrella" in warm
+
+    def test_phrasing_is_stable(self):
+        """Test the same question gets the same wording"""
+        reports = [{"city": "London", "data": weather()}]
+
+        assert render("conditions", "Weather in London?", reports) == \
+            render("conditions", "Weather in London?", reports)
+
+    def test_multiple_cities_compared(self):
+        """Test several cities get a paragraph each, a comparison and the missing ones"""
+        reports = [
+            {"city": "Delhi", "data": weather("Delhi", 34)},
+            {"city": "London", "data": weather("London", 12)},
+            {"city": "Atlantis", "error": "unknown city"}
+        ]
+
+        answer = render("temperature", "Is Delhi hotter than London?", reports)
+        paragraphs = answer.split("\n\n")
+
+        assert len(paragraphs) == 4
+        assert "34°C" in paragraphs[0] and "12°C" in paragraphs[1]
+        assert paragraphs[2] == "Delhi is the warmest at 34°C and London the coldest at 12°C."
+        assert paragraphs[3] == "I couldn't get the weather for Atlantis."
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,256 @@
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+
+# Trace and innermost span for whichever run is active in the current context
+_active_trace: ContextVar[Optional["Trace"]] = ContextVar("active_trace", default=None)
+_active_span: ContextVar[Optional["Span"]] = ContextVar("active_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes",
+                 "start_time", "duration_ms", "error", "_start")
+
+    def __init__(self, trace_id: str, name: str, parent_id: Optional[str] = None, attributes: Dict = None):
+        """
+        A single timed operation inside a trace
+
+        Args:
+            trace_id: Trace this span belongs to
+            name: Operation name, e.g. "classify_intent" or "rag.rerank"
+            parent_id: Span id of the enclosing span, if any
+            attributes: Extra key/value data about the operation
+        """
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.duration_ms = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    def finish(self, error: BaseException = None):
+        """
+        Stop the span's clock
+
+        Args:
+            error: Exception that ended the span, if any
+        """
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 3)
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> Dict:
+        """Serialize the span"""
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class Trace:
+    def __init__(self, name: str, **attributes):
+        """
+        Collection of spans for one request
+
+        Args:
+            name: Name of the root span
+            **attributes: Attributes recorded on the root span
+        """
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(self.trace_id, name, attributes=attributes)
+        self.spans: List[Span] = [self.root]
+
+    @property
+    def duration_ms(self) -> float:
+        """Duration of the whole trace, or 0.0 while it is still running"""
+        return self.root.duration_ms or 0.0
+
+    def span_tree(self) -> Dict:
+        """
+        Nest the spans under their parents
+
+        Returns:
+            Root span dict with a "children" list at every level
+        """
+        nodes = {span.span_id: {**span.to_dict(), "children": []} for span in self.spans}
+        for span in self.spans:
+            if span.parent_id in nodes:
+                nodes[span.parent_id]["children"].append(nodes[span.span_id])
+        return nodes[self.root.span_id]
+
+
+class _SpanContext:
+    def __init__(self, trace: Trace, name: str, attributes: Dict):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self) -> Span:
+        parent = _active_span.get()
+        self.span = Span(
+            self.trace.trace_id,
+            self.name,
+            parent_id=parent.span_id if parent else self.trace.root.span_id,
+            attributes=self.attributes
+        )
+        self.trace.spans.append(self.span)
+        self.token = _active_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.finish(exc)
+        _active_span.reset(self.token)
+        return False
+
+
+class _NoopSpanContext:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpanContext()
+
+
+def span(name: str, **attributes):
+    """
+    Open a child span of the active trace
+
+    When no trace is active this returns a shared no-op context manager,
+    so instrumented code costs a single context lookup with tracing off.
+
+    Args:
+        name: Operation name
+        **attributes: Extra key/value data about the operation
+
+    Returns:
+        Context manager yielding the Span, or None when not tracing
+    """
+    trace = _active_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _SpanContext(trace, name, attributes)
+
+
+def add_attributes(**attributes):
+    """
+    Attach attributes to the innermost active span, if any
+
+    Args:
+        **attributes: Key/value data to record
+    """
+    current = _active_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def current_trace_id() -> Optional[str]:
+    """Get the id of the active trace, or None when not tracing"""
+    trace = _active_trace.get()
+    return trace.trace_id if trace else None
+
+
+class Tracer:
+    def __init__(self, enabled: bool = False, slow_query_ms: float = None):
+        """
+        Per-request tracing with an optional slow query log
+
+        Args:
+            enabled: Persist the spans of every request
+            slow_query_ms: Capture the full span tree of requests slower than
+                this many milliseconds (None disables the slow query log)
+        """
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        """
+        Build a tracer from AGENT_TRACING and AGENT_SLOW_QUERY_MS
+
+        Returns:
+            Configured Tracer
+        """
+        enabled = os.getenv("AGENT_TRACING", "").lower() in ("1", "true", "yes")
+        slow_query_ms = os.getenv("AGENT_SLOW_QUERY_MS")
+        return cls(enabled=enabled, slow_query_ms=float(slow_query_ms) if slow_query_ms else None)
+
+    @property
+    def active(self) -> bool:
+        """Whether spans need to be collected at all"""
+        return self.enabled or self.slow_query_ms is not None
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """
+        Trace a request
+
+        Args:
+            name: Name of the root span
+            **attributes: Attributes recorded on the root span
+
+        Yields:
+            The Trace, or None when tracing is off
+        """
+        if not self.active:
+            yield None
+            return
+
+        trace = Trace(name, **attributes)
+        trace_token = _active_trace.set(trace)
+        span_token = _active_span.set(trace.root)
+        error = None
+        try:
+            yield trace
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            trace.root.finish(error)
+            _active_span.reset(span_token)
+            _active_trace.reset(trace_token)
+
+    def persist(self, trace: Optional[Trace], db, message_id: int = None, session_id: str = None, query: str = None):
+        """
+        Store a finished trace and log it if it was slow
+
+        Args:
+            trace: Trace returned by trace(), or None
+            db: ChatDatabase to write to
+            message_id: chat_history row the trace belongs to
+            session_id: Session identifier
+            query: User query
+        """
+        if trace is None:
+            return
+
+        if self.enabled:
+            db.insert_spans(message_id, [s.to_dict() for s in trace.spans])
+
+        if self.slow_query_ms is not None and trace.duration_ms >= self.slow_query_ms:
+            db.insert_slow_query(
+                trace_id=trace.trace_id,
+                message_id=message_id,
+                session_id=session_id,
+                query=query,
+                duration_ms=trace.duration_ms,
+                span_tree=json.dumps(trace.span_tree())
+            )
@@ -0,0 +1,114 @@
+import logging
+import os
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# USD per million (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0)
+}
+
+# Session budget states
+OK = "ok"
+ECONOMY = "economy"
+EXHAUSTED = "exhausted"
+
+BUDGET_EXHAUSTED_ANSWER = (
+    "This session has used up its token budget. Please start a new session to continue."
+)
+
+
+def cost_usd(model: Optional[str], prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """
+    Price a model call
+
+    Dated model versions reported by the API (e.g. "gpt-4o-mini-2024-07-18")
+    are priced as their base model.
+
+    Args:
+        model: Model name, or None if the provider didn't report one
+        prompt_tokens: Input tokens
+        completion_tokens: Output tokens
+
+    Returns:
+        Cost in USD, 0.0 for unknown models
+    """
+    prices = None
+    if model:
+        # Longest matching prefix, so "gpt-4o-mini-..." isn't priced as "gpt-4o"
+        for name in sorted(MODEL_PRICES, key=len, reverse=True):
+            if model.startswith(name):
+                prices = MODEL_PRICES[name]
+                break
+    if prices is None:
+        logger.debug("unpriced_model model=%s", model)
+        return 0.0
+
+    prompt_price, completion_price = prices
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class SessionBudget:
+    def __init__(self, max_tokens: int = None, max_cost_usd: float = None, economy_ratio: float = 0.8):
+        """
+        Per-session spending limits
+
+        Once a session has spent economy_ratio of either limit its requests
+        take cheaper paths; once it reaches a limit they are refused.
+
+        Args:
+            max_tokens: Total tokens a session may use (None for no limit)
+            max_cost_usd: Total cost a session may incur (None for no limit)
+            economy_ratio: Fraction of a limit after which requests are economized
+        """
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+        self.economy_ratio = economy_ratio
+
+    @classmethod
+    def from_env(cls) -> "SessionBudget":
+        """
+        Create a budget configured by SESSION_TOKEN_BUDGET, SESSION_COST_BUDGET_USD
+        and SESSION_BUDGET_ECONOMY_RATIO (0 or unset limits are disabled)
+
+        Returns:
+            SessionBudget instance
+        """
+        return cls(
+            max_tokens=int(os.getenv("SESSION_TOKEN_BUDGET", "0")) or None,
+            max_cost_usd=float(os.getenv("SESSION_COST_BUDGET_USD", "0")) or None,
+            economy_ratio=float(os.getenv("SESSION_BUDGET_ECONOMY_RATIO", "0.8"))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any limit is set"""
+        return bool(self.max_tokens or self.max_cost_usd)
+
+    def status(self, spent: Dict) -> str:
+        """
+        Classify a session's spending against the budget
+
+        Args:
+            spent: Usage totals as returned by ChatDatabase.get_usage
+
+        Returns:
+            OK, ECONOMY or EXHAUSTED
+        """
+        used = 0.0
+        if self.max_tokens:
+            used = max(used, spent.get("total_tokens", 0) / self.max_tokens)
+        if self.max_cost_usd:
+            used = max(used, spent.get("cost_usd", 0.0) / self.max_cost_usd)
+
+        if used >= 1:
+            return EXHAUSTED
+        if used >= self.economy_ratio:
+            return ECONOMY
+        return OK
@@ -1,50 +1,563 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import List, Optional
 
+import httpx
 import requests
-import os
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+import metrics
+import tracing
+from gazetteer import City, Gazetteer
+from resilience import CircuitBreaker, Hedger
+
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Most city ids OpenWeatherMap's group endpoint accepts in one request
+GROUP_MAX_IDS = 20
+
+
+class UnknownCityError(Exception):
+    """Raised when OpenWeatherMap doesn't know the requested city"""
+
+
+class WeatherAPIError(Exception):
+    """Raised when OpenWeatherMap answers with an error status"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _call(fn, *args, **kwargs):
+    """Call fn directly, in place of Hedger.call for requests that mustn't be hedged"""
+    return fn(*args, **kwargs)
+
+
+def _retry_after_seconds(value) -> Optional[float]:
+    """
+    Parse a Retry-After header
+    
+    Args:
+        value: Header value, either delay seconds or an HTTP date
+        
+    Returns:
+        Seconds to wait, or None if absent or unparseable
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
 class WeatherTool:
-    def __init__(self):
+    def __init__(self, units: str = "metric", fresh_ttl: float = None, stale_ttl: float = None,
+                 negative_ttl: float = None, max_entries: int = 1024, pool_size: int = None,
+                 max_retries: int = None, base_url: str = None, gazetteer: Gazetteer = None,
+                 breaker: CircuitBreaker = None, hedger: Hedger = None):
+        """
+        OpenWeatherMap client with a per-city response cache
+        
+        Requests go through a pooled keep-alive session (and a pooled async
+        client for aget_weather), so repeated calls reuse connections instead
+        of paying for a new TCP and TLS handshake each time. Rate-limited
+        (429) and 5xx responses are retried with exponential backoff and
+        jitter, waiting as long as the API's Retry-After asks when it sends one.
+        
+        City names are resolved to OpenWeatherMap ids with a local gazetteer
+        first, so aliases ("Bombay") reach the right city and share a cache
+        entry with its proper name. Names the gazetteer doesn't list exactly
+        are sent to the API as written; only if the API doesn't know one
+        either is the gazetteer's closest spelling tried ("Londn"), so
+        unlisted places that look like a listed city ("Leon", "Laos") are
+        never rewritten to it.
+        
+        Fresh entries are served without calling the API. Once an entry
+        goes stale it is still served for a while, and a background request
+        refreshes it. Cities the API doesn't know are remembered too, so
+        repeated misspellings don't reach the API. prefetch() fills the
+        cache for several listed cities with one group request.
+        
+        API calls go through a circuit breaker: after a run of failures
+        (timeouts, 5xx once retries are used up) calls fail immediately
+        until a probe shows the API has recovered, instead of each waiting
+        out its timeout. Synchronous calls can also be hedged: a duplicate
+        of the first request goes out once it is slower than a recent
+        latency percentile. Retries are never hedged, since they follow a
+        429 or 5xx and a duplicate would only add to the API's load.
+        
+        Args:
+            units: OpenWeatherMap units ("metric", "imperial" or "standard")
+            fresh_ttl: Seconds an entry is served as is (defaults to
+                WEATHER_FRESH_TTL, 600; 0 disables the cache)
+            stale_ttl: Seconds after that a stale entry is served while it is
+                refreshed (defaults to WEATHER_STALE_TTL, 1800)
+            negative_ttl: Seconds an unknown city is remembered (defaults to
+                WEATHER_NEGATIVE_TTL, 3600)
+            max_entries: Cities kept; the least recently used are evicted first
+            pool_size: Keep-alive connections per client (defaults to WEATHER_POOL_SIZE, 10)
+            max_retries: Retries of 429/5xx responses (defaults to WEATHER_MAX_RETRIES, 2)
+            base_url: API endpoint (defaults to OpenWeatherMap's current weather API)
+            gazetteer: City index (defaults to the one configured by GAZETTEER_PATH)
+            breaker: Circuit breaker (defaults to one configured by CIRCUIT_* settings)
+            hedger: Request hedger (defaults to one configured by WEATHER_HEDGE_PERCENTILE)
+        """
         self.api_key = os.getenv("OPENWEATHERMAP_API_KEY")
-        self.base_url = "https://api.openweathermap.org/data/2.5/weather"
+        self.base_url = base_url or "https://api.openweathermap.org/data/2.5/weather"
+        self.group_url = self.base_url.rsplit("/", 1)[0] + "/group"
+        self.units = units
+        self.fresh_ttl = fresh_ttl if fresh_ttl is not None else float(os.getenv("WEATHER_FRESH_TTL", "600"))
+        self.stale_ttl = stale_ttl if stale_ttl is not None else float(os.getenv("WEATHER_STALE_TTL", "1800"))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.getenv("WEATHER_NEGATIVE_TTL", "3600"))
+        self.max_entries = max_entries
+        self.pool_size = pool_size or int(os.getenv("WEATHER_POOL_SIZE", "10"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("WEATHER_MAX_RETRIES", "2"))
+        self.backoff = 0.5
+        self.max_backoff = 8.0
+        self.refresh_timeout = 10
+        self._cache = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self.gazetteer = gazetteer if gazetteer is not None else Gazetteer.from_env()
+        self.breaker = breaker or CircuitBreaker.from_env("weather", excluded=(UnknownCityError,))
+        self.hedger = hedger or Hedger.from_env("weather")
+    
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """
+        Get the pooled async client, creating it on first use
+        
+        The client's connections belong to the event loop that first uses
+        them, so a tool's async calls should all run on one loop.
+        """
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+        return self._async_client
     
-    def get_weather(self, city: str):
+    def close(self):
+        """Close the pooled session's connections"""
+        self.session.close()
+    
+    async def aclose(self):
+        """Close the pooled async client's connections"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+    
+    def _resolve(self, city: str) -> Optional[City]:
+        """Look a city name or alias up in the gazetteer, exactly"""
+        return self.gazetteer.resolve(city) if self.gazetteer is not None else None
+    
+    def _guess(self, city: str) -> Optional[str]:
+        """
+        Closest listed spelling of a name the gazetteer doesn't list exactly
+        
+        Returns:
+            The guessed city as "Name, CC", which resolves exactly, or None
+        """
+        if self.gazetteer is None or self._resolve(city) is not None:
+            return None
+        place = self.gazetteer.resolve(city, fuzzy=True)
+        return f"{place.name}, {place.country}" if place is not None else None
+    
+    def _cache_key(self, city: str) -> tuple:
+        """Key cities by id when known, else by normalized name, so "new  york" and "New York" share an entry"""
+        place = self._resolve(city)
+        if place is not None:
+            return place.id, self.units
+        return " ".join(city.lower().split()), self.units
+    
+    def _record(self, result: str):
+        """Count a cache lookup by result: hit, stale, negative_hit or miss"""
+        metrics.registry.increment("weather_cache_total", result=result)
+        tracing.add_attributes(weather_cache=result)
+    
+    def _cached(self, key: tuple, city: str) -> Optional[dict]:
+        """
+        Look a city up in the cache, refreshing stale entries in the background
+        
+        Returns:
+            Cached weather, or None on a miss
+            
+        Raises:
+            UnknownCityError: The city is remembered as unknown
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+        
+        if entry is not None:
+            age = time.monotonic() - entry["fetched_at"]
+            if entry["error"] is not None:
+                if age < self.negative_ttl:
+                    self._record("negative_hit")
+                    raise UnknownCityError(entry["error"])
+            elif age < self.fresh_ttl:
+                self._record("hit")
+                return dict(entry["data"])
+            elif age < self.fresh_ttl + self.stale_ttl:
+                self._record("stale")
+                self._refresh_in_background(key, city)
+                return dict(entry["data"])
+        
+        self._record("miss")
+        return None
+    
+    def get_weather(self, city: str, timeout: float = 10):
         """
         Get current weather for a city
         
         Args:
             city: Name of the city
+            timeout: Seconds to wait for the API, including retries
             
         Returns:
             Dictionary with weather information
         """
-        params = {
-            "q": city,
+        if not self.fresh_ttl:
+            return self._request(city, timeout)
+        
+        key = self._cache_key(city)
+        cached = self._cached(key, city)
+        if cached is not None:
+            return cached
+        return self._fetch_and_store(key, city, timeout)
+    
+    async def aget_weather(self, city: str, timeout: float = 10):
+        """
+        Get current weather for a city without blocking the event loop
+        
+        Shares the cache with get_weather.
+        
+        Args:
+            city: Name of the city
+            timeout: Seconds to wait for the API, including retries
+            
+        Returns:
+            Dictionary with weather information
+        """
+        if not self.fresh_ttl:
+            return await self._arequest(city, timeout)
+        
+        key = self._cache_key(city)
+        cached = self._cached(key, city)
+        if cached is not None:
+            return cached
+        try:
+            data = await self._arequest(city, timeout)
+        except UnknownCityError as e:
+            self._store(key, {"data": None, "error": str(e)})
+            raise
+        self._store(key, {"data": data, "error": None})
+        return dict(data)
+    
+    def prefetch(self, cities: List[str], timeout: float = 10) -> int:
+        """
+        Cache several cities' weather with one group request
+        
+        OpenWeatherMap's group endpoint only takes city ids, so it is used
+        only when the gazetteer lists every city that isn't cached yet;
+        otherwise nothing is requested and get_weather fetches each city
+        as usual. Cities the response leaves out, or all of them if the
+        request fails, are likewise left to get_weather. Does nothing while
+        the cache is off.
+        
+        Args:
+            cities: City names, as passed to get_weather
+            timeout: Seconds to wait for the API, including retries
+            
+        Returns:
+            Number of cities cached
+        """
+        if not self.fresh_ttl:
+            return 0
+        
+        keys = {}
+        for city in cities:
+            key = self._cache_key(city)
+            if self._is_cached(key):
+                continue
+            place = self._resolve(city)
+            if place is None:
+                return 0
+            keys[place.id] = key
+        if len(keys) < 2:
+            # A single city costs one request either way
+            return 0
+        
+        ids = list(keys)
+        give_up_at = time.monotonic() + timeout
+        stored = 0
+        for start in range(0, len(ids), GROUP_MAX_IDS):
+            batch = ids[start:start + GROUP_MAX_IDS]
+            try:
+                reports = self.breaker.call(
+                    self._fetch_group, batch, max(give_up_at - time.monotonic(), 0.001)
+                )
+            except Exception as e:
+                logger.warning("weather_group_failed cities=%d error=%s", len(batch), e)
+                break
+            for city_id, data in reports.items():
+                if city_id in keys:
+                    self._store(keys[city_id], {"data": data, "error": None})
+                    stored += 1
+        logger.debug("weather_prefetched cities=%d stored=%d", len(keys), stored)
+        return stored
+    
+    def _is_cached(self, key: tuple) -> bool:
+        """Whether get_weather would answer a key from the cache, without counting a lookup"""
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is None:
+            return False
+        age = time.monotonic() - entry["fetched_at"]
+        if entry["error"] is not None:
+            return age < self.negative_ttl
+        return age < self.fresh_ttl + self.stale_ttl
+    
+    def _fetch_and_store(self, key: tuple, city: str, timeout: float) -> dict:
+        """Fetch a city's weather and cache it; other failures (timeouts, 5xx) are not cached"""
+        try:
+            data = self._request(city, timeout)
+        except UnknownCityError as e:
+            self._store(key, {"data": None, "error": str(e)})
+            raise
+        self._store(key, {"data": data, "error": None})
+        return dict(data)
+    
+    def _store(self, key: tuple, entry: dict):
+        """Add an entry to the LRU cache"""
+        entry["fetched_at"] = time.monotonic()
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+    
+    def _refresh_in_background(self, key: tuple, city: str):
+        """Start refreshing a stale entry unless a refresh is already running"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key, city), name="weather-refresh", daemon=True).start()
+    
+    def _refresh(self, key: tuple, city: str):
+        """Refresh a stale entry; on failure the stale entry keeps being served"""
+        try:
+            self._fetch_and_store(key, city, self.refresh_timeout)
+        except Exception as e:
+            logger.warning("weather_refresh_failed city=%s error=%s", city, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+    
+    def _params(self, city: str) -> dict:
+        """Query parameters for a city: its id when the gazetteer knows it, else its name"""
+        place = self._resolve(city)
+        return {
+            **({"id": place.id} if place is not None else {"q": city}),
             "appid": self.api_key,
-            "units": "metric"  # Celsius
+            "units": self.units
+        }
+    
+    def _retry_delay(self, response, attempt: int, give_up_at: float) -> Optional[float]:
+        """
+        Decide whether and how long to wait before retrying a response
+        
+        Args:
+            response: requests or httpx response
+            attempt: Number of retries already made
+            give_up_at: time.monotonic() by which the call must finish
+            
+        Returns:
+            Seconds to wait, or None to stop retrying
+        """
+        if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+            return None
+        
+        delay = _retry_after_seconds(response.headers.get("Retry-After"))
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if time.monotonic() + delay >= give_up_at:
+            # Waiting would outlast the caller's timeout; report the failure now
+            return None
+        
+        logger.debug("weather_retry status=%s delay_s=%.2f attempt=%d", response.status_code, delay, attempt + 1)
+        metrics.registry.increment("weather_retries_total", status=response.status_code)
+        return delay
+    
+    def _parse(self, data: dict) -> dict:
+        """Extract the fields the pipeline uses from an API response"""
+        return {
+            "city": data["name"],
+            "country": data["sys"]["country"],
+            "temperature": data["main"]["temp"],
+            "feels_like": data["main"]["feels_like"],
+            "humidity": data["main"]["humidity"],
+            "description": data["weather"][0]["description"],
+            "wind_speed": data["wind"]["speed"]
         }
+    
+    def _request(self, city: str, timeout: float) -> dict:
+        """
+        Fetch a city's weather through the circuit breaker, trying the
+        gazetteer's closest spelling if the API doesn't know the name
+        
+        Raises:
+            CircuitOpenError: The API has been failing and isn't being called
+        """
+        give_up_at = time.monotonic() + timeout
+        try:
+            return self.breaker.call(self._fetch, city, timeout)
+        except UnknownCityError:
+            guess = self._guess(city)
+            if guess is None:
+                raise
+        logger.debug("weather_city_guessed city=%s guess=%s", city, guess)
+        return self.breaker.call(self._fetch, guess, max(give_up_at - time.monotonic(), 0.001))
+    
+    async def _arequest(self, city: str, timeout: float) -> dict:
+        """Asynchronous _request"""
+        give_up_at = time.monotonic() + timeout
+        try:
+            return await self.breaker.acall(self._afetch, city, timeout)
+        except UnknownCityError:
+            guess = self._guess(city)
+            if guess is None:
+                raise
+        logger.debug("weather_city_guessed city=%s guess=%s", city, guess)
+        return await self.breaker.acall(self._afetch, guess, max(give_up_at - time.monotonic(), 0.001))
+    
+    def _status_error(self, city: str, status: int, error: Exception) -> Exception:
+        """Exception to raise for an error response"""
+        if status == 404:
+            return UnknownCityError(f"Failed to fetch weather: unknown city {city!r}")
+        return WeatherAPIError(f"Failed to fetch weather: {str(error)}", status)
+    
+    def _send(self, url: str, params: dict, timeout: float):
+        """
+        GET from the API on the pooled session, retrying 429 and 5xx responses
+        
+        Only the first request is hedged; retries and the backoff before
+        them run in the caller's thread.
+        
+        Returns:
+            The last response
+        """
+        give_up_at = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            remaining = max(give_up_at - time.monotonic(), 0.001)
+            get = self.hedger.call if attempt == 0 else _call
+            response = get(self.session.get, url, params=params, timeout=remaining)
+            delay = self._retry_delay(response, attempt, give_up_at)
+            if delay is None:
+                return response
+            time.sleep(delay)
+            attempt += 1
+    
+    def _fetch(self, city: str, timeout: float) -> dict:
+        """
+        Call the OpenWeatherMap API on the pooled session
         
+        Raises:
+            UnknownCityError: The API doesn't know the city
+            WeatherAPIError: The API answered with another error status
+            Exception: Any other failure
+        """
         try:
-            response = requests.get(self.base_url, params=params, timeout=10)
+            response = self._send(self.base_url, self._params(city), timeout)
             response.raise_for_status()
-            data = response.json()
-            
-            # Extract relevant info
-            weather_info = {
-                "city": data["name"],
-                "country": data["sys"]["country"],
-                "temperature": data["main"]["temp"],
-                "feels_like": data["main"]["feels_like"],
-                "humidity": data["main"]["humidity"],
-                "description": data["weather"][0]["description"],
-                "wind_speed": data["wind"]["speed"]
-            }
+            return self._parse(response.json())
+        
+        except requests.HTTPError as e:
+            if e.response is not None:
+                raise self._status_error(city, e.response.status_code, e)
+            raise Exception(f"Failed to fetch weather: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Failed to fetch weather: {str(e)}")
+    
+    def _fetch_group(self, ids: List[int], timeout: float) -> dict:
+        """
+        Call the OpenWeatherMap group endpoint for several city ids
+        
+        Returns:
+            Weather per city id found
             
-            return weather_info
+        Raises:
+            WeatherAPIError: The API answered with an error status
+            Exception: Any other failure
+        """
+        params = {"id": ",".join(str(city_id) for city_id in ids), "appid": self.api_key, "units": self.units}
+        try:
+            response = self._send(self.group_url, params, timeout)
+            response.raise_for_status()
+            return {item["id"]: self._parse(item) for item in response.json()["list"]}
+        
+        except requests.HTTPError as e:
+            if e.response is not None:
+                raise WeatherAPIError(f"Failed to fetch weather: {str(e)}", e.response.status_code)
+            raise Exception(f"Failed to fetch weather: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Failed to fetch weather: {str(e)}")
+    
+    async def _afetch(self, city: str, timeout: float) -> dict:
+        """
+        Call the OpenWeatherMap API on the pooled async client
+        
+        Raises:
+            UnknownCityError: The API doesn't know the city
+            WeatherAPIError: The API answered with another error status
+            Exception: Any other failure
+        """
+        client = self._get_async_client()
+        give_up_at = time.monotonic() + timeout
+        
+        try:
+            attempt = 0
+            while True:
+                remaining = max(give_up_at - time.monotonic(), 0.001)
+                response = await client.get(self.base_url, params=self._params(city), timeout=remaining)
+                delay = self._retry_delay(response, attempt, give_up_at)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
             
+            response.raise_for_status()
+            return self._parse(response.json())
+        
+        except httpx.HTTPStatusError as e:
+            raise self._status_error(city, e.response.status_code, e)
         except Exception as e:
             raise Exception(f"Failed to fetch weather: {str(e)}")
 
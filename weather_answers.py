@@ -0,0 +1,223 @@
+"""
+Weather answers rendered from local templates instead of an LLM call
+"""
+
+import re
+import zlib
+from typing import Dict, List, Optional
+
+# Answer paths reported in the result's "response_path"
+TEMPLATE = "template"
+DEGRADED_TEMPLATE = "degraded_template"
+LLM = "llm"
+NO_DATA = "no_data"
+RAG = "rag"
+REFUSED = "refused"
+
+# Questions about other times than now: only the LLM can say what the
+# current conditions do and don't tell
+_OTHER_TIMES = {
+    "tomorrow", "tonight", "later", "week", "weekend", "forecast", "next", "yesterday", "hourly",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "month", "season", "usually", "average", "climate", "history"
+}
+
+# Advice and explanations, which the LLM answers even when they mention a
+# question type below
+_OPEN_ENDED = {
+    "should", "recommend", "suggest", "plan", "idea", "safe", "best", "activities", "activity",
+    "picnic", "hike", "hiking", "run", "running", "jog", "beach", "swim", "travel", "fly", "flight",
+    "drive", "why", "explain", "cause", "causes"
+}
+
+# Question types in priority order, with the words that identify them
+QUESTION_TYPES = [
+    ("rain", {"umbrella", "rain", "raining", "rainy", "wet", "drizzle", "drizzling", "shower", "showers", "storm"}),
+    ("clothing", {"wear", "jacket", "coat", "sweater", "jumper", "shorts", "layers", "dress", "gloves", "scarf"}),
+    ("wind", {"wind", "windy", "breeze", "breezy", "gust", "gusts", "gusty"}),
+    ("humidity", {"humid", "humidity", "muggy", "sticky", "damp"}),
+    ("temperature", {
+        "temperature", "temp", "degrees", "hot", "cold", "warm", "cool", "chilly", "freezing",
+        "hotter", "colder", "warmer", "cooler", "celsius"
+    }),
+]
+
+_TEMPLATES = {
+    "conditions": [
+        "It's currently {temperature}°C with {description} in {city}, {country}. "
+        "Humidity is {humidity}% and the wind speed is {wind_speed} m/s.",
+        "Right now {city} has {description} and {temperature}°C (feels like {feels_like}°C), "
+        "with {humidity}% humidity and wind at {wind_speed} m/s.",
+        "In {city}, {country} it's {temperature}°C and {description} at the moment. "
+        "Expect {humidity}% humidity and {wind_speed} m/s winds.",
+    ],
+    "rain": {
+        "rain": [
+            "Yes, take an umbrella: there's {description} in {city} right now, at {temperature}°C.",
+            "You'll want an umbrella in {city}. It's {temperature}°C with {description} at the moment.",
+        ],
+        "snow": [
+            "It's snowing rather than raining in {city} ({description}, {temperature}°C), "
+            "so dress for snow more than rain.",
+        ],
+        "dry": [
+            "No umbrella needed right now: {city} has {description} and {temperature}°C.",
+            "It isn't raining in {city} at the moment. It's {temperature}°C with {description}.",
+        ],
+    },
+    "clothing": {
+        "cold": ["It's {temperature}°C (feels like {feels_like}°C) in {city}, so wear a warm coat.{rain_note}"],
+        "cool": ["At {temperature}°C in {city} a jacket or sweater is a good idea.{rain_note}"],
+        "mild": ["It's a mild {temperature}°C in {city}; a light layer should be enough.{rain_note}"],
+        "warm": ["It's {temperature}°C in {city}, warm enough for light clothes.{rain_note}"],
+    },
+    "wind": [
+        "The wind in {city} is {wind_speed} m/s right now, {wind_word}.",
+        "{city} has {wind_word} at {wind_speed} m/s at the moment, with {description}.",
+    ],
+    "humidity": [
+        "Humidity in {city} is {humidity}% right now, which feels {humidity_word}.",
+        "It's {humidity}% humidity in {city} at the moment ({humidity_word}), at {temperature}°C.",
+    ],
+    "temperature": [
+        "It's {temperature}°C in {city} right now (feels like {feels_like}°C), so {temperature_word}.",
+        "{city} is at {temperature}°C at the moment, feeling like {feels_like}°C. "
+        "That's {temperature_word}.",
+    ],
+}
+
+
+def classify_question(query: str) -> Optional[str]:
+    """
+    Decide whether a weather question can be answered from a template
+
+    Args:
+        query: User query
+
+    Returns:
+        Question type ("rain", "clothing", "wind", "humidity", "temperature"
+        or "conditions"), or None for open-ended questions the LLM should answer
+    """
+    words = set(re.findall(r"[a-z]+", query.lower()))
+    # Checked before the keywords: "why is it so cold" asks for an
+    # explanation, not the temperature
+    if words & (_OTHER_TIMES | _OPEN_ENDED):
+        return None
+    for question_type, keywords in QUESTION_TYPES:
+        if words & keywords:
+            return question_type
+    return "conditions"
+
+
+def _condition(description: str) -> str:
+    """Group an OpenWeatherMap description: rain, snow or dry"""
+    description = description.lower()
+    if any(word in description for word in ("rain", "drizzle", "shower", "thunderstorm")):
+        return "rain"
+    if any(word in description for word in ("snow", "sleet")):
+        return "snow"
+    return "dry"
+
+
+def _temperature_band(temperature: float) -> str:
+    """Clothing band for a temperature in °C"""
+    if temperature < 8:
+        return "cold"
+    if temperature < 15:
+        return "cool"
+    if temperature < 22:
+        return "mild"
+    return "warm"
+
+
+def _temperature_word(temperature: float) -> str:
+    """How a temperature in °C feels"""
+    if temperature <= 0:
+        return "freezing"
+    if temperature < 8:
+        return "cold"
+    if temperature < 15:
+        return "cool"
+    if temperature < 22:
+        return "mild"
+    if temperature < 28:
+        return "warm"
+    return "hot"
+
+
+def _wind_word(wind_speed: float) -> str:
+    """Describe a wind speed in m/s"""
+    if wind_speed < 2:
+        return "almost calm"
+    if wind_speed < 5:
+        return "a light breeze"
+    if wind_speed < 10:
+        return "a moderate breeze"
+    if wind_speed < 17:
+        return "strong wind"
+    return "very strong wind"
+
+
+def _humidity_word(humidity: float) -> str:
+    """Describe a relative humidity in %"""
+    if humidity < 30:
+        return "dry"
+    if humidity < 60:
+        return "comfortable"
+    if humidity < 80:
+        return "a bit humid"
+    return "very humid"
+
+
+def _pick(variants: List[str], query: str, city: str) -> str:
+    """Choose a template variant, stable for the same question and city"""
+    return variants[zlib.crc32(f"{query}|{city}".encode()) % len(variants)]
+
+
+def _render_city(question_type: str, query: str, data: Dict) -> str:
+    """Render one city's answer"""
+    condition = _condition(data["description"])
+    values = {
+        **data,
+        "wind_word": _wind_word(data["wind_speed"]),
+        "humidity_word": _humidity_word(data["humidity"]),
+        "temperature_word": _temperature_word(data["temperature"]),
+        "rain_note": " Bring an umbrella too, there's " + data["description"] + "." if condition == "rain" else ""
+    }
+    templates = _TEMPLATES[question_type]
+    if question_type == "rain":
+        templates = templates[condition]
+    elif question_type == "clothing":
+        templates = templates[_temperature_band(data["temperature"])]
+    return _pick(templates, query, data["city"]).format(**values)
+
+
+def render(question_type: str, query: str, reports: List[Dict]) -> str:
+    """
+    Answer a weather question from templates
+
+    Args:
+        question_type: Result of classify_question
+        query: User query, used to vary the phrasing
+        reports: Per-city results, each with "city" and either "data" or "error"
+
+    Returns:
+        One paragraph per city, a comparison when several cities were asked
+        about, and the cities that couldn't be fetched
+    """
+    found = [report["data"] for report in reports if "data" in report]
+    paragraphs = [_render_city(question_type, query, data) for data in found]
+
+    if len(found) > 1 and question_type in ("temperature", "conditions"):
+        warmest = max(found, key=lambda data: data["temperature"])
+        coldest = min(found, key=lambda data: data["temperature"])
+        if warmest["temperature"] != coldest["temperature"]:
+            paragraphs.append(
+                f"{warmest['city']} is the warmest at {warmest['temperature']}°C "
+                f"and {coldest['city']} the coldest at {coldest['temperature']}°C."
+            )
+
+    missing = [report["city"] for report in reports if "error" in report]
+    if missing:
+        paragraphs.append(f"I couldn't get the weather for {', '.join(missing)}.")
+    return "\n\n".join(paragraphs)